@@ -0,0 +1,62 @@
+"""Speed and memory of flattening the crash cards into the three tables
+
+The previous row by row implementation (``.dict()`` of every nested model and dtype inference
+from a list of dicts) is compared with the columnar ``crash_to_dataframes`` on the recorded response
+replicated to ``--cards`` cards.
+
+    PYTHONPATH=. python benchmarks/bench_convert.py --cards 100000
+"""
+import argparse
+import time
+from typing import Tuple
+
+from pandas import DataFrame
+
+from benchmarks.bench_parse import replicated_body
+from parser_gibdd.api.gibdd_api import parse_dtp_card_data
+from parser_gibdd.convert import crash_to_dataframes
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+
+
+def legacy_crash_to_dataframes(data: CrashDataResponse) -> Tuple[DataFrame, DataFrame, DataFrame]:
+    crashes, vehicles, participants = [], [], []
+    for card in data.crashes:
+        crashes.append({**card.dict(exclude={'crash_info'}),
+                        **card.crash_info.dict(exclude={"vehicle_info", "participant_info"}),
+                        **{"region_name": data.region_name}})
+        vehicles.extend([{**veh.dict(exclude={"drivers_info"}), **{"crash_id": card.id}}
+                         for veh in card.crash_info.vehicle_info])
+        participants.extend([{**participant.dict(), **{"crash_id": card.id}}
+                             for participant in card.crash_info.participant_info])
+        participants.extend([{**driver.dict(), **{"crash_id": card.id}}
+                             for veh in card.crash_info.vehicle_info for driver in veh.drivers_info])
+    return DataFrame(crashes), DataFrame(vehicles), DataFrame(participants)
+
+
+def measure(convert, data, repeat: int) -> Tuple[float, int]:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        frames = convert(data)
+        best = min(best, time.perf_counter() - started)
+    return best, sum(int(frame.memory_usage(deep=True).sum()) for frame in frames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cards", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    body = replicated_body(args.cards)
+    model = parse_dtp_card_data(body)
+    view = parse_dtp_card_data(body, raw=True)
+    for label, convert, data in (("row by row, models", legacy_crash_to_dataframes, model),
+                                 ("columnar, models", crash_to_dataframes, model),
+                                 ("columnar, raw views", crash_to_dataframes, view)):
+        seconds, memory = measure(convert, data, args.repeat)
+        print(f"{label:20} {args.cards / seconds:10.0f} cards/s  {memory / 1024 ** 2:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Memory held by the parsed getDTPCardData responses: models, raw views and compact records
+
+The synthetic responses (see benchmarks/synthetic.py) are parsed page by page like a crawl does
+and kept in memory, the memory still allocated after the bodies are dropped is reported per card
+together with the parsing speed.
+
+    PYTHONPATH=. python benchmarks/bench_memory.py
+    PYTHONPATH=. python benchmarks/bench_memory.py --cards 200000 --page 2000
+"""
+import argparse
+import gc
+import logging
+import time
+import tracemalloc
+
+from benchmarks.synthetic import synthetic_body
+from parser_gibdd.api.gibdd_api import parse_dtp_card_data
+from parser_gibdd.convert import crash_to_dataframes
+
+MODES = {
+    "models": dict(raw=False, compact=False),
+    "raw views": dict(raw=True, compact=False),
+    "compact records": dict(raw=True, compact=True),
+    "validated compact records": dict(raw=False, compact=True),
+}
+
+
+def measure(bodies, mode):
+    """Seconds to parse the bodies, then the memory held by the parsed responses, traced in a separate pass"""
+    started = time.perf_counter()
+    for body in bodies:
+        parse_dtp_card_data(body, **mode)
+    seconds = time.perf_counter() - started
+    gc.collect()
+    tracemalloc.start()
+    responses = [parse_dtp_card_data(body, **mode) for body in bodies]
+    gc.collect()
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return responses, held, peak, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cards", type=int, default=20000)
+    parser.add_argument("--page", type=int, default=2000, help="cards in a single response")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    bodies = [synthetic_body(args.page, seed=seed) for seed in range(args.cards // args.page)]
+    cards = len(bodies) * args.page
+    print(f"{cards} cards in {len(bodies)} responses, {sum(map(len, bodies)) / 2 ** 20:.1f} MiB of json")
+    print(f"{'':28} {'held B/card':>12} {'peak MiB':>10} {'cards/s':>10} {'flatten s':>10}")
+    for label, mode in MODES.items():
+        responses, held, peak, seconds = measure(bodies, mode)
+        started = time.perf_counter()
+        for response in responses:
+            crash_to_dataframes(response)
+        flatten = time.perf_counter() - started
+        print(f"{label:28} {held / cards:12.0f} {peak / 2 ** 20:10.1f} {cards / seconds:10.0f} {flatten:10.2f}")
+        del responses
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Parsing speed of the getDTPCardData responses
+
+The recorded response in fixtures/dtp_card_data.json is replicated to ``--cards`` cards and parsed
+with the previous implementation (``Response.json()`` for both layers and ``parse_raw``) and the current one.
+The export path (parsing and the conversion into dataframes) is measured with the models and with the raw views.
+
+    PYTHONPATH=. python benchmarks/bench_parse.py --cards 20000
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+import pydantic
+
+from parser_gibdd import jsonlib
+from parser_gibdd.api.gibdd_api import parse_dtp_card_data
+from parser_gibdd.convert import crash_to_dataframes
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+
+FIXTURE = Path(__file__).parent / "fixtures" / "dtp_card_data.json"
+
+
+def replicated_body(cards: int) -> bytes:
+    data = json.loads(json.loads(FIXTURE.read_bytes())["data"])
+    recorded = data["tab"]
+    data["tab"] = [dict(recorded[ind % len(recorded)], KartId=ind, rowNum=ind) for ind in range(cards)]
+    data["countCard"] = data["end"] = cards
+    return json.dumps({"data": json.dumps(data, ensure_ascii=False)}, ensure_ascii=False).encode()
+
+
+def legacy_parse(body: bytes) -> CrashDataResponse:
+    return CrashDataResponse.parse_raw(json.loads(body)["data"])
+
+
+def measure(parse, body: bytes, cards: int, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parse(body)
+        best = min(best, time.perf_counter() - started)
+    return cards / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cards", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    body = replicated_body(args.cards)
+    assert legacy_parse(body) == parse_dtp_card_data(body)
+    print(f"json backend: {jsonlib.BACKEND}, compiled pydantic: {pydantic.compiled}, "
+          f"body: {len(body) / 1024 ** 2:.1f} MiB, cards: {args.cards}")
+    before = measure(legacy_parse, body, args.cards, args.repeat)
+    after = measure(parse_dtp_card_data, body, args.cards, args.repeat)
+    print(f"before: {before:10.0f} cards/s")
+    print(f"after:  {after:10.0f} cards/s  ({after / before:.2f}x)")
+    models = measure(lambda content: crash_to_dataframes(parse_dtp_card_data(content)), body, args.cards, args.repeat)
+    views = measure(lambda content: crash_to_dataframes(parse_dtp_card_data(content, raw=True)),
+                    body, args.cards, args.repeat)
+    print(f"export, models: {models:10.0f} cards/s")
+    print(f"export, raw:    {views:10.0f} cards/s  ({views / models:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Offline benchmarks of every stage of the crawl pipeline
+
+All data is synthetic (see benchmarks/synthetic.py), nothing is sent to stat.gibdd.ru.
+
+planning   units and pages planned for every district of a country-sized tree over ten years
+parsing    getDTPCardData bodies validated into the models and into the raw views
+flattening responses flattened into the three tables
+packaging  xlsx workbooks in one and in ``--workers`` processes, parquet parts
+crawl      a federal region crawled end to end through GibddAPI against SyntheticGibdd with ``--delay`` latency,
+           with the responses parsed in the download threads and in ``--parse-workers`` processes
+
+    PYTHONPATH=. python benchmarks/bench_pipeline.py
+    PYTHONPATH=. python benchmarks/bench_pipeline.py --only crawl --districts 30 --delay 0.2
+"""
+import argparse
+import logging
+import tempfile
+import time
+from datetime import date
+from pathlib import Path
+
+from benchmarks.bench_regions import synthetic_country
+from benchmarks.synthetic import SyntheticGibdd, synthetic_body
+from parser_gibdd.api.crashes import region_crashes_all_threading
+from parser_gibdd.api.gibdd_api import GibddAPI, parse_dtp_card_data
+from parser_gibdd.api.parsing import ParsePool
+from parser_gibdd.api.planner import RequestPlanner
+from parser_gibdd.api.throttle import Throttle, ConcurrencyController
+from parser_gibdd.convert import crash_to_dataframes, render_workbooks, write_columnar_subregion
+from parser_gibdd.metrics import Metrics, set_default_metrics
+
+SECTIONS = ("planning", "parsing", "flattening", "packaging", "crawl")
+
+
+def best_of(function, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def report(label: str, amount: float, unit: str, seconds: float) -> None:
+    print(f"{label:28} {amount / seconds:12.0f} {unit}/s  ({seconds:.3f}s)")
+
+
+def bench_planning(args) -> None:
+    country = synthetic_country(85, 30)
+    planner = RequestPlanner(max_months=12)
+    districts = [(fed.okato, district.okato) for fed in country.regions for district in fed.districts]
+
+    def plan():
+        for region, subregion in districts:
+            for unit in planner.units(region, subregion, date(2015, 1, 1), date(2024, 12, 1)):
+                planner.first_page(unit)
+
+    report("planning, 2,550 districts", len(districts), "districts", best_of(plan, args.repeat))
+
+
+def bench_parsing(args) -> None:
+    body = synthetic_body(args.cards)
+    report("parsing, models", args.cards, "cards", best_of(lambda: parse_dtp_card_data(body), args.repeat))
+    report("parsing, raw views", args.cards, "cards",
+           best_of(lambda: parse_dtp_card_data(body, raw=True), args.repeat))
+
+
+def bench_flattening(args) -> None:
+    body = synthetic_body(args.cards)
+    for label, data in (("flattening, models", parse_dtp_card_data(body)),
+                        ("flattening, raw views", parse_dtp_card_data(body, raw=True))):
+        report(label, args.cards, "cards", best_of(lambda: crash_to_dataframes(data), args.repeat))
+
+
+def bench_packaging(args) -> None:
+    pages = [parse_dtp_card_data(synthetic_body(args.cards // 8, seed=seed)) for seed in range(8)]
+    for workers in sorted({1, args.workers}):
+        seconds = best_of(lambda: list(render_workbooks(((str(ind), page) for ind, page in enumerate(pages)),
+                                                        workers)), 1)
+        report(f"xlsx, {workers} workers", args.cards, "cards", seconds)
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print("parquet skipped, pyarrow is not installed")
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        seconds = best_of(lambda: write_columnar_subregion(pages, Path(directory) / str(time.perf_counter()),
+                                                           municipal="Район"), args.repeat)
+    report("parquet", args.cards, "cards", seconds)
+
+
+def bench_crawl(args) -> None:
+    region = synthetic_country(1, args.districts).regions[0]
+    synthetic = SyntheticGibdd(cards_per_month=args.cards_per_month, delay=args.delay)
+    # the synthetic months are generated on the first crawl, only the next ones are measured
+    region_crashes_all_threading(region, date(2019, 1, 1), date(2020, 12, 1), api=GibddAPI(replay=synthetic),
+                                 planner=RequestPlanner())
+    for parse_workers in sorted({0, args.parse_workers}):
+        parse_pool = ParsePool(parse_workers) if parse_workers else None
+        if parse_pool is not None:
+            parse_pool.parse(synthetic_body(1))  # starts the workers
+        synthetic.requests = 0
+        metrics = Metrics()
+        previous = set_default_metrics(metrics)
+        throttle = Throttle(rate=0, controller=ConcurrencyController(maximum=args.workers * 4))
+        try:
+            with GibddAPI(replay=synthetic, throttle=throttle, parse_pool=parse_pool) as api:
+                started = time.perf_counter()
+                crashes = region_crashes_all_threading(region, date(2019, 1, 1), date(2020, 12, 1), api=api,
+                                                       planner=RequestPlanner())
+                seconds = time.perf_counter() - started
+        finally:
+            set_default_metrics(previous)
+        cards = sum(len(response.crashes) for responses in crashes.values() for response in responses)
+        label = f"{parse_workers} parse workers" if parse_workers else "parsed in threads"
+        report(f"crawl, {label}", cards, "cards", seconds)
+        report("crawl requests", synthetic.requests, "requests", seconds)
+        print(metrics.summary(top=3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", choices=SECTIONS, action="append", help="run only these sections")
+    parser.add_argument("--cards", type=int, default=4000, help="cards of the parsed, flattened and packaged data")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=4, help="processes of the xlsx packaging")
+    parser.add_argument("--districts", type=int, default=20, help="districts of the crawled region")
+    parser.add_argument("--cards-per-month", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.05, help="latency of a synthetic response in seconds")
+    parser.add_argument("--parse-workers", type=int, default=4,
+                        help="the crawl is measured without a parse pool and with this amount of parse workers")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    for section in args.only or SECTIONS:
+        globals()[f"bench_{section}"](args)
+
+
+if __name__ == "__main__":
+    main()
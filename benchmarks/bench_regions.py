@@ -0,0 +1,94 @@
+"""Region lookups of Country over a tree the size of the real one
+
+85 federal regions with 30 districts each (2,550 districts) are generated, every district is looked up
+by OKATO and its parent is found, with the previous linear scans and with the index.
+Fuzzy search is measured on addresses that contain a district name, scoring every name against
+every query and scoring only the trigram shortlist.
+
+    PYTHONPATH=. python benchmarks/bench_regions.py
+"""
+import argparse
+import time
+from typing import Optional
+
+from fuzzywuzzy import fuzz
+
+from parser_gibdd.models.region import Country, Region, FederalRegion
+
+
+def synthetic_country(federal: int, districts: int) -> Country:
+    return Country(regions=[
+        FederalRegion(name=f"Регион {fed}", okato=str(fed), districts=[
+            Region(name=f"Район {fed}-{sub}", okato=f"{fed}{sub:03d}") for sub in range(districts)
+        ])
+        for fed in range(1, federal + 1)
+    ])
+
+
+def linear_get_region(country: Country, okato: str) -> Optional[Region]:
+    for region in country.regions:
+        if region.okato == okato:
+            return region
+        for subregion in region.districts:
+            if subregion.okato == okato:
+                return subregion
+    return None
+
+
+def linear_get_parent_region(country: Country, region: Region) -> Optional[FederalRegion]:
+    for federal in country.regions:
+        if federal.okato == region.okato:
+            return federal
+        if region.okato in [inner.okato for inner in federal.districts]:
+            return federal
+    return None
+
+
+def linear_find_region(country: Country, region_name: str):
+    found_regions = []
+    for region in country.regions:
+        if fuzz.partial_ratio(region.name, region_name) > 90:
+            found_regions.append(region)
+        for inner in region.districts:
+            if fuzz.partial_ratio(inner.name, region_name) > 90:
+                found_regions.append(inner)
+    return found_regions
+
+
+def measure(lookup, items) -> float:
+    started = time.perf_counter()
+    for item in items:
+        lookup(item)
+    return (time.perf_counter() - started) / len(items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--federal", type=int, default=85)
+    parser.add_argument("--districts", type=int, default=30)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    country = synthetic_country(args.federal, args.districts)
+    print(f"{args.federal * args.districts} districts, country with the index built in "
+          f"{time.perf_counter() - started:.3f}s")
+    codes = [district.okato for fed in country.regions for district in fed.districts]
+    regions = [country.get_region(okato) for okato in codes]
+    for label, lookup, items in (
+            ("get_region, linear", lambda okato: linear_get_region(country, okato), codes),
+            ("get_region, index", country.get_region, codes),
+            ("get_parent_region, linear", lambda region: linear_get_parent_region(country, region), regions),
+            ("get_parent_region, index", country.get_parent_region, regions),
+    ):
+        print(f"{label:26} {measure(lookup, items) * 1e6:10.2f} us per lookup")
+    addresses = [f"ул. Ленина, 1, Район {fed}-{sub}"
+                 for fed in range(1, args.federal + 1, 7) for sub in range(0, args.districts, 7)]
+    for label, lookup in (
+            ("find_region, linear", lambda name: linear_find_region(country, name)),
+            ("find_region, trigrams", country.find_region),
+    ):
+        print(f"{label:26} {measure(lookup, addresses) * 1e6:10.2f} us per lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""CLI startup time and OKATO tree loading time
+
+``gibdd --help`` and the import of the CLI are timed in fresh interpreters, the OKATO tree of the synthetic
+2,550 district country is loaded with ``Country.parse_raw`` and through the binary cache.
+
+    PYTHONPATH=. python benchmarks/bench_startup.py
+"""
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.bench_regions import synthetic_country
+from parser_gibdd.models.region import Country
+from parser_gibdd.snapshots import load_country
+
+COMMANDS = {
+    "import parser_gibdd.cli.shell": "import parser_gibdd.cli.shell",
+    "gibdd --help": "from parser_gibdd.cli.shell import main; main(['--help'])",
+}
+
+
+def interpreter_seconds(code: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=False, stdout=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = interpreter_seconds("pass", args.repeat)
+    print(f"{'empty interpreter':32} {baseline * 1000:8.1f} ms")
+    for label, code in COMMANDS.items():
+        print(f"{label:32} {interpreter_seconds(code, args.repeat) * 1000:8.1f} ms")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "okato_codes_latest.json"
+        path.write_text(synthetic_country(85, 30).json(ensure_ascii=False), encoding="utf-8")
+        for label, load in (("Country.parse_raw", lambda: Country.parse_raw(path.read_bytes())),
+                            ("load_country, binary cache", lambda: load_country(path))):
+            load()
+            best = float("inf")
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                load()
+                best = min(best, time.perf_counter() - started)
+            print(f"{label:32} {best * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
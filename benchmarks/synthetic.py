@@ -0,0 +1,129 @@
+"""Synthetic getDTPCardData responses of any size
+
+Cards are assembled from the vehicles, participants and crash details of the recorded response
+in fixtures/dtp_card_data.json, so every field has the shape and the vocabulary of the real data.
+SyntheticGibdd answers getDTPCardData requests like the real site: a deterministic amount of cards
+for every subregion and month, paginated with ``st`` and ``en``. It is plugged into GibddAPI as ``replay``:
+
+    api = GibddAPI(replay=SyntheticGibdd(cards_per_month=300, delay=0.05))
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from parser_gibdd.exceptions import RecordingNotFoundError
+from parser_gibdd.models.gibdd.requests import GibddDateString
+
+FIXTURE = Path(__file__).parent / "fixtures" / "dtp_card_data.json"
+
+
+class CardFactory:
+    """Builds random cards from the parts of the recorded cards"""
+
+    def __init__(self, seed: int = 0):
+        recorded = json.loads(json.loads(FIXTURE.read_bytes())["data"])["tab"]
+        self.random = random.Random(seed)
+        self.cards = recorded
+        self.vehicles = [vehicle for card in recorded for vehicle in card["infoDtp"]["ts_info"]]
+        self.participants = [participant for card in recorded for participant in card["infoDtp"]["uchInfo"]]
+
+    def card(self, kart_id: int, date_string: str, district: str = "Район") -> Dict[str, Any]:
+        rnd = self.random
+        template = rnd.choice(self.cards)
+        vehicles = [dict(vehicle, n_ts=str(ind + 1)) for ind, vehicle in
+                    enumerate(rnd.choices(self.vehicles, k=rnd.choice((1, 1, 2, 2, 2, 3))))]
+        participants = rnd.choices(self.participants, k=rnd.choice((0, 0, 1, 1, 2))) if self.participants else []
+        info = dict(template["infoDtp"], COORD_L=round(rnd.uniform(30.0, 60.0), 5),
+                    COORD_W=round(rnd.uniform(43.0, 60.0), 5), house=str(rnd.randint(1, 200)),
+                    ts_info=vehicles, uchInfo=participants)
+        return dict(template, KartId=kart_id, rowNum=kart_id, date=date_string, District=district,
+                    Time=f"{rnd.randint(0, 23)}:{rnd.randint(0, 59):02d}", K_TS=len(vehicles),
+                    K_UCH=len(participants) + sum(len(vehicle["ts_uch"]) for vehicle in vehicles),
+                    RAN=rnd.randint(0, 3), POG=rnd.choice((0, 0, 0, 0, 1)), infoDtp=info)
+
+    def cards_of_month(self, district: str, year: int, month: int, amount: int, first_id: int) -> List[Dict[str, Any]]:
+        return [self.card(first_id + ind, f"{ind % 28 + 1:02d}.{month:02d}.{year}", district) for ind in range(amount)]
+
+
+def synthetic_body(cards: int, seed: int = 0, region_name: str = "Район") -> bytes:
+    """Body of a getDTPCardData response with ``cards`` synthetic cards"""
+    factory = CardFactory(seed)
+    tab = [factory.card(ind, f"{ind % 28 + 1:02d}.{ind % 12 + 1:02d}.2021", region_name) for ind in range(cards)]
+    return response_body(region_name, tab, len(tab), 0, len(tab))
+
+
+def response_body(region_name: str, tab: List[Dict[str, Any]], count: int, start: int, end: int) -> bytes:
+    data = {"RegName": region_name, "countCard": count, "end": end, "pokName": "", "posl": "", "ran": 0,
+            "pog": 0, "start": start, "tab": tab}
+    return json.dumps({"data": json.dumps(data, ensure_ascii=False)}, ensure_ascii=False).encode()
+
+
+class SyntheticGibdd:
+    """Fake stat.gibdd.ru answering the getDTPCardData requests with synthetic cards
+
+    Parameters
+    ----------
+    cards_per_month : int
+        average amount of cards of a subregion in a month, the amount of every subregion and month
+        is between a half and one and a half of it
+    seed : int
+        seed of the amounts and of the cards
+    delay : float
+        latency of every response in seconds
+    seconds_per_card : float
+        additional latency of every card in a response
+    """
+    replaying = True
+
+    def __init__(self, cards_per_month: int = 100, seed: int = 0, delay: float = 0.0, seconds_per_card: float = 0.0):
+        self.cards_per_month = cards_per_month
+        self.seed = seed
+        self.delay = delay
+        self.seconds_per_card = seconds_per_card
+        self.requests = 0
+        self._months: Dict[tuple, List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def _digest(self, subregion: str, year: int, month: int) -> bytes:
+        return hashlib.sha256(f"{self.seed}:{subregion}:{year}:{month}".encode()).digest()
+
+    def month_count(self, subregion: str, year: int, month: int) -> int:
+        return int(self.cards_per_month * (0.5 + self._digest(subregion, year, month)[0] / 255))
+
+    def _month_cards(self, subregion: str, year: int, month: int) -> List[Dict[str, Any]]:
+        key = (subregion, year, month)
+        with self._lock:
+            cards = self._months.get(key)
+        if cards is None:
+            factory = CardFactory(int.from_bytes(self._digest(subregion, year, month)[:8], "big"))
+            first_id = int(subregion) * 10 ** 9 + (year * 12 + month) * 10 ** 4
+            amount = self.month_count(subregion, year, month)
+            cards = factory.cards_of_month(f"Район {subregion}", year, month, amount, first_id)
+            with self._lock:
+                self._months[key] = cards
+        return cards
+
+    def replay(self, url: str, payload: Optional[Dict[str, Any]]) -> bytes:
+        if not urlsplit(url).path.endswith("/getDTPCardData") or payload is None:
+            raise RecordingNotFoundError(f"SyntheticGibdd only answers getDTPCardData, got {url}")
+        request = json.loads(payload["data"])
+        tab = [
+            card
+            for date_string in request["date"]
+            for card in self._month_cards(request["reg"], *GibddDateString(date_string).year_month())
+        ]
+        start, end = int(request["st"]), int(request["en"])
+        page = tab[start:end]
+        if self.delay or self.seconds_per_card:
+            time.sleep(self.delay + self.seconds_per_card * len(page))
+        with self._lock:
+            self.requests += 1
+        return response_body(f"Район {request['reg']}", page, len(tab), start, end)
+
+    def record(self, url: str, payload: Optional[Dict[str, Any]], body: bytes) -> None:
+        pass
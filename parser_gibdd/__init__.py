@@ -1,10 +1,11 @@
 from logging.config import dictConfig
 from pathlib import Path
 
-from dotenv import load_dotenv
-
 env_path = Path('') / '.env'
-load_dotenv(dotenv_path=env_path)
+if env_path.exists():
+    from dotenv import load_dotenv
+
+    load_dotenv(dotenv_path=env_path)
 
 dictConfig({
     'version': 1,
@@ -0,0 +1,563 @@
+"""Asyncio crawl engine
+
+All getDTPCardData requests of a crawl are issued from a single event loop, the amount of requests
+in flight is limited globally by ``concurrency`` and the rate of requests is limited for every host,
+or both are adapted to the server by a :class:`parser_gibdd.api.throttle.Throttle`.
+Work units are fed to the workers through a bounded queue, so a country crawl never schedules
+more work than the workers are able to process.
+
+Requires ``aiohttp`` to be installed.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import queue
+import threading
+import time
+from datetime import date
+from typing import Any, Callable, Tuple, List, Dict, Union, Optional, AsyncIterator, Iterator
+from urllib.parse import urlsplit
+
+from parser_gibdd.api.crashes import incomplete_unit
+from parser_gibdd.api.gibdd_api import parse_dtp_card_data, GIBDD_HOST
+from parser_gibdd.api.parsing import ParsePool
+from parser_gibdd.api.planner import CrawlUnit, RequestPlanner, PageSizer, default_planner
+from parser_gibdd.api.throttle import Throttle, OVERLOAD_STATUSES
+from parser_gibdd.cache import ResponseCache
+from parser_gibdd.exceptions import ResourceUnreachable, ResourceRequestFailed, CrashesNotFoundError
+from parser_gibdd.journal import CrawlJournal
+from parser_gibdd.metrics import default_metrics, labelled, record_response
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+from parser_gibdd.models.gibdd.requests import GibddDTPCardData, GibddDateString, DtpCardDataOrder
+from parser_gibdd.models.region import FederalRegion, Country, Region
+from parser_gibdd.models.region import RegionName, FederalRegionName
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+country_return_type = Dict[FederalRegionName, Dict[RegionName, List[CrashDataResponse]]]
+
+
+class HostRateLimiter:
+    """Spaces out the starts of requests to the same host
+
+    Parameters
+    ----------
+    rate : float
+        maximum amount of requests per second for a single host, no limit if 0
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next_slot: Dict[str, float] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def wait(self, host: str) -> None:
+        if not self.rate:
+            return
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + 1 / self.rate
+        delay = slot - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def retry_after(header: Optional[str], default: float) -> float:
+    """Seconds to wait from the Retry-After header, only the delay form of the header is supported"""
+    try:
+        return min(max(float(header), 0.0), 120.0) if header else default
+    except ValueError:
+        return default
+
+
+class AsyncGibddAPI:
+    """Async counterpart of the GibddAPI
+
+    Parameters
+    ----------
+    host : str
+        address of the gibdd website, can be pointed to a local fake for testing
+    concurrency : int
+        maximum amount of requests in flight at the same time
+    rate : float
+        maximum amount of requests per second sent to a single host
+    retries : int
+        how many times a request is retried if the resource is unreachable or returns 429 or 5xx
+    timeout : float
+        total timeout of a single request in seconds
+    throttle : Throttle, optional
+        adaptive pacing of the requests, replaces the fixed ``concurrency`` and ``rate`` limits,
+        ``concurrency`` stays the amount of the crawl workers
+    cache : ResponseCache, optional
+        on-disk cache of the responses, cached responses are returned without network calls
+    raw : bool
+        parse the responses into unvalidated views instead of the models, see GibddAPI
+    compact : bool
+        keep the responses as compact records, see GibddAPI
+    parse_pool : ParsePool, optional
+        worker processes validating the responses, see GibddAPI, the pool is not closed with the api
+    """
+
+    def __init__(self,
+                 host: str = GIBDD_HOST,
+                 concurrency: int = 20,
+                 rate: float = 10.0,
+                 retries: int = 5,
+                 timeout: float = 300.0,
+                 throttle: Optional[Throttle] = None,
+                 cache: Optional[ResponseCache] = None,
+                 raw: bool = False,
+                 compact: bool = False,
+                 parse_pool: Optional[ParsePool] = None):
+        if aiohttp is None:
+            raise ImportError("aiohttp is required for the async crawl engine, install it with `pip install aiohttp`")
+        self.host = host
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.cache = cache
+        self.raw = raw
+        self.compact = compact
+        self.parse_pool = parse_pool
+        self.throttle = throttle
+        self.rate_limiter = HostRateLimiter(rate)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._released: Optional[asyncio.Event] = None
+        self.session: Optional["aiohttp.ClientSession"] = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._released = asyncio.Event()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.session.close()
+
+    async def _acquire(self, host: str) -> float:
+        """Wait for a slot and a token, returns the time the request is sent at"""
+        if self.throttle is None:
+            started = time.monotonic()
+            await self._semaphore.acquire()
+            await self.rate_limiter.wait(host)
+            default_metrics().observe("throttle", time.monotonic() - started)
+            return 0.0
+        started = time.monotonic()
+        while not self.throttle.controller.try_acquire():
+            # nothing is awaited between the failed attempt and clear, so no release can be missed
+            self._released.clear()
+            await self._released.wait()
+        delay = self.throttle.bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        self.throttle.record_wait(time.monotonic() - started)
+        return time.monotonic()
+
+    def _release(self, sent: float, status: Optional[int], cancel: bool = False) -> None:
+        if self.throttle is None:
+            self._semaphore.release()
+            return
+        if cancel:
+            self.throttle.cancel(sent)
+        else:
+            self.throttle.release(sent, status)
+        self._released.set()
+
+    async def send_dtp_card_data(self, request_data: GibddDTPCardData) -> bytes:
+        """Send a getDTPCardData request and return the raw body of the response"""
+        body, _, _ = await self.fetch_dtp_card_data(request_data)
+        return body
+
+    async def fetch_dtp_card_data(self, request_data: GibddDTPCardData) -> Tuple[bytes, bool, float]:
+        """Same as send_dtp_card_data, also tells whether the body was taken from the cache
+        and the seconds of the round trip of the request, without the waits for the throttle"""
+        url = f'{self.host}/map/getDTPCardData'
+        payload = request_data.to_request_form()
+        if self.cache is not None:
+            cached = self.cache.get(payload)
+            if cached is not None:
+                return cached, True, 0.0
+        attempt = 0
+        while True:
+            sent = await self._acquire(urlsplit(url).netloc)
+            try:
+                started = time.perf_counter()
+                async with self.session.post(url, json=payload) as response:
+                    body = await response.read()
+                round_trip = time.perf_counter() - started
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                self._release(sent, None)
+                attempt += 1
+                if attempt > self.retries:
+                    raise ResourceUnreachable(f"Unable to reach the requested resource, exception:\n {e}")
+                logger.warning(f"Request to {url} failed, retrying ({attempt}/{self.retries}): {e!r}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+            except BaseException:
+                self._release(sent, None, cancel=True)
+                raise
+            self._release(sent, response.status)
+            if response.status in OVERLOAD_STATUSES and attempt < self.retries:
+                attempt += 1
+                logger.warning(f"Request to {url} returned {response.status}, retrying ({attempt}/{self.retries})")
+                await asyncio.sleep(retry_after(response.headers.get("Retry-After"), min(2 ** attempt, 30)))
+                continue
+            if response.status >= 400:
+                raise ResourceRequestFailed(
+                    f"Request failed with status code {response.status}:\n"
+                    f"Response: {body[:1000]!r}"
+                )
+            logger.info('Request successful')
+            if self.cache is not None:
+                self.cache.set(payload, body)
+            return body, False, round_trip
+
+
+async def subregion_timeframe_crashes_amount_async(api: AsyncGibddAPI,
+                                                   region: Union[str, int],
+                                                   subregion: Union[str, int],
+                                                   year: int,
+                                                   months: Tuple[int, int] = (1, 12),
+                                                   cards: Tuple[int, int] = (0, 50)) -> CrashDataResponse:
+    """Async version of :func:`parser_gibdd.api.crashes.subregion_timeframe_crashes_amount`"""
+    first, last = months
+    request_data = GibddDTPCardData(
+        date=[GibddDateString.from_year_month(year, m) for m in range(first, last + 1)],
+        ParReg=str(region),
+        order=DtpCardDataOrder(type=1, fieldName='dat'),
+        reg=str(subregion),
+        ind='1',
+        st=str(cards[0]),
+        en=str(cards[1])
+    )
+    return await dtp_card_data_async(api, request_data)
+
+
+async def in_thread(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Run a blocking call in the default executor, so it does not stall the other requests of the loop
+
+    The call keeps the metrics labels of the task
+    """
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(None, call)
+
+
+async def dtp_card_data_async(api: AsyncGibddAPI,
+                              request_data: GibddDTPCardData,
+                              sizer: Optional[PageSizer] = None) -> CrashDataResponse:
+    """Send a single getDTPCardData request and parse the response, network downloads are observed by the sizer"""
+    with labelled(okato=request_data.reg):
+        body, from_cache, elapsed = await api.fetch_dtp_card_data(request_data)
+        record_response(len(body), elapsed, from_cache)
+        try:
+            if api.parse_pool is not None and not api.raw:
+                # submitting waits for a free slot of the pool, so it does not block the loop either
+                crashes = await asyncio.wrap_future(await in_thread(api.parse_pool.submit, body, compact=api.compact))
+            else:
+                crashes = await in_thread(parse_dtp_card_data, body, raw=api.raw, compact=api.compact)
+        except CrashesNotFoundError:
+            # the body is cached before it is parsed, a body that can not be parsed is not served again
+            if api.cache is not None:
+                api.cache.discard(request_data.to_request_form())
+            raise
+        default_metrics().count("cards", len(crashes.crashes))
+    if sizer is not None and not from_cache:
+        sizer.observe(len(crashes.crashes), elapsed, len(body))
+    return crashes
+
+
+async def unit_crashes_async(api: AsyncGibddAPI,
+                             unit: CrawlUnit,
+                             planner: Optional[RequestPlanner] = None) -> List[CrashDataResponse]:
+    """Async version of :func:`parser_gibdd.api.crashes.unit_crashes`, the pages are requested concurrently"""
+    planner = planner or default_planner()
+    count = planner.known_count(unit)
+    if count == 0:
+        return []
+    crashes: List[CrashDataResponse] = []
+    start = 0
+    if count is None:
+        first_request = planner.first_page(unit)
+        try:
+            first_page = await dtp_card_data_async(api, first_request, planner.sizer)
+        except CrashesNotFoundError:
+            # only the first page tells that there are no crashes in the unit
+            planner.record(unit, 0)
+            return []
+        count = first_page.cards_amount
+        planner.record(unit, count)
+        crashes.append(first_page)
+        start = int(first_request.en)
+    try:
+        crashes.extend(await asyncio.gather(*[
+            dtp_card_data_async(api, request_data, planner.sizer)
+            for request_data in planner.pages(unit, count, start=start)
+        ]))
+    except CrashesNotFoundError as e:
+        raise incomplete_unit(unit, crashes, count) from e
+    return crashes
+
+
+async def subregion_unit_crashes_async(api: AsyncGibddAPI,
+                                       unit: CrawlUnit,
+                                       journal: Optional[CrawlJournal] = None,
+                                       planner: Optional[RequestPlanner] = None) -> List[CrashDataResponse]:
+    """Crashes of a single crawl unit, units finished by a previous crawl are taken from the journal"""
+    planner = planner or default_planner()
+    if journal is not None:
+        finished = await in_thread(journal.get, unit)
+        if finished is not None:
+            logger.info(f"{unit} is already finished, skipping")
+            planner.finished(unit, finished)
+            return finished
+    crashes = await unit_crashes_async(api, unit, planner)
+    if journal is not None:
+        await in_thread(journal.record, unit, crashes)
+    planner.finished(unit, crashes)
+    return crashes
+
+
+async def subregion_crashes_async(api: AsyncGibddAPI,
+                                  region: Union[str, int],
+                                  subregion: Union[str, int],
+                                  period_start: date,
+                                  period_end: date,
+                                  journal: Optional[CrawlJournal] = None,
+                                  planner: Optional[RequestPlanner] = None) -> List[CrashDataResponse]:
+    """Get all crashes between two given dates, every unit of the plan is requested concurrently"""
+    planner = planner or default_planner()
+    logger.info(f"retrieving crashes for:\nregion: {region},\nsubregion: {subregion}")
+    units = await asyncio.gather(*[
+        subregion_unit_crashes_async(api, unit, journal, planner)
+        for unit in planner.units(region, subregion, period_start, period_end)
+    ])
+    logger.info(f"Data for subregion {subregion} in region {region} collected")
+    return [crash for unit_crashes in units for crash in unit_crashes]
+
+
+def _check_okato(region: Region) -> None:
+    if not region.okato:
+        raise Exception(
+            f"No okato code for region: {region.name}, update the cache for federal regions"
+        )
+
+
+async def _crawl_stream(api: AsyncGibddAPI,
+                        units: List[Tuple[FederalRegion, Region]],
+                        period_start: date,
+                        period_end: date,
+                        journal: Optional[CrawlJournal] = None,
+                        planner: Optional[RequestPlanner] = None
+                        ) -> AsyncIterator[Tuple[Tuple[FederalRegion, Region], List[CrashDataResponse]]]:
+    """Crawl (federal region, subregion) units with a fixed amount of workers, yield them as they are finished
+
+    Both queues are bounded: the producer waits for the workers and the workers wait for the consumer,
+    so no more than a few subregions per worker are held in memory.
+    The first error stops the crawl and is raised to the consumer.
+    """
+    work: asyncio.Queue = asyncio.Queue(maxsize=api.concurrency * 2)
+    done: asyncio.Queue = asyncio.Queue(maxsize=api.concurrency)
+
+    async def producer():
+        for unit in units:
+            await work.put(unit)
+        for _ in range(api.concurrency):
+            await work.put(None)
+
+    async def worker():
+        while True:
+            unit = await work.get()
+            if unit is None:
+                break
+            fed, subregion = unit
+            try:
+                crashes = await subregion_crashes_async(
+                    api, fed.okato, subregion.okato, period_start, period_end, journal, planner
+                )
+            except Exception as e:
+                await done.put(e)
+                return
+            await done.put((unit, crashes))
+        await done.put(None)
+
+    tasks = [asyncio.create_task(producer())] + [asyncio.create_task(worker()) for _ in range(api.concurrency)]
+    finished_workers = 0
+    try:
+        while finished_workers < api.concurrency:
+            item = await done.get()
+            if item is None:
+                finished_workers += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _crawl(api: AsyncGibddAPI,
+                 units: List[Tuple[FederalRegion, Region]],
+                 period_start: date,
+                 period_end: date,
+                 journal: Optional[CrawlJournal] = None,
+                 planner: Optional[RequestPlanner] = None) -> Dict[Tuple[str, str], List[CrashDataResponse]]:
+    return {
+        (fed.okato, subregion.okato): crashes
+        async for (fed, subregion), crashes in _crawl_stream(api, units, period_start, period_end, journal, planner)
+    }
+
+
+def _country_units(country: Country) -> List[Tuple[FederalRegion, Region]]:
+    units = []
+    for fed in country.regions:
+        _check_okato(fed)
+        for subregion in fed.districts:
+            _check_okato(subregion)
+            units.append((fed, subregion))
+    return units
+
+
+async def region_crashes_all_async(api: AsyncGibddAPI,
+                                   region: FederalRegion,
+                                   period_start: date,
+                                   period_end: date,
+                                   journal: Optional[CrawlJournal] = None,
+                                   planner: Optional[RequestPlanner] = None
+                                   ) -> Dict[RegionName, List[CrashDataResponse]]:
+    """Get all crashes in a given federal region"""
+    _check_okato(region)
+    for subregion in region.districts:
+        _check_okato(subregion)
+    results = await _crawl(api, [(region, sub) for sub in region.districts], period_start, period_end,
+                           journal, planner)
+    return {sub.name: results[(region.okato, sub.okato)] for sub in region.districts}
+
+
+async def country_crashes_all_async(api: AsyncGibddAPI,
+                                    country: Country,
+                                    period_start: date,
+                                    period_end: date,
+                                    journal: Optional[CrawlJournal] = None,
+                                    planner: Optional[RequestPlanner] = None) -> country_return_type:
+    """Get all crashes in Russia, all subregions of all federal regions share the same workers"""
+    results = await _crawl(api, _country_units(country), period_start, period_end, journal, planner)
+    return {
+        fed.name: {sub.name: results[(fed.okato, sub.okato)] for sub in fed.districts}
+        for fed in country.regions
+    }
+
+
+def country_crashes_all_asyncio(country: Country,
+                                period_start: date,
+                                period_end: date,
+                                concurrency: int = 20,
+                                rate: float = 10.0,
+                                host: str = GIBDD_HOST,
+                                cache: Optional[ResponseCache] = None,
+                                journal: Optional[CrawlJournal] = None,
+                                planner: Optional[RequestPlanner] = None,
+                                raw: bool = False,
+                                throttle: Optional[Throttle] = None,
+                                compact: bool = False,
+                                parse_pool: Optional[ParsePool] = None) -> country_return_type:
+    """Blocking entrypoint for the async country crawl"""
+
+    async def run():
+        async with AsyncGibddAPI(host, concurrency=concurrency, rate=rate, throttle=throttle, cache=cache,
+                                 raw=raw, compact=compact, parse_pool=parse_pool) as api:
+            return await country_crashes_all_async(api, country, period_start, period_end, journal, planner)
+
+    return asyncio.run(run())
+
+
+async def stream_country_crashes_async(api: AsyncGibddAPI,
+                                       country: Country,
+                                       period_start: date,
+                                       period_end: date,
+                                       journal: Optional[CrawlJournal] = None,
+                                       planner: Optional[RequestPlanner] = None
+                                       ) -> AsyncIterator[Tuple[FederalRegionName, RegionName,
+                                                                List[CrashDataResponse]]]:
+    """Yield the crashes of every subregion in Russia as soon as the subregion is finished"""
+    async for (fed, subregion), crashes in _crawl_stream(
+            api, _country_units(country), period_start, period_end, journal, planner
+    ):
+        yield FederalRegionName(fed.name), RegionName(subregion.name), crashes
+
+
+def iter_country_crashes_asyncio(country: Country,
+                                 period_start: date,
+                                 period_end: date,
+                                 concurrency: int = 20,
+                                 rate: float = 10.0,
+                                 host: str = GIBDD_HOST,
+                                 cache: Optional[ResponseCache] = None,
+                                 journal: Optional[CrawlJournal] = None,
+                                 planner: Optional[RequestPlanner] = None,
+                                 raw: bool = False,
+                                 throttle: Optional[Throttle] = None,
+                                 compact: bool = False,
+                                 parse_pool: Optional[ParsePool] = None
+                                 ) -> Iterator[Tuple[FederalRegionName, RegionName, List[CrashDataResponse]]]:
+    """Blocking iterator over the async country crawl
+
+    The event loop runs in a background thread and hands the finished subregions over a bounded queue,
+    so the consumer can write them out while the next ones are being downloaded.
+    """
+    results: queue.Queue = queue.Queue(maxsize=concurrency)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        async with AsyncGibddAPI(host, concurrency=concurrency, rate=rate, throttle=throttle, cache=cache,
+                                 raw=raw, compact=compact, parse_pool=parse_pool) as api:
+            async for item in stream_country_crashes_async(api, country, period_start, period_end, journal,
+                                                           planner):
+                if not await loop.run_in_executor(None, put, item):
+                    break
+
+    def target():
+        try:
+            asyncio.run(run())
+        except BaseException as e:
+            put(e)
+        else:
+            put(finished)
+
+    thread = threading.Thread(target=target, name="gibdd-event-loop", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = results.get()
+            if item is finished:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -1,14 +1,20 @@
 import concurrent.futures
 import logging
+import time
+from collections import deque
 from datetime import date
 from functools import partial
-from typing import Tuple, List, Dict, Union
+from typing import Tuple, List, Dict, Union, Optional, Iterator, Deque
 
-from parser_gibdd.api.gibdd_api import GibddAPI, DtpCardDataResponseHandler
-from parser_gibdd.exceptions import CrashesNotFoundError
+from parser_gibdd.api.gibdd_api import GibddAPI, DtpCardDataResponseHandler, default_api
+from parser_gibdd.api.parsing import ParsePool
+from parser_gibdd.api.planner import CrawlUnit, RequestPlanner, PageSizer, default_planner
+from parser_gibdd.exceptions import CrashesNotFoundError, ResourceRequestFailed, ResourceUnreachable
+from parser_gibdd.journal import CrawlJournal
+from parser_gibdd.metrics import default_metrics, labelled, record_response
 from parser_gibdd.models.gibdd.crash import CrashDataResponse
 from parser_gibdd.models.gibdd.requests import GibddDTPCardData, GibddDateString, DtpCardDataOrder
-from parser_gibdd.models.region import FederalRegion, Country
+from parser_gibdd.models.region import FederalRegion, Country, Region
 from parser_gibdd.models.region import RegionName, FederalRegionName
 
 logger = logging.getLogger(__name__)
@@ -18,7 +24,8 @@ def subregion_timeframe_crashes_amount(region: Union[str, int],
                                        subregion: Union[str, int],
                                        year: int,
                                        months: Tuple[int, int] = (1, 12),
-                                       cards: Tuple[int, int] = (0, 50)) -> CrashDataResponse:
+                                       cards: Tuple[int, int] = (0, 50),
+                                       api: Optional[GibddAPI] = None) -> CrashDataResponse:
     """Returns the required amount of crash data
 
     Parameters
@@ -33,6 +40,8 @@ def subregion_timeframe_crashes_amount(region: Union[str, int],
         range of months to request data from
     cards : Tuple[int, int]
         range of cards to retrieve
+    api : GibddAPI, optional
+        client to send the request with, the process-wide default client is used if not passed
     """
     first, last = months
     request_data = GibddDTPCardData(
@@ -44,35 +53,34 @@ def subregion_timeframe_crashes_amount(region: Union[str, int],
         st=str(cards[0]),
         en=str(cards[1])
     )
-    with GibddAPI("http://stat.gibdd.ru/") as api:
-        request = api.request_dtp_card_data(request_data)
-        response = api.send_request(request)
-        parsed_response = DtpCardDataResponseHandler(response).parse()
-    return parsed_response
+    return dtp_card_data(request_data, api=api)
 
 
 def subregion_timeframe_crashes_all(
         region: Union[str, int],
         subregion: Union[str, int],
         year: int,
-        months: Tuple[int, int] = (1, 12), ) -> List[CrashDataResponse]:
+        months: Tuple[int, int] = (1, 12),
+        api: Optional[GibddAPI] = None) -> List[CrashDataResponse]:
     """ALL crash data in a given timeframe for a subregion"""
     all_crashes = []
     crashes_collected = False
+    left_interval, right_interval = (0, 50)
     while not crashes_collected:
         try:
-            left_interval, right_interval = (0, 50)
             crash = subregion_timeframe_crashes_amount(
                 region=region,
                 subregion=subregion,
                 year=year,
                 months=months,
-                cards=(left_interval, right_interval)
+                cards=(left_interval, right_interval),
+                api=api
             )
             all_crashes.append(crash)
         except CrashesNotFoundError:
             crashes_collected = True
         else:
+            crashes_collected = right_interval >= crash.cards_amount
             left_interval += 50
             right_interval += 50
     logger.info(f"Data for subregion {subregion} in region {region} collected")
@@ -84,6 +92,7 @@ def subregion_timeframe_crashes_all_noloop(
         subregion: Union[str, int],
         year: int,
         months: Tuple[int, int] = (1, 12),
+        api: Optional[GibddAPI] = None,
 ) -> List[CrashDataResponse]:
     """ALL crash data in a given timeframe for a subregion, except with two large requests
 
@@ -97,14 +106,16 @@ def subregion_timeframe_crashes_all_noloop(
             subregion=subregion,
             year=year,
             months=months,
-            cards=(0, 1)
+            cards=(0, 1),
+            api=api
         )
         all_crashes = subregion_timeframe_crashes_amount(
             region=region,
             subregion=subregion,
             year=year,
             months=months,
-            cards=(0, initial_request.cards_amount)
+            cards=(0, initial_request.cards_amount),
+            api=api
         )
         crashes.append(all_crashes)
     except CrashesNotFoundError:
@@ -113,40 +124,185 @@ def subregion_timeframe_crashes_all_noloop(
     return crashes
 
 
+def dtp_card_data(request_data: GibddDTPCardData,
+                  api: Optional[GibddAPI] = None,
+                  retries: int = 0,
+                  sizer: Optional[PageSizer] = None) -> CrashDataResponse:
+    """Send a single getDTPCardData request and parse the response
+
+    Parameters
+    ----------
+    request_data : GibddDTPCardData
+        the request to send
+    api : GibddAPI, optional
+        client to send the request with, the process-wide default client is used if not passed
+    retries : int
+        how many times the request alone is retried if the resource is unreachable
+    sizer : PageSizer, optional
+        receives the latency and the body size of the responses downloaded from the network
+    """
+    return dtp_card_data_future(request_data, api=api, retries=retries, sizer=sizer).result()
+
+
+def dtp_card_data_future(request_data: GibddDTPCardData,
+                         api: Optional[GibddAPI] = None,
+                         retries: int = 0,
+                         sizer: Optional[PageSizer] = None) -> "concurrent.futures.Future[CrashDataResponse]":
+    """Send a single getDTPCardData request, the response is parsed by the parse pool of the api
+
+    Returns as soon as the response is downloaded, the future is resolved once the response is parsed.
+    Without a parse pool the response is parsed in this thread and the future is already resolved.
+    Takes the same parameters as :func:`dtp_card_data`.
+    """
+    api = api or default_api()
+    with labelled(okato=request_data.reg):
+        attempt = 0
+        while True:
+            try:
+                response = api.send_request(api.request_dtp_card_data(request_data))
+                break
+            except ResourceUnreachable as e:
+                attempt += 1
+                if attempt > retries:
+                    raise
+                logger.warning(f"Page {request_data.st}-{request_data.en} failed, retrying ({attempt}/{retries}): {e}")
+                time.sleep(min(2 ** attempt, 30))
+        elapsed = getattr(response, "round_trip", 0.0)
+        from_cache = getattr(response, "from_cache", False)
+        record_response(len(response.content), elapsed, from_cache)
+        handler = DtpCardDataResponseHandler(response, raw=api.raw, compact=getattr(api, "compact", False))
+        if parses_in_pool(api):
+            crashes = handler.submit(api.parse_pool)
+        else:
+            crashes = concurrent.futures.Future()
+            try:
+                crashes.set_result(handler.parse())
+            except CrashesNotFoundError as e:
+                crashes.set_exception(e)
+
+    def parsed(future: concurrent.futures.Future) -> None:
+        error = future.exception()
+        if error is not None:
+            # the body is cached before it is parsed, a body that can not be parsed is not served again
+            if isinstance(error, CrashesNotFoundError) and api.cache is not None:
+                api.cache.discard(request_data.to_request_form())
+            return
+        cards = len(future.result().crashes)
+        default_metrics().count("cards", cards, okato=request_data.reg)
+        if sizer is not None and not from_cache:
+            sizer.observe(cards, elapsed, len(response.content))
+
+    crashes.add_done_callback(parsed)
+    return crashes
+
+
+def parses_in_pool(api: GibddAPI) -> bool:
+    """Whether the getDTPCardData responses of the api are validated by its parse pool"""
+    return isinstance(getattr(api, "parse_pool", None), ParsePool) and not api.raw
+
+
+def crawl_workers(api: GibddAPI, max_workers: Optional[int] = None) -> int:
+    """Amount of subregions crawled at the same time, by default as many as the throttle of the api may send"""
+    if max_workers is not None:
+        return max_workers
+    return api.throttle.controller.maximum if api.throttle else 5
+
+
+def unit_crashes(unit: CrawlUnit,
+                 api: Optional[GibddAPI] = None,
+                 planner: Optional[RequestPlanner] = None) -> List[CrashDataResponse]:
+    """All crashes of a crawl unit, requested with as few pages as the planner allows
+
+    The first page tells the amount of cards, the rest of the pages are fetched concurrently
+    and handed over to the parse pool of the api, if it has one, as soon as they are downloaded
+    """
+    planner = planner or default_planner()
+    api = api or default_api()
+    pooled = parses_in_pool(api)
+    fetch = partial(dtp_card_data_future if pooled else dtp_card_data, api=api, retries=planner.page_retries,
+                    sizer=planner.sizer)
+    count = planner.known_count(unit)
+    if count == 0:
+        return []
+    crashes: List[CrashDataResponse] = []
+    start = 0
+    if count is None:
+        first_request = planner.first_page(unit)
+        try:
+            first_page = fetch(first_request).result() if pooled else fetch(first_request)
+        except CrashesNotFoundError:
+            # only the first page tells that there are no crashes in the unit
+            planner.record(unit, 0)
+            return []
+        count = first_page.cards_amount
+        planner.record(unit, count)
+        crashes.append(first_page)
+        start = int(first_request.en)
+    pages = planner.pages(unit, count, start=start)
+    try:
+        # the pages keep downloading while the first ones are waiting for the parse pool of the api
+        if len(pages) > 1 and planner.page_workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=planner.page_workers) as executor:
+                crashes.extend(page.result() if pooled else page for page in executor.map(fetch, pages))
+        else:
+            fetched = list(map(fetch, pages)) if pooled else map(fetch, pages)
+            crashes.extend(page.result() if pooled else page for page in fetched)
+    except CrashesNotFoundError as e:
+        raise incomplete_unit(unit, crashes, count) from e
+    return crashes
+
+
+def incomplete_unit(unit: CrawlUnit, crashes: List[CrashDataResponse], count: int) -> ResourceRequestFailed:
+    """Error of a unit with a page that has no crashes although the unit has ``count`` cards
+
+    The unit is not finished, so it is neither journaled nor recorded by the sync and is requested again
+    """
+    collected = sum(len(crash.crashes) for crash in crashes)
+    return ResourceRequestFailed(f"A page of {unit} has no crashes, only {collected} of {count} cards were received")
+
+
+def subregion_unit_crashes(unit: CrawlUnit,
+                           api: Optional[GibddAPI] = None,
+                           journal: Optional[CrawlJournal] = None,
+                           planner: Optional[RequestPlanner] = None) -> List[CrashDataResponse]:
+    """Crashes of a single crawl unit, units finished by a previous crawl are taken from the journal"""
+    planner = planner or default_planner()
+    if journal is not None:
+        finished = journal.get(unit)
+        if finished is not None:
+            logger.info(f"{unit} is already finished, skipping")
+            planner.finished(unit, finished)
+            return finished
+    crashes = unit_crashes(unit, api=api, planner=planner)
+    if journal is not None:
+        journal.record(unit, crashes)
+    planner.finished(unit, crashes)
+    return crashes
+
+
 def subregion_crashes(region: Union[str, int],
                       subregion: Union[str, int],
                       period_start: date,
-                      period_end: date) -> List[CrashDataResponse]:
+                      period_end: date,
+                      api: Optional[GibddAPI] = None,
+                      journal: Optional[CrawlJournal] = None,
+                      planner: Optional[RequestPlanner] = None) -> List[CrashDataResponse]:
     """Get all crashes between two given dates"""
-    st_year, st_month = period_start.year, period_start.month
-    end_year, end_month = period_end.year, period_end.month
-
+    planner = planner or default_planner()
     logger.info(f"retrieving crashes for:\nregion: {region},\nsubregion: {subregion}")
-    if st_year == end_year:
-        return subregion_timeframe_crashes_all_noloop(
-            region, subregion, year=st_year, months=(st_month, end_month)
-        )
-
-    crashes_first_year = subregion_timeframe_crashes_all_noloop(
-        region, subregion, year=st_year, months=(st_month, 12 - st_month)
-    )
-    crashes_last_year = subregion_timeframe_crashes_all_noloop(
-        region, subregion, year=end_year, months=(1, end_month)
-    )
-    crashes_inbetween = []
-    while st_year + 1 != end_year:
-        st_year += 1
-        crashes_inbetween.extend(subregion_timeframe_crashes_all_noloop(
-            region, subregion, year=st_year, months=(1, 12)
-        ))
-    return [*crashes_first_year,
-            *crashes_last_year,
-            *crashes_inbetween]
+    crashes = []
+    for unit in planner.units(region, subregion, period_start, period_end):
+        crashes.extend(subregion_unit_crashes(unit, api=api, journal=journal, planner=planner))
+    logger.info(f"Data for subregion {subregion} in region {region} collected")
+    return crashes
 
 
 def region_crashes_all(region: FederalRegion,
                        period_start: date,
-                       period_end: date) -> Dict[RegionName, List[CrashDataResponse]]:
+                       period_end: date,
+                       api: Optional[GibddAPI] = None,
+                       journal: Optional[CrawlJournal] = None,
+                       planner: Optional[RequestPlanner] = None) -> Dict[RegionName, List[CrashDataResponse]]:
     """Get all crashes in a given federal region"""
     crashes: Dict[RegionName, List[CrashDataResponse]] = {}
     if not region.okato:
@@ -162,21 +318,34 @@ def region_crashes_all(region: FederalRegion,
             region=region.okato,
             subregion=subregion.okato,
             period_start=period_start,
-            period_end=period_end
+            period_end=period_end,
+            api=api,
+            journal=journal,
+            planner=planner
         )
     return crashes
 
 
 def region_crashes_all_threading(region: FederalRegion,
                                  period_start: date,
-                                 period_end: date) -> Dict[RegionName, List[CrashDataResponse]]:
+                                 period_end: date,
+                                 api: Optional[GibddAPI] = None,
+                                 journal: Optional[CrawlJournal] = None,
+                                 planner: Optional[RequestPlanner] = None,
+                                 max_workers: Optional[int] = None) -> Dict[RegionName, List[CrashDataResponse]]:
+    """Get all crashes in a given federal region, ``max_workers`` subregions are requested at the same time
+
+    The requests themselves are paced by the throttle of the api, ``max_workers`` defaults to its maximum
+    """
     if not region.okato:
         raise Exception(
             f"No okato code for federal region: {region.name}, update the cache for federal regions"
         )
+    api = api or default_api()
     concrete_subregion_crashes = partial(subregion_crashes, region=region.okato, period_start=period_start,
-                                         period_end=period_end)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+                                         period_end=period_end, api=api, journal=journal,
+                                         planner=planner)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=crawl_workers(api, max_workers)) as executor:
         result = executor.map(
             lambda x: (x.name, concrete_subregion_crashes(subregion=x.okato)), region.districts
         )
@@ -185,7 +354,10 @@ def region_crashes_all_threading(region: FederalRegion,
 
 def country_crashes_all(country: Country,
                         period_start: date,
-                        period_end: date) -> List[Dict[RegionName, List[CrashDataResponse]]]:
+                        period_end: date,
+                        api: Optional[GibddAPI] = None,
+                        journal: Optional[CrawlJournal] = None,
+                        planner: Optional[RequestPlanner] = None) -> List[Dict[RegionName, List[CrashDataResponse]]]:
     """
     Get all crashes in Russia
 
@@ -196,7 +368,10 @@ def country_crashes_all(country: Country,
         crashes.append(region_crashes_all(
             region=fed,
             period_start=period_start,
-            period_end=period_end
+            period_end=period_end,
+            api=api,
+            journal=journal,
+            planner=planner
         ))
     return crashes
 
@@ -206,13 +381,19 @@ country_return_type = Dict[FederalRegionName, Dict[RegionName, List[CrashDataRes
 
 def country_crashes_all_threading(country: Country,
                                   period_start: date,
-                                  period_end: date
+                                  period_end: date,
+                                  api: Optional[GibddAPI] = None,
+                                  journal: Optional[CrawlJournal] = None,
+                                  planner: Optional[RequestPlanner] = None,
                                   ) -> country_return_type:
     return {
         fed.name: region_crashes_all_threading(
             region=fed,
             period_start=period_start,
-            period_end=period_end
+            period_end=period_end,
+            api=api,
+            journal=journal,
+            planner=planner
         )
         for fed in country.regions
     }
@@ -223,3 +404,47 @@ def country_crashes_all_threading(country: Country,
     #                                                         period_end=period_end)), country.regions
     #     )
     # return {name: data for name, data in result}
+
+
+country_stream_type = Iterator[Tuple[FederalRegionName, RegionName, List[CrashDataResponse]]]
+
+
+def iter_country_crashes(country: Country,
+                         period_start: date,
+                         period_end: date,
+                         api: Optional[GibddAPI] = None,
+                         journal: Optional[CrawlJournal] = None,
+                         planner: Optional[RequestPlanner] = None,
+                         max_workers: Optional[int] = None) -> country_stream_type:
+    """Lazily crawl all crashes in Russia, one subregion at a time
+
+    Yields (federal region name, subregion name, crashes) in the order of the country.
+    At most ``2 * max_workers`` subregions are requested or waiting to be consumed at the same time,
+    so the memory stays bounded no matter how large the whole country is.
+    ``max_workers`` defaults to the maximum concurrency of the throttle of the api or 5 without one.
+    """
+    api = api or default_api()
+    max_workers = crawl_workers(api, max_workers)
+    for fed in country.regions:
+        if not fed.okato:
+            raise Exception(
+                f"No okato code for federal region: {fed.name}, update the cache for federal regions"
+            )
+    subregions = ((fed, subregion) for fed in country.regions for subregion in fed.districts)
+    in_flight: Deque[Tuple[FederalRegion, Region, concurrent.futures.Future]] = deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for fed, subregion in subregions:
+                in_flight.append((fed, subregion, executor.submit(
+                    subregion_crashes, region=fed.okato, subregion=subregion.okato, period_start=period_start,
+                    period_end=period_end, api=api, journal=journal, planner=planner
+                )))
+                if len(in_flight) >= 2 * max_workers:
+                    done_fed, done_subregion, future = in_flight.popleft()
+                    yield FederalRegionName(done_fed.name), RegionName(done_subregion.name), future.result()
+            while in_flight:
+                done_fed, done_subregion, future = in_flight.popleft()
+                yield FederalRegionName(done_fed.name), RegionName(done_subregion.name), future.result()
+        finally:
+            for _, _, future in in_flight:
+                future.cancel()
@@ -1,20 +1,38 @@
 import abc
+import concurrent.futures
 import json
+import threading
+import time
 from json.decoder import JSONDecodeError
 from logging import getLogger
 from pprint import pformat
+from typing import Dict, Optional, TYPE_CHECKING
 
 from requests import Request, Session, Response
 from requests.adapters import HTTPAdapter
-from requests.exceptions import ChunkedEncodingError
+from requests.exceptions import ChunkedEncodingError, ConnectionError as RequestsConnectionError, Timeout
+from urllib3.util.retry import Retry
 
+from parser_gibdd.api.singleflight import SingleFlight, SharedResult, Flight, MISS
+from parser_gibdd.api.throttle import Throttle, OVERLOAD_STATUSES
+from parser_gibdd.cache import ResponseCache
+from parser_gibdd.jsonlib import loads
+from parser_gibdd.metrics import default_metrics
 from parser_gibdd.exceptions import ResourceUnreachable, ResourceRequestFailed, CrashesNotFoundError
 from parser_gibdd.models.gibdd.crash import CrashDataResponse
 from parser_gibdd.models.gibdd.okato import RegionDataResponse, RegionMapData
 from parser_gibdd.models.gibdd.requests import GibddMainMapData, GibddDTPCardData
+from parser_gibdd.models.gibdd.records import CrashDataResponseRecord
+from parser_gibdd.models.gibdd.views import CrashDataResponseView
+from parser_gibdd.replay import ReplayStore
+
+if TYPE_CHECKING:
+    from parser_gibdd.api.parsing import ParsePool
 
 logger = getLogger(__name__)
 
+GIBDD_HOST = "http://stat.gibdd.ru"
+
 
 class RequestHandler(abc.ABC):
     def __init__(self, response: Response):
@@ -28,46 +46,252 @@ class RequestHandler(abc.ABC):
 class MapDataResponseHandler(RequestHandler):
 
     def parse(self) -> RegionDataResponse:
-        data = self.raw_response.json()
+        data = loads(self.raw_response.content)
         return RegionDataResponse(
             metabase=[
                 RegionMapData(
-                    maps=json.loads(each["maps"]),
+                    maps=loads(each["maps"]),
                     separator=each["separator"]
                 )
-                for each in json.loads(data["metabase"])
+                for each in loads(data["metabase"])
             ],
-            data=json.loads(data["data"]),
+            data=loads(data["data"]),
             regionname=data["regionname"]
         )
 
 
+def parse_dtp_card_data(content: bytes, raw: bool = False, compact: bool = False) -> CrashDataResponse:
+    """Parse the body of a getDTPCardData response
+
+    The crash data is a json string nested inside of the "data" key of the response,
+    each layer is decoded exactly once with the fastest available json backend
+
+    Parameters
+    ----------
+    content : bytes
+        body of the response
+    raw : bool
+        return a CrashDataResponseView over the decoded json instead of validating it into a CrashDataResponse
+    compact : bool
+        return compact records instead of the models or the views, see :mod:`parser_gibdd.models.gibdd.records`,
+        the records are built from the validated models unless ``raw``
+    """
+    metrics = default_metrics()
+    try:
+        with metrics.timer("decode"):
+            data = loads(loads(content)["data"])
+        with metrics.timer("validate"):
+            if not raw:
+                response = CrashDataResponse.parse_obj(data)
+                if compact:
+                    return CrashDataResponseRecord.from_model(response)  # type: ignore
+                return response
+            if not isinstance(data, dict) or not isinstance(data.get("tab"), list) or "countCard" not in data:
+                raise CrashesNotFoundError()
+            if compact:
+                return CrashDataResponseRecord.from_raw(data)  # type: ignore
+            return CrashDataResponseView(data)  # type: ignore
+    except (JSONDecodeError, ValueError, KeyError, TypeError, AttributeError):
+        raise CrashesNotFoundError()
+
+
 class DtpCardDataResponseHandler(RequestHandler):
+    """Parses a getDTPCardData response, responses shared by deduplicated requests are parsed only once"""
+
+    def __init__(self, response: Response, raw: bool = False, compact: bool = False):
+        super().__init__(response)
+        self.raw = raw
+        self.compact = compact
 
     def parse(self) -> CrashDataResponse:
-        try:
-            data = self.raw_response.json()
-            return CrashDataResponse.parse_raw(self.raw_response.json()["data"])
-        except (JSONDecodeError, ValueError):
-            raise CrashesNotFoundError()
+        shared = getattr(self.raw_response, "shared", None)
+        if not isinstance(shared, SharedResult):
+            return parse_dtp_card_data(self.raw_response.content, raw=self.raw, compact=self.compact)
+        return shared.get(("dtp_card_data", self.raw, self.compact),
+                          lambda: parse_dtp_card_data(self.raw_response.content, raw=self.raw, compact=self.compact))
+
+    def submit(self, pool: "ParsePool") -> "concurrent.futures.Future[CrashDataResponse]":
+        """Parse in the worker processes of the pool, deduplicated responses are submitted only once"""
+        shared = getattr(self.raw_response, "shared", None)
+        if not isinstance(shared, SharedResult):
+            return pool.submit(self.raw_response.content, compact=self.compact)
+        return shared.get(("dtp_card_data", "pool", self.compact),
+                          lambda: pool.submit(self.raw_response.content, compact=self.compact))
+
+
+class PoolStats:
+    """Thread safe counters of the connection pool usage
+
+    Every request either reuses an idle keep-alive connection (hit) or has to open a new one (miss)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.misses = 0
+
+    def request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def miss(self) -> None:
+        with self._lock:
+            self.misses += 1
+
+    @property
+    def hits(self) -> int:
+        return max(self.requests - self.misses, 0)
+
+    def dict(self) -> Dict[str, int]:
+        return {"requests": self.requests, "hits": self.hits, "misses": self.misses}
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that records connection pool hits and misses into ``stats``"""
+
+    def __init__(self, stats: PoolStats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self._counting_pool(pool_cls)
+            for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def _counting_pool(self, pool_cls):
+        """Connection pool class whose connections count every new TCP connection as a miss"""
+        stats = self.stats
+
+        class CountingConnection(pool_cls.ConnectionCls):
+            def connect(self):
+                stats.miss()
+                super().connect()
+
+        return type(f"Counting{pool_cls.__name__}", (pool_cls,), {"ConnectionCls": CountingConnection})
+
+    def send(self, request, *args, **kwargs):
+        self.stats.request()
+        return super().send(request, *args, **kwargs)
 
 
 class GibddAPI:
-    def __init__(self, host: str):
+    """Client of the gibdd website
+
+    A single instance is meant to be long-lived and shared between threads,
+    connections to the host are kept alive and reused from the pool.
+
+    Parameters
+    ----------
+    host : str
+        address of the gibdd website
+    pool_size : int
+        maximum amount of connections kept open to the host, threads wait for a free connection
+        instead of opening new ones when the pool is exhausted
+    keep_alive : bool
+        keep connections open between requests
+    retries : int
+        amount of retries for the failed connections and the 429 and 5xx responses
+    backoff : float
+        backoff factor of the retries, the n-th retry waits ``backoff * 2 ** (n - 1)`` seconds
+        or as long as the Retry-After header of the response says
+    timeout : float, optional
+        seconds to wait for the connection and for every read from it, a timeout counts as a failed connection
+    throttle : Throttle, optional
+        paces the requests and adapts the amount of requests in flight to the latency and errors of the server,
+        see :mod:`parser_gibdd.api.throttle`
+    single_flight : SingleFlight, optional
+        deduplication of the requests, identical requests sent at the same time share a single call
+        and the responses are kept in memory for the requests repeated later in the run
+    cache : ResponseCache, optional
+        on-disk cache of the getDTPCardData responses, cached responses are returned without network calls
+    replay : ReplayStore, optional
+        records the responses or replays the recorded ones instead of the network calls,
+        see :mod:`parser_gibdd.replay`
+    parse_pool : ParsePool, optional
+        validates the getDTPCardData responses in worker processes instead of the downloading threads,
+        see :mod:`parser_gibdd.api.parsing`, unused in the ``raw`` mode that doesn't validate anything
+    raw : bool
+        trusted mode of the bulk exports, getDTPCardData responses are parsed into unvalidated
+        views (see :mod:`parser_gibdd.models.gibdd.views`) instead of the models
+    compact : bool
+        keep the getDTPCardData responses as compact records (see :mod:`parser_gibdd.models.gibdd.records`)
+        instead of the models or the views, for the crawls holding a lot of cards in memory
+    """
+
+    def __init__(self,
+                 host: str = GIBDD_HOST,
+                 pool_size: int = 10,
+                 keep_alive: bool = True,
+                 retries: int = 5,
+                 backoff: float = 0.5,
+                 timeout: Optional[float] = 300.0,
+                 throttle: Optional[Throttle] = None,
+                 single_flight: Optional[SingleFlight[Response]] = None,
+                 cache: Optional[ResponseCache] = None,
+                 replay: Optional[ReplayStore] = None,
+                 parse_pool: Optional["ParsePool"] = None,
+                 raw: bool = False,
+                 compact: bool = False):
         self.host = host
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.throttle = throttle
+        self.single_flight = single_flight
+        self.cache = cache
+        self.replay = replay
+        self.parse_pool = parse_pool
+        self.raw = raw
+        self.compact = compact
+        self.pool_stats = PoolStats()
         self.session = self.__create_session()
 
     def __create_session(self) -> Session:
-        """Apply a custom adapter to handle retries"""
+        """Apply a custom adapter to handle retries and count the connection pool usage"""
         s = Session()
-        s.mount(self.host, HTTPAdapter(max_retries=5))
+        s.mount(self.host, PooledHTTPAdapter(
+            self.pool_stats,
+            max_retries=Retry(
+                total=self.retries,
+                backoff_factor=self.backoff,
+                status_forcelist=OVERLOAD_STATUSES,
+                allowed_methods=None,  # the POST requests of gibdd only read data
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            ),
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            pool_block=True,
+        ))
+        if not self.keep_alive:
+            s.headers["Connection"] = "close"
         return s
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        logger.exception(traceback)
+        if type is not None:
+            logger.exception(value)
+        self.close()
+
+    def close(self) -> None:
+        if self.pool_stats.requests:
+            logger.info(f"Closing session to {self.host}, connection pool usage: {self.pool_stats.dict()}")
+        if self.cache and (self.cache.hits or self.cache.misses):
+            logger.info(f"Response cache usage: {self.cache.stats()}")
+        if self.single_flight and (self.single_flight.misses or self.single_flight.hits):
+            logger.info(f"Request deduplication: {self.single_flight.stats()}")
+        if self.throttle and self.throttle.requests:
+            logger.info(f"Throttle state: {self.throttle.dict()}")
+        if isinstance(self.replay, ReplayStore):
+            logger.info(f"Recorded responses: {self.replay.stats()}")
+        if self.parse_pool is not None:
+            self.parse_pool.close()
         self.session.close()
 
     def request_main_map_data(self, request_data: GibddMainMapData) -> Request:
@@ -86,17 +310,110 @@ class GibddAPI:
             json=request_data.to_request_form(),
         )
 
+    def _is_cacheable(self, request: Request) -> bool:
+        return self.cache is not None and request.url.endswith('/map/getDTPCardData') and request.json is not None
+
     def send_request(self, request: Request) -> Response:
+        if self.single_flight is None or request.json is None:
+            return self._send_request(request)
+        return deduplicated_response(request, self.single_flight.do(request_key(request),
+                                                                    lambda: self._send_request(request)))
+
+    def _send_request(self, request: Request) -> Response:
+        if self.replay is not None and self.replay.replaying:
+            response = cached_response(request, self.replay.replay(request.url, request.json))
+            response.from_cache = False  # type: ignore
+            return response
+        if self._is_cacheable(request):
+            body = self.cache.get(request.json)
+            if body is not None:
+                if self.replay is not None:
+                    self.replay.record(request.url, request.json, body)
+                return cached_response(request, body)
+        sent = self.throttle.acquire() if self.throttle else 0.0
         try:
-            request = self.session.prepare_request(request)
-            response = self.session.send(request)
-        except (ConnectionError, TimeoutError, ChunkedEncodingError) as e:
+            prepared = self.session.prepare_request(request)
+            started = time.perf_counter()
+            response = self.session.send(prepared, timeout=self.timeout)
+        except (ConnectionError, TimeoutError, ChunkedEncodingError, RequestsConnectionError, Timeout) as e:
+            if self.throttle:
+                self.throttle.release(sent, None)
             raise ResourceUnreachable(f"Unable to reach the requested resource, exception:\n {e}")
+        except BaseException:
+            if self.throttle:
+                self.throttle.cancel(sent)
+            raise
+        # only the round trip, the waits for the throttle and the lookups of the caches are not included
+        response.round_trip = time.perf_counter() - started  # type: ignore
+        if self.throttle:
+            self.throttle.release(sent, response.status_code, retried=was_retried(response))
         if not response.ok:
             raise ResourceRequestFailed(
                 f"Request failed with status code {response.status_code}:\n"
                 f"Response: {pformat(response.content)}"
             )
         logger.info('Request successful')
+        if self._is_cacheable(request):
+            self.cache.set(request.json, response.content)
+        if self.replay is not None:
+            self.replay.record(request.url, request.json, response.content)
 
         return response
+
+
+def request_key(request: Request) -> str:
+    """Identity of a request for the deduplication"""
+    return f"{request.method} {request.url} {json.dumps(request.json, sort_keys=True, separators=(',', ':'))}"
+
+
+def deduplicated_response(request: Request, flight: Flight) -> Response:
+    """Copy of the response of a flight, the copies handed to the coalesced requests share the parsed body
+
+    Responses of the LRU hits and of the coalesced requests did not come from the network for the request
+    and are marked ``from_cache``
+    """
+    copy = cached_response(request, flight.result.content)
+    copy.headers = flight.result.headers
+    if flight.outcome == MISS:
+        copy.from_cache = getattr(flight.result, "from_cache", False)  # type: ignore
+        copy.round_trip = getattr(flight.result, "round_trip", 0.0)  # type: ignore
+    copy.shared = flight.shared  # type: ignore
+    return copy
+
+
+def was_retried(response: Response) -> bool:
+    """Whether urllib3 had to retry the request before getting the response"""
+    retries = getattr(response.raw, "retries", None)
+    return bool(retries and retries.history)
+
+
+def cached_response(request: Request, body: bytes) -> Response:
+    """Successful response with the body taken from the cache, marked with ``from_cache``"""
+    response = Response()
+    response.status_code = 200
+    response.url = request.url
+    response._content = body
+    response.from_cache = True  # type: ignore
+    response.round_trip = 0.0  # type: ignore
+    return response
+
+
+_default_api: Optional[GibddAPI] = None
+_default_api_lock = threading.Lock()
+
+
+def default_api() -> GibddAPI:
+    """Process-wide GibddAPI, created on the first use and shared by all the crawl functions"""
+    global _default_api
+    with _default_api_lock:
+        if _default_api is None:
+            _default_api = GibddAPI(GIBDD_HOST)
+        return _default_api
+
+
+def set_default_api(api: Optional[GibddAPI]) -> Optional[GibddAPI]:
+    """Replace the process-wide GibddAPI, returns the previous one which is not closed"""
+    global _default_api
+    with _default_api_lock:
+        previous, _default_api = _default_api, api
+    return previous
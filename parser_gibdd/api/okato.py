@@ -1,6 +1,7 @@
 import logging
+from typing import Optional
 
-from parser_gibdd.api.gibdd_api import GibddAPI, MapDataResponseHandler
+from parser_gibdd.api.gibdd_api import GibddAPI, MapDataResponseHandler, default_api
 from parser_gibdd.models.gibdd.okato import RegionDataResponse
 from parser_gibdd.models.gibdd.requests import GibddMainMapData, GibddDateString, GibddDateListString
 from parser_gibdd.utils import latest_yearmonth
@@ -8,7 +9,7 @@ from parser_gibdd.utils import latest_yearmonth
 logger = logging.getLogger(__name__)
 
 
-def request_all_federal_okato() -> RegionDataResponse:
+def request_all_federal_okato(api: Optional[GibddAPI] = None) -> RegionDataResponse:
     """Get okato codes for all federal regions
 
     Only one request, efficient
@@ -19,20 +20,21 @@ def request_all_federal_okato() -> RegionDataResponse:
         date=GibddDateListString.from_date_string(GibddDateString.from_year_month(*latest_yearmonth())),
         pok='1'
     )
-    with GibddAPI("http://stat.gibdd.ru/") as api:
-        request = api.request_main_map_data(request_data)
-        response = api.send_request(request)
-        parsed_response = MapDataResponseHandler(response).parse()
-    return parsed_response
+    api = api or default_api()
+    request = api.request_main_map_data(request_data)
+    response = api.send_request(request)
+    return MapDataResponseHandler(response).parse()
 
 
-def request_inner_okato(region_code: str) -> RegionDataResponse:
+def request_inner_okato(region_code: str, api: Optional[GibddAPI] = None) -> RegionDataResponse:
     """Get okato codes for the municipalities in the federal region
 
     Parameters
     ----------
     region_code : str
         OKATO of the region to query
+    api : GibddAPI, optional
+        client to send the request with, the process-wide default client is used if not passed
     """
     request_data = GibddMainMapData(
         maptype=1,
@@ -40,8 +42,7 @@ def request_inner_okato(region_code: str) -> RegionDataResponse:
         date=GibddDateListString.from_date_string(GibddDateString.from_year_month(*latest_yearmonth())),
         pok='1'
     )
-    with GibddAPI("http://stat.gibdd.ru/") as api:
-        request = api.request_main_map_data(request_data)
-        response = api.send_request(request)
-        parsed_response = MapDataResponseHandler(response).parse()
-    return parsed_response
+    api = api or default_api()
+    request = api.request_main_map_data(request_data)
+    response = api.send_request(request)
+    return MapDataResponseHandler(response).parse()
@@ -0,0 +1,131 @@
+"""Validation of the getDTPCardData responses in worker processes
+
+Validating a big response with pydantic holds the GIL for a long time, so the threads downloading
+the other pages stall while a page is validated. With a :class:`ParsePool` plugged into GibddAPI
+the download threads only hand the bodies over to the worker processes and move on to the next request.
+
+Only the validation moves to the workers. A worker decodes and validates a body into the models
+and dumps them back into json, the parent process still decodes that json into a
+:class:`parser_gibdd.models.gibdd.views.CrashDataResponseView` or a compact record and builds
+the tables from them under the GIL, which is many times cheaper than the validation and than
+unpickling the models, but isn't free. Dumping turns some values back into strings, e.g. the time
+of a crash, the views and the records coerce them to the field types again, so their tables are
+the same as the tables of the models.
+The pool is used by both crawl engines, the async one submits the bodies from the threads of its loop.
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from typing import Dict, Optional, Tuple
+
+from parser_gibdd.exceptions import CrashesNotFoundError
+from parser_gibdd.jsonlib import loads
+from parser_gibdd.metrics import Metrics, current_labels, default_metrics, labelled, set_default_metrics
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+from parser_gibdd.models.gibdd.records import CrashDataResponseRecord
+from parser_gibdd.models.gibdd.views import CrashDataResponseView
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_in_worker(content: bytes, labels: Dict[str, str]) -> Tuple[Optional[bytes], Metrics]:
+    """Validated json of a response body, None if there are no crashes in it, and the metrics of the worker"""
+    from parser_gibdd.api.gibdd_api import parse_dtp_card_data
+
+    metrics = Metrics()
+    previous = set_default_metrics(metrics)
+    try:
+        with labelled(**labels):
+            try:
+                response = parse_dtp_card_data(content)
+            except CrashesNotFoundError:
+                return None, metrics
+            with metrics.timer("serialize"):
+                return response.json(by_alias=True).encode(), metrics
+    finally:
+        set_default_metrics(previous)
+
+
+class ParsePool:
+    """Process pool validating the getDTPCardData bodies, plugged into GibddAPI with ``parse_pool=``
+
+    The workers only validate, decoding their output and building the tables stays in the parent process.
+
+    At most ``max_pending`` bodies are waiting for a worker or being validated, :meth:`submit`
+    blocks the download thread when there are more, so the downloaded bodies don't pile up in memory
+    when the network is faster than the workers.
+
+    Parameters
+    ----------
+    workers : int
+        amount of worker processes, all cores by default
+    max_pending : int
+        maximum amount of bodies submitted and not parsed yet, twice the amount of workers by default
+    """
+
+    def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.workers
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+    def _pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # the pool is started by the running download threads, forking them could copy a held lock
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def submit(self, content: bytes, compact: bool = False) -> "concurrent.futures.Future[CrashDataResponse]":
+        """Validate a response body in a worker, the future fails with CrashesNotFoundError if it has no crashes
+
+        The validated json is returned as a view or, with ``compact``, as a compact record
+        """
+        metrics = default_metrics()
+        self._slots.acquire()
+        parsed: concurrent.futures.Future = concurrent.futures.Future()
+        try:
+            validating = self._pool().submit(_parse_in_worker, content, current_labels())
+        except BaseException:
+            self._slots.release()
+            raise
+
+        def done(future: concurrent.futures.Future) -> None:
+            self._slots.release()
+            try:
+                validated, worker_metrics = future.result()
+                metrics.merge(worker_metrics)
+                if validated is None:
+                    raise CrashesNotFoundError()
+                data = loads(validated)
+                parsed.set_result(CrashDataResponseRecord.from_raw(data) if compact else CrashDataResponseView(data))
+            except BaseException as e:
+                parsed.set_exception(e)
+
+        validating.add_done_callback(done)
+        return parsed
+
+    def parse(self, content: bytes, compact: bool = False) -> CrashDataResponse:
+        return self.submit(content, compact).result()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                if sys.version_info >= (3, 9):
+                    self._executor.shutdown(cancel_futures=True)
+                else:  # pragma: no cover
+                    # the bodies waiting for a worker are still validated before the workers exit
+                    self._executor.shutdown()
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
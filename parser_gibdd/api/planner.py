@@ -0,0 +1,235 @@
+import threading
+from datetime import date
+from typing import Dict, List, NamedTuple, Optional, Tuple, TYPE_CHECKING
+
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+from parser_gibdd.models.gibdd.requests import GibddDTPCardData, GibddDateString, DtpCardDataOrder
+
+if TYPE_CHECKING:  # pragma: no cover
+    from parser_gibdd.sync import SyncState
+
+MonthKey = Tuple[int, int]
+
+
+def months_between(period_start: date, period_end: date) -> List[MonthKey]:
+    """All (year, month) pairs between two dates, both ends included"""
+    first = period_start.year * 12 + period_start.month - 1
+    last = period_end.year * 12 + period_end.month - 1
+    return [(index // 12, index % 12 + 1) for index in range(first, last + 1)]
+
+
+class CrawlUnit(NamedTuple):
+    """The smallest piece of a crawl, all crashes of a subregion in a continuous range of months"""
+    region: str
+    subregion: str
+    first: MonthKey
+    last: MonthKey
+
+    @property
+    def months(self) -> List[MonthKey]:
+        return months_between(date(*self.first, 1), date(*self.last, 1))
+
+
+class PageSizer:
+    """Picks the size of the next page from the latency and the body size of the previous pages
+
+    Seconds and bytes per card are tracked as exponential moving averages, the page size is
+    the amount of cards that fits into both ``target_seconds`` and ``target_bytes``.
+
+    Parameters
+    ----------
+    initial : int
+        page size until the first page is observed
+    minimum : int
+        smallest page size, page sizes are also rounded down to a multiple of it
+    maximum : int
+        biggest page size
+    target_seconds : float
+        desired time to download a single page
+    target_bytes : int
+        desired size of the body of a single page
+    smoothing : float
+        weight of the latest observation in the moving averages
+    """
+
+    def __init__(self,
+                 initial: int = 500,
+                 minimum: int = 50,
+                 maximum: int = 5000,
+                 target_seconds: float = 15.0,
+                 target_bytes: int = 16 * 1024 ** 2,
+                 smoothing: float = 0.3):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self.smoothing = smoothing
+        self.seconds_per_card: Optional[float] = None
+        self.bytes_per_card: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _average(self, current: Optional[float], value: float) -> float:
+        return value if current is None else current + self.smoothing * (value - current)
+
+    def observe(self, cards: int, seconds: float, size: int) -> None:
+        """Record a page downloaded from the network"""
+        if cards <= 0:
+            return
+        with self._lock:
+            self.seconds_per_card = self._average(self.seconds_per_card, seconds / cards)
+            self.bytes_per_card = self._average(self.bytes_per_card, size / cards)
+
+    def page_size(self) -> int:
+        with self._lock:
+            if self.seconds_per_card is None or self.bytes_per_card is None:
+                size = float(self.initial)
+            else:
+                size = min(self.target_seconds / max(self.seconds_per_card, 1e-9),
+                           self.target_bytes / max(self.bytes_per_card, 1e-9))
+        size = int(size) // self.minimum * self.minimum
+        return max(self.minimum, min(self.maximum, size))
+
+
+class RequestPlanner:
+    """Turns a subregion and a period into the fewest getDTPCardData requests
+
+    All months of a unit go into the ``date`` list of a single request. The first page of a unit
+    doubles as the count probe, since every response carries the total amount of cards,
+    so a unit with less than ``card_limit`` cards costs exactly one request.
+    Bigger units are split into pages of ``card_limit`` cards. Counts of the previous responses
+    are remembered, units with a known count are planned without a probe and empty units are skipped.
+
+    With a ``sizer`` the pages are adaptive: their size follows the observed latency and body size
+    and never goes over ``card_limit``. Pages after the first one are fetched concurrently and
+    a failed page is retried on its own instead of the whole unit.
+
+    Parameters
+    ----------
+    card_limit : int
+        maximum amount of cards requested at once
+    max_months : int, optional
+        maximum amount of months in a single unit, all months of the period go into one unit if not set
+    sizer : PageSizer, optional
+        adaptive page size, pages of ``card_limit`` cards are used if not set
+    page_workers : int
+        amount of pages of a single unit fetched at the same time
+    page_retries : int
+        how many times a single page is retried if the resource is unreachable
+    sync : SyncState, optional
+        incremental sync, only the months that are new or may have been revised since the last sync are planned
+    """
+
+    def __init__(self,
+                 card_limit: int = 2000,
+                 max_months: Optional[int] = None,
+                 sizer: Optional[PageSizer] = None,
+                 page_workers: int = 4,
+                 page_retries: int = 3,
+                 sync: Optional["SyncState"] = None):
+        self.card_limit = card_limit
+        self.max_months = max_months
+        self.sizer = sizer
+        self.page_workers = page_workers
+        self.page_retries = page_retries
+        self.sync = sync
+        self._counts: Dict[Tuple[str, str, Tuple[MonthKey, ...]], int] = {}
+        self._lock = threading.Lock()
+
+    def units(self, region: str, subregion: str, period_start: date, period_end: date) -> List[CrawlUnit]:
+        months = months_between(period_start, period_end)
+        if self.sync is not None:
+            months = self.sync.pending_months(str(region), str(subregion), months)
+        # every unit is a continuous range of months
+        runs: List[List[MonthKey]] = []
+        for year, month in months:
+            if runs and runs[-1][-1][0] * 12 + runs[-1][-1][1] + 1 == year * 12 + month:
+                runs[-1].append((year, month))
+            else:
+                runs.append([(year, month)])
+        return [
+            CrawlUnit(str(region), str(subregion), chunk[0], chunk[-1])
+            for run in runs
+            for chunk in (run[ind:ind + (self.max_months or len(run))]
+                          for ind in range(0, len(run), self.max_months or len(run)))
+        ]
+
+    def finished(self, unit: CrawlUnit, crashes: List[CrashDataResponse]) -> None:
+        """Called with the crashes of every finished unit, records its months in the sync
+
+        The high-water mark advances once the subregion is written, see :meth:`SyncState.commit`
+        """
+        if self.sync is not None:
+            self.sync.record(unit, crashes)
+
+    def record(self, unit: CrawlUnit, count: int) -> None:
+        """Remember the amount of cards in the unit"""
+        with self._lock:
+            self._counts[(unit.region, unit.subregion, tuple(unit.months))] = count
+
+    def known_count(self, unit: CrawlUnit) -> Optional[int]:
+        """Amount of cards in the unit if it is known from the previous responses
+
+        Counts of the single months are summed up if the unit as a whole was never requested
+        """
+        months = unit.months
+        with self._lock:
+            count = self._counts.get((unit.region, unit.subregion, tuple(months)))
+            if count is not None:
+                return count
+            monthly = [self._counts.get((unit.region, unit.subregion, (month,))) for month in months]
+        if any(month_count is None for month_count in monthly):
+            return None
+        return sum(monthly)  # type: ignore
+
+    @staticmethod
+    def request(unit: CrawlUnit, cards: Tuple[int, int]) -> GibddDTPCardData:
+        return GibddDTPCardData(
+            date=[GibddDateString.from_year_month(year, month) for year, month in unit.months],
+            ParReg=unit.region,
+            order=DtpCardDataOrder(type=1, fieldName='dat'),
+            reg=unit.subregion,
+            ind='1',
+            st=str(cards[0]),
+            en=str(cards[1])
+        )
+
+    def page_size(self) -> int:
+        if self.sizer is None:
+            return self.card_limit
+        return min(self.card_limit, self.sizer.page_size())
+
+    def first_page(self, unit: CrawlUnit) -> GibddDTPCardData:
+        return self.request(unit, (0, self.page_size()))
+
+    def pages(self, unit: CrawlUnit, count: int, start: int = 0) -> List[GibddDTPCardData]:
+        """Pages of a unit with ``count`` cards beginning with the card ``start``
+
+        Without a sizer the first page is the same as first_page
+        """
+        size = self.page_size()
+        return [
+            self.request(unit, (page_start, page_start + size))
+            for page_start in range(start, count, size)
+        ]
+
+
+_default_planner: Optional[RequestPlanner] = None
+_default_planner_lock = threading.Lock()
+
+
+def default_planner() -> RequestPlanner:
+    """Process-wide RequestPlanner, shares the known card counts between all the crawl functions"""
+    global _default_planner
+    with _default_planner_lock:
+        if _default_planner is None:
+            _default_planner = RequestPlanner()
+        return _default_planner
+
+
+def set_default_planner(planner: Optional[RequestPlanner]) -> Optional[RequestPlanner]:
+    """Replace the process-wide RequestPlanner, returns the previous one"""
+    global _default_planner
+    with _default_planner_lock:
+        previous, _default_planner = _default_planner, planner
+    return previous
@@ -0,0 +1,135 @@
+"""Deduplication of identical requests within a run
+
+Concurrent identical requests share a single call (single-flight), the results of the finished calls are kept
+in a bounded in-memory LRU, so a request repeated later in the same run is not sent again either.
+"""
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Generic, Hashable, NamedTuple, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+MISS = "miss"
+HIT = "hit"
+COALESCED = "coalesced"
+
+
+class SharedResult:
+    """Values derived from a result that is shared between identical requests, e.g. its parsed body
+
+    Every value is computed once, by the first request that asks for it
+    """
+    __slots__ = ("_lock", "_values")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[Hashable, Any] = {}
+
+    def get(self, key: Hashable, compute: Callable[[], T]) -> T:
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = compute()
+            return self._values[key]
+
+
+class Flight(NamedTuple):
+    """Result of SingleFlight.do
+
+    ``shared`` is common to the request that made the call and the requests coalesced with it,
+    the results taken from the LRU get None, so the values derived from them are not kept in memory
+    """
+    result: Any
+    outcome: str
+    shared: Optional[SharedResult]
+
+
+def result_size(result: Any) -> int:
+    """Size of a result in bytes, the length of the body for the responses"""
+    content = getattr(result, "content", result)
+    return len(content) if isinstance(content, (bytes, bytearray, str)) else sys.getsizeof(content)
+
+
+class SingleFlight(Generic[T]):
+    """Single-flight calls with an LRU of the finished results
+
+    The LRU is bounded both by the amount of the results and by their total size.
+
+    Parameters
+    ----------
+    max_entries : int
+        maximum amount of the results kept in the LRU, nothing is kept if 0
+    max_bytes : int
+        maximum total size of the results kept in the LRU, nothing is kept if 0
+    size : callable
+        size of a single result in bytes, :func:`result_size` if not passed
+    """
+
+    def __init__(self,
+                 max_entries: int = 1024,
+                 max_bytes: int = 128 * 1024 ** 2,
+                 size: Optional[Callable[[T], int]] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = size or result_size
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self._current_size = 0
+        self._results: "OrderedDict[Hashable, Tuple[T, int]]" = OrderedDict()
+        self._in_flight: Dict[Hashable, Tuple[Future, SharedResult]] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, call: Callable[[], T]) -> Flight:
+        """Result of the call for the key and whether it was a miss, a hit of the LRU or coalesced
+
+        Only the first of the concurrent calls with the same key is made, the others wait for its result
+        or its exception. Exceptions are not remembered.
+        """
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return Flight(self._results[key][0], HIT, None)
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = (Future(), SharedResult())
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        future, shared = flight
+        if not leader:
+            return Flight(future.result(), COALESCED, shared)
+        try:
+            result = call()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            self._remember(key, result)
+        future.set_result(result)
+        return Flight(result, MISS, shared)
+
+    def _remember(self, key: Hashable, result: T) -> None:
+        size = self.size(result)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        self._results[key] = (result, size)
+        self._current_size += size
+        while self._current_size > self.max_bytes or len(self._results) > self.max_entries:
+            _, (_, evicted_size) = self._results.popitem(last=False)
+            self._current_size -= evicted_size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._results.clear()
+            self._current_size = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "coalesced": self.coalesced, "misses": self.misses,
+                "entries": len(self._results), "size": self._current_size}
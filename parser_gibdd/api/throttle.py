@@ -0,0 +1,218 @@
+"""Client-side pacing of the requests to stat.gibdd.ru
+
+The rate of requests is limited by a token bucket. The amount of requests in flight is adapted to the server
+with additive increase / multiplicative decrease: the limit grows while the responses are fast and successful
+and is cut down on 429, 5xx, timeouts and connection errors or when the latency grows well over its baseline.
+"""
+import threading
+import time
+from typing import Dict, Optional, Union
+
+from parser_gibdd.metrics import default_metrics
+
+# statuses that mean the server is overloaded, they are also retried with a backoff by the GibddAPI adapter
+OVERLOAD_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class TokenBucket:
+    """Thread safe token bucket
+
+    Parameters
+    ----------
+    rate : float
+        tokens added per second, no limit if 0
+    burst : int
+        maximum amount of tokens, requests that can be sent at once after a pause
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, returns how many seconds the caller has to wait before using it"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self) -> float:
+        """Take a token, blocks until it can be used, returns the seconds waited"""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class ConcurrencyController:
+    """Adaptive limit of the requests in flight, additive increase / multiplicative decrease
+
+    Every successful response within ``latency_tolerance`` times the baseline latency adds ``1 / limit``
+    to the limit, so the limit grows by one per round of ``limit`` requests. An overloaded response or
+    a slow one multiplies the limit by ``decrease``. Only the requests sent after the last decrease can
+    decrease the limit again, so a burst of failures of the requests that were already in flight counts once.
+
+    Parameters
+    ----------
+    initial : int
+        limit before any response is observed
+    minimum : int
+        the limit never goes below it
+    maximum : int
+        the limit never goes above it
+    decrease : float
+        factor the limit is multiplied by on overload
+    latency_tolerance : float
+        a response slower than the baseline latency times the tolerance is treated as overload
+    smoothing : float
+        weight of the latest healthy response in the baseline latency
+    """
+
+    def __init__(self,
+                 initial: int = 4,
+                 minimum: int = 1,
+                 maximum: int = 16,
+                 decrease: float = 0.5,
+                 latency_tolerance: float = 3.0,
+                 smoothing: float = 0.1):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.in_flight = 0
+        self.baseline_latency: Optional[float] = None
+        self.successes = 0
+        self.overloads = 0
+        self.decreases = 0
+        self._last_decrease = float("-inf")
+        self._condition = threading.Condition()
+
+    def try_acquire(self) -> bool:
+        """Take a slot if the limit allows it, never blocks"""
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self) -> float:
+        """Take a slot, blocks until a request in flight is released, returns the seconds waited"""
+        started = time.monotonic()
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        return time.monotonic() - started
+
+    def release(self, sent: float, latency: float, overloaded: Optional[bool]) -> None:
+        """Free the slot of a request sent at ``sent`` (monotonic) and adapt the limit to its outcome
+
+        ``overloaded`` is None for the outcomes that tell nothing about the load of the server,
+        e.g. 404 or an unparsable body.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if overloaded is None:
+                pass
+            elif not overloaded and (self.baseline_latency is None
+                                     or latency <= self.baseline_latency * self.latency_tolerance):
+                self.successes += 1
+                self.baseline_latency = latency if self.baseline_latency is None else \
+                    self.baseline_latency + self.smoothing * (latency - self.baseline_latency)
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            else:
+                self.overloads += 1
+                if sent > self._last_decrease:
+                    self.decreases += 1
+                    self._last_decrease = time.monotonic()
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+            self._condition.notify_all()
+
+
+class Throttle:
+    """Token bucket and adaptive concurrency limit shared by all requests of a client
+
+    Parameters
+    ----------
+    rate : float
+        maximum amount of requests per second, no limit if 0
+    burst : int
+        amount of requests that can be sent at once after a pause
+    controller : ConcurrencyController, optional
+        adaptive limit of the requests in flight, ``ConcurrencyController()`` if not passed
+    """
+
+    def __init__(self, rate: float = 5.0, burst: int = 1, controller: Optional[ConcurrencyController] = None):
+        self.bucket = TokenBucket(rate, burst)
+        self.controller = controller or ConcurrencyController()
+        self.requests = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_overload(status: Optional[int]) -> Optional[bool]:
+        """Whether the status tells the server is overloaded, None if it tells nothing about the load
+
+        The status is None for timeouts and connection errors, they count as overload
+        """
+        if status is None or status in OVERLOAD_STATUSES:
+            return True
+        if status >= 400:
+            return None
+        return False
+
+    def record_wait(self, seconds: float) -> None:
+        """Count a request that waited ``seconds`` for its slot and token, the wait is timed as ``throttle``"""
+        with self._lock:
+            self.requests += 1
+            self.waited += seconds
+        default_metrics().observe("throttle", seconds)
+
+    def acquire(self) -> float:
+        """Wait for a slot and a token, returns the time the request is sent at, to be passed to release"""
+        waited = self.controller.acquire()
+        waited += self.bucket.acquire()
+        self.record_wait(waited)
+        return time.monotonic()
+
+    def release(self, sent: float, status: Optional[int], retried: bool = False) -> None:
+        """Report the outcome of a request
+
+        Parameters
+        ----------
+        sent : float
+            value returned by acquire
+        status : int, optional
+            status code of the response, None if the request timed out or the connection failed
+        retried : bool
+            the request only succeeded after retrying an overloaded response
+        """
+        overloaded = True if retried else self.is_overload(status)
+        self.controller.release(sent, time.monotonic() - sent, overloaded)
+
+    def cancel(self, sent: float) -> None:
+        """Free the slot of a request that failed for a reason other than the server, the limit is kept"""
+        self.controller.release(sent, time.monotonic() - sent, None)
+
+    def dict(self) -> Dict[str, Union[int, float, None]]:
+        controller = self.controller
+        return {
+            "rate": self.bucket.rate,
+            "limit": round(controller.limit, 2),
+            "in_flight": controller.in_flight,
+            "requests": self.requests,
+            "successes": controller.successes,
+            "overloads": controller.overloads,
+            "decreases": controller.decreases,
+            "baseline_latency": controller.baseline_latency and round(controller.baseline_latency, 3),
+            "waited_seconds": round(self.waited, 3),
+        }
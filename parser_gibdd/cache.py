@@ -0,0 +1,144 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Optional, Dict, Any, Tuple
+
+from parser_gibdd.models.gibdd.requests import GibddDateString
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of the raw getDTPCardData response bodies
+
+    Entries are keyed by the hash of the canonical request payload (``GibddDTPCardData.to_request_form()``)
+    and stored zlib-compressed. Data for the months that are long over does not change anymore,
+    so these entries never expire. Recent months get revised by gibdd, their entries expire after ``ttl``.
+    When the cache grows over ``max_size`` the least recently used entries are removed.
+
+    Parameters
+    ----------
+    path : str
+        directory to keep the cached responses in
+    ttl : float
+        lifetime in seconds of the entries that contain recent months
+    max_size : int
+        maximum size of the cache directory in bytes
+    settle_months : int
+        how many months gibdd keeps revising the data for, months older than that are considered closed
+    """
+    suffix = ".zz"
+
+    def __init__(self,
+                 path: str = "./cache/responses",
+                 ttl: float = 24 * 60 * 60,
+                 max_size: int = 2 * 1024 ** 3,
+                 settle_months: int = 3):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.settle_months = settle_months
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in self.path.glob(f"*/*{self.suffix}"))
+
+    @staticmethod
+    def key(payload: Dict[str, Any]) -> str:
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}{self.suffix}"
+
+    def is_immutable(self, payload: Dict[str, Any], now: Optional[Tuple[int, int]] = None) -> bool:
+        """True if every month in the request is closed and will not be revised anymore"""
+        try:
+            months = [GibddDateString(d).year_month() for d in json.loads(payload["data"])["date"]]
+        except (KeyError, ValueError, TypeError, IndexError):
+            return False
+        if not months:
+            return False
+        if now is None:
+            today = time.localtime()
+            now = (today.tm_year, today.tm_mon)
+        now_index = now[0] * 12 + now[1]
+        return all(now_index - (year * 12 + month) >= self.settle_months for year, month in months)
+
+    def get(self, payload: Dict[str, Any]) -> Optional[bytes]:
+        entry = self._entry_path(self.key(payload))
+        try:
+            stat = entry.stat()
+            if not self.is_immutable(payload) and time.time() - stat.st_mtime > self.ttl:
+                self._remove(entry)
+                self._count(hit=False)
+                return None
+            body = zlib.decompress(entry.read_bytes())
+        except (FileNotFoundError, zlib.error):
+            self._count(hit=False)
+            return None
+        # access time is tracked through atime for the eviction, mtime stays the time of the download
+        os.utime(entry, (time.time(), stat.st_mtime))
+        self._count(hit=True)
+        return body
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def set(self, payload: Dict[str, Any], body: bytes) -> None:
+        entry = self._entry_path(self.key(payload))
+        entry.parent.mkdir(exist_ok=True)
+        compressed = zlib.compress(body)
+        tmp = entry.with_name(f"{entry.name}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(compressed)
+        with self._lock:
+            if entry.exists():
+                self._size -= entry.stat().st_size
+            os.replace(tmp, entry)
+            self._size += len(compressed)
+        if self._size > self.max_size:
+            self.evict()
+
+    def discard(self, payload: Dict[str, Any]) -> None:
+        """Remove the entry of a body that turned out to be unusable, e.g. an html page or a truncated json"""
+        self._remove(self._entry_path(self.key(payload)))
+
+    def _remove(self, entry: Path) -> None:
+        with self._lock:
+            try:
+                size = entry.stat().st_size
+                entry.unlink()
+            except FileNotFoundError:
+                return
+            self._size -= size
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits into 90% of max_size"""
+        entries = sorted(
+            ((entry.stat().st_atime, entry) for entry in self.path.glob(f"*/*{self.suffix}")),
+            key=lambda x: x[0]
+        )
+        target = self.max_size * 0.9
+        removed = 0
+        for _, entry in entries:
+            if self._size <= target:
+                break
+            self._remove(entry)
+            removed += 1
+        logger.info(f"Evicted {removed} responses from the cache, cache size: {self._size} bytes")
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": self._size}
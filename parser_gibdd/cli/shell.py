@@ -3,38 +3,255 @@ import logging
 from datetime import date
 from pathlib import Path
 from pprint import pformat
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 
 import click
 
-from parser_gibdd.api.crashes import subregion_crashes, region_crashes_all, region_crashes_all_threading, \
-    country_crashes_all_threading
-from parser_gibdd.convert import package_crashes_subregion, package_crashes_fed_region, package_crashes_country
-from parser_gibdd.models.region import Region, FederalRegion, Country
-from parser_gibdd.regions import get_country_codes
+from parser_gibdd.utils import OUTPUT_FORMATS
+
+if TYPE_CHECKING:  # pragma: no cover
+    from parser_gibdd.api.gibdd_api import GibddAPI
+    from parser_gibdd.api.planner import RequestPlanner
+    from parser_gibdd.models.region import Country
+
+# the crawl and the conversion pull in requests, aiohttp and pandas,
+# they are imported by the commands that use them, so the help and the region lookups start fast
 
 logger = logging.getLogger("parser_gibdd.gibdd_cli")
 
 
+class Clients:
+    """Process-wide planner and GibddAPI configured by the options of the group
+
+    They are built by the first command that needs them, so the help and the commands that send no requests
+    neither open the sync state nor create the caches.
+    """
+
+    def __init__(self, ctx: click.Context):
+        self.ctx = ctx
+        self.options = ctx.params
+        self._planner: Optional["RequestPlanner"] = None
+        self._api: Optional["GibddAPI"] = None
+
+    def planner(self) -> "RequestPlanner":
+        if self._planner is None:
+            from parser_gibdd.api.planner import RequestPlanner, PageSizer, set_default_planner
+            from parser_gibdd.sync import SyncState
+
+            options = self.options
+            state = SyncState(options["sync_state"], revise_months=options["revise_months"]) \
+                if options["sync"] else None
+            if state is not None:
+                self.ctx.call_on_close(state.close)
+            card_limit = options["card_limit"]
+            self._planner = RequestPlanner(card_limit=card_limit,
+                                           max_months=options["max_months"],
+                                           sizer=PageSizer(maximum=card_limit) if options["adaptive_pages"] else None,
+                                           page_workers=options["page_workers"],
+                                           sync=state)
+            set_default_planner(self._planner)
+        return self._planner
+
+    def api(self) -> "GibddAPI":
+        if self._api is None:
+            from parser_gibdd.api.gibdd_api import GibddAPI, set_default_api
+            from parser_gibdd.api.parsing import ParsePool
+            from parser_gibdd.api.singleflight import SingleFlight
+            from parser_gibdd.api.throttle import Throttle, ConcurrencyController
+            from parser_gibdd.cache import ResponseCache
+            from parser_gibdd.replay import ReplayStore
+
+            self.planner()
+            options = self.options
+            cache = ResponseCache(options["cache_path"], ttl=options["cache_ttl"] * 60 * 60,
+                                  max_size=options["cache_size"] * 1024 ** 2) if options["use_cache"] else None
+            throttle = Throttle(options["request_rate"],
+                                controller=ConcurrencyController(maximum=options["max_in_flight"])) \
+                if options["use_throttle"] else None
+            single_flight = SingleFlight(max_bytes=options["dedup_size"] * 1024 ** 2) if options["dedup"] else None
+            replay = None
+            record_path, replay_path = options["record_path"], options["replay_path"]
+            if record_path or replay_path:
+                replay = ReplayStore(record_path or replay_path, mode="record" if record_path else "replay",
+                                     delay=options["replay_delay"])
+            parse_workers = options["parse_workers"]
+            self._api = GibddAPI(pool_size=options["pool_size"], throttle=throttle, single_flight=single_flight,
+                                 cache=cache, raw=options["raw"], compact=options["compact"], replay=replay,
+                                 parse_pool=ParsePool(parse_workers) if parse_workers > 0 else None)
+            set_default_api(self._api)
+            self.ctx.call_on_close(self._api.close)
+        return self._api
+
+
+def clients() -> Clients:
+    """Clients of the running command"""
+    return click.get_current_context().find_object(Clients)
+
+
 @click.group()
-def main():
-    pass
+@click.option("--pool-size",
+              type=int,
+              default=10,
+              help="Maximum amount of keep-alive connections to stat.gibdd.ru")
+@click.option("--throttle/--no-throttle", "use_throttle",
+              default=True,
+              help="Pace the requests and adapt the amount of requests in flight to the latency and errors "
+                   "of stat.gibdd.ru")
+@click.option("--request-rate",
+              type=float,
+              default=5.0,
+              help="Maximum amount of requests per second with --throttle, no limit if 0")
+@click.option("--max-in-flight",
+              type=int,
+              default=16,
+              help="Upper bound of the adaptive amount of requests in flight with --throttle")
+@click.option("--dedup/--no-dedup",
+              default=True,
+              help="Send identical requests of a run only once, the responses are kept in memory")
+@click.option("--dedup-size",
+              type=int,
+              default=128,
+              help="Maximum size of the responses kept in memory for the deduplication in megabytes")
+@click.option("--cache/--no-cache", "use_cache",
+              default=True,
+              help="Keep the downloaded crash data in the response cache")
+@click.option("--cache-path",
+              default="./cache/responses",
+              help="Directory of the response cache")
+@click.option("--cache-ttl",
+              type=float,
+              default=24.0,
+              help="Hours until the cached responses for the recent months expire")
+@click.option("--cache-size",
+              type=int,
+              default=2048,
+              help="Maximum size of the response cache in megabytes")
+@click.option("--record", "record_path",
+              default=None,
+              help="Save every response into this directory so the run can be replayed offline")
+@click.option("--replay", "replay_path",
+              default=None,
+              help="Answer the requests with the responses saved by --record, nothing is sent to stat.gibdd.ru")
+@click.option("--replay-delay",
+              type=float,
+              default=0.0,
+              help="Seconds every replayed response takes, emulates the latency of the site")
+@click.option("--card-limit",
+              type=int,
+              default=2000,
+              help="Maximum amount of crash cards requested at once, bigger periods are paginated")
+@click.option("--max-months",
+              type=int,
+              default=None,
+              help="Maximum amount of months in a single request, all months of the period by default")
+@click.option("--adaptive-pages",
+              is_flag=True,
+              default=False,
+              help="Pick the page size from the observed latency and body size, --card-limit is the maximum")
+@click.option("--page-workers",
+              type=int,
+              default=4,
+              help="Amount of pages of a single subregion fetched at the same time")
+@click.option("--parse-workers",
+              type=int,
+              default=0,
+              help="Amount of processes validating the responses while the threads keep downloading, "
+                   "0 to validate them in the downloading threads")
+@click.option("--raw",
+              is_flag=True,
+              default=False,
+              help="Skip the validation of the crash data, faster for the bulk exports")
+@click.option("--compact",
+              is_flag=True,
+              default=False,
+              help="Keep the crash data in memory as compact records, for the crawls of the whole country")
+@click.option("--sync",
+              is_flag=True,
+              default=False,
+              help="Only request the months that are new or may have been revised since the last sync "
+                   "and add them to the existing output")
+@click.option("--sync-state",
+              default="./cache/sync_state.sqlite3",
+              help="Path to the high-water marks of the sync")
+@click.option("--revise-months",
+              type=int,
+              default=3,
+              help="How many of the latest synced months are requested again")
+@click.option("--metrics-summary/--no-metrics-summary",
+              default=True,
+              help="Print the time spent in every stage of the crawl and the conversion when the command ends")
+@click.option("--metrics-out",
+              default=None,
+              help="Write the timers and the counters of every stage and subregion into this file")
+@click.option("--metrics-format",
+              type=click.Choice(["prometheus", "jsonl"]),
+              default="prometheus",
+              help="Format of --metrics-out, Prometheus text format or json lines")
+@click.pass_context
+def main(ctx: click.Context, record_path: Optional[str], replay_path: Optional[str], metrics_summary: bool,
+         metrics_out: Optional[str], metrics_format: str, **options):
+    """Crawl stat.gibdd.ru, the options of the group configure the clients of the crawling commands"""
+    from parser_gibdd.metrics import Metrics, set_default_metrics
+
+    if record_path and replay_path:
+        raise click.UsageError("--record and --replay can't be used together")
+    ctx.obj = Clients(ctx)
+    metrics = Metrics()
+    set_default_metrics(metrics)
+
+    def report_metrics():
+        if metrics and metrics_summary:
+            click.echo(metrics.summary(), err=True)
+        if metrics_out:
+            metrics.write(metrics_out, metrics_format)
+
+    ctx.call_on_close(report_metrics)
 
 
 @main.command()
 @click.option("-s", "cache_path", required=False)
-def all_okato(cache_path: Optional[str]) -> Optional[Country]:
+@click.option("--snapshots", "snapshots_path",
+              default="./cache/okato",
+              help="Directory of the OKATO snapshots, one per month")
+@click.option("--workers",
+              type=int,
+              default=8,
+              help="Amount of federal regions requested at the same time")
+@click.option("--retries",
+              type=int,
+              default=3,
+              help="How many times the request of a single federal region is retried")
+@click.option("--force",
+              is_flag=True,
+              default=False,
+              help="Request the codes even if the snapshot of the latest month already exists")
+@click.option("--reuse-previous",
+              is_flag=True,
+              default=False,
+              help="Request only the districts of the federal regions that are new or renamed since "
+                   "the previous snapshot, the districts of the others are taken from it")
+def all_okato(cache_path: Optional[str], snapshots_path: str, workers: int, retries: int,
+              force: bool, reuse_previous: bool) -> Optional["Country"]:
     """Get OKATO codes for whole country
 
     If save_path is not passed, data will just be printed in stdout
     """
+    from parser_gibdd.regions import refresh_country_codes
+    from parser_gibdd.snapshots import OkatoSnapshots
 
-    all_codes = get_country_codes()
+    clients().api()
+    refresh = refresh_country_codes(OkatoSnapshots(snapshots_path), max_workers=workers, retries=retries,
+                                    force=force, reuse_previous=reuse_previous)
+    all_codes = refresh.country
     click.echo([
         f"{fed.name} муниципалитетов: {len(fed.districts)}"
         for fed in all_codes.regions
     ])
     click.echo(pformat(all_codes.dict()))
+    click.echo(refresh.diff.report())
+    if refresh.failed:
+        click.echo(f"Failed to request {', '.join(region.name for region in refresh.failed)}, "
+                   f"their previous codes are used, run the command again to complete the snapshot")
 
     if cache_path:
         path = Path(cache_path)
@@ -67,24 +284,42 @@ def all_okato(cache_path: Optional[str]) -> Optional[Country]:
               required=False,
               default="./cache/okato_codes_latest.json",
               help="")
+@click.option("-f", "--format", "output_format",
+              type=click.Choice(OUTPUT_FORMATS),
+              default="xlsx",
+              help="xlsx workbooks in a zip archive, a parquet/arrow dataset partitioned by federal region and year "
+                   "or a sqlite warehouse updated by every run")
+@click.option("-w", "--workers",
+              type=int,
+              default=1,
+              help="Amount of processes rendering the xlsx workbooks")
 def verbose(date_from: date,
             date_to: date,
             federal: int,
             municipal: Optional[int] = None,
-            okato_cache_path: Optional[str] = None) -> None:
+            okato_cache_path: Optional[str] = None,
+            output_format: str = "xlsx",
+            workers: int = 1) -> None:
     """Get gibdd data for a given """
+    from parser_gibdd.api.crashes import subregion_crashes, region_crashes_all
+    from parser_gibdd.convert import package_crashes_subregion, package_crashes_fed_region
+    from parser_gibdd.models.region import Region
+    from parser_gibdd.snapshots import load_country
+
+    clients().api()
+    sync = clients().planner().sync
     if not municipal:
-        path = Path(okato_cache_path)
-        with path.open("r") as raw:
-            all_codes = Country.parse_raw(raw.read())
+        all_codes = load_country(okato_cache_path)
         federal_region = all_codes.get_region(str(federal), federal=True)
         if not federal_region or isinstance(federal_region, Region):
             click.echo(f"Whoops, no federal region with okato code {federal} found")
             return
         region_crashes = region_crashes_all(region=federal_region, period_start=date_from, period_end=date_to)
-        package_crashes_fed_region(region_crashes, federal_region=federal_region.name)
+        package_crashes_fed_region(region_crashes, federal_region=federal_region.name, output_format=output_format,
+                                   workers=workers, append=sync is not None, country=all_codes, sync=sync)
     required_crashes = subregion_crashes(federal, municipal, date_from, date_to)
-    package_crashes_subregion(required_crashes)
+    package_crashes_subregion(required_crashes, output_format=output_format, workers=workers,
+                              append=sync is not None, okato=str(municipal), sync=sync)
 
 
 @main.command()
@@ -107,12 +342,23 @@ def verbose(date_from: date,
               required=False,
               default="./cache/okato_codes_latest.json",
               help="Name of the required region")
+@click.option("-f", "--format", "output_format",
+              type=click.Choice(OUTPUT_FORMATS),
+              default="xlsx",
+              help="xlsx workbooks in a zip archive, a parquet/arrow dataset partitioned by federal region and year "
+                   "or a sqlite warehouse updated by every run")
+@click.option("-w", "--workers",
+              type=int,
+              default=1,
+              help="Amount of processes rendering the xlsx workbooks")
 @click.pass_context
-def name(ctx: click.Context, date_from: date, date_to: date, region: str, okato_path: str) -> None:
+def name(ctx: click.Context, date_from: date, date_to: date, region: str, okato_path: str,
+         output_format: str, workers: int) -> None:
     """Get gibdd data by region name"""
-    path = Path(okato_path)
-    with path.open("r") as raw:
-        all_codes = Country.parse_raw(raw.read())
+    from parser_gibdd.models.region import FederalRegion
+    from parser_gibdd.snapshots import load_country
+
+    all_codes = load_country(okato_path)
     found_regions = all_codes.find_region(region)
     if not found_regions:
         click.echo("region you specified was not found, try again")
@@ -124,16 +370,24 @@ def name(ctx: click.Context, date_from: date, date_to: date, region: str, okato_
                                   show_choices=True)
     selected_region = found_regions[int(selected_index)]
     if isinstance(selected_region, FederalRegion):
+        from parser_gibdd.api.crashes import region_crashes_all_threading
+        from parser_gibdd.convert import package_crashes_fed_region
+
+        clients().api()
+        sync = clients().planner().sync
         region_crashes = region_crashes_all_threading(region=selected_region,
                                                       period_start=date_from,
                                                       period_end=date_to)
-        package_crashes_fed_region(region_crashes, federal_region=selected_region.name)
+        package_crashes_fed_region(region_crashes, federal_region=selected_region.name, output_format=output_format,
+                                   workers=workers, append=sync is not None, country=all_codes, sync=sync)
         return
     ctx.invoke(verbose,
                date_from=date_from,
                date_to=date_to,
                federal=all_codes.get_parent_region(selected_region).okato,
-               municipal=selected_region.okato)
+               municipal=selected_region.okato,
+               output_format=output_format,
+               workers=workers)
 
 
 @main.command()
@@ -151,12 +405,208 @@ def name(ctx: click.Context, date_from: date, date_to: date, region: str, okato_
               required=False,
               default="./cache/okato_codes_latest.json",
               help="Name of the required region")
-def country(date_from: date, date_to: date, okato_path: str) -> None:
-    path = Path(okato_path)
-    with path.open("r") as raw:
-        all_codes = Country.parse_raw(raw.read())
-    country_results = country_crashes_all_threading(all_codes, period_start=date_from, period_end=date_to)
-    package_crashes_country(country_results)
+@click.option("-f", "--format", "output_format",
+              type=click.Choice(OUTPUT_FORMATS),
+              default="xlsx",
+              help="xlsx workbooks in a zip archive, a parquet/arrow dataset partitioned by federal region and year "
+                   "or a sqlite warehouse updated by every run")
+@click.option("-w", "--workers",
+              type=int,
+              default=1,
+              help="Amount of processes rendering the xlsx workbooks")
+@click.option("--async", "use_async",
+              is_flag=True,
+              default=False,
+              help="Crawl with the asyncio engine, requires aiohttp")
+@click.option("--concurrency",
+              type=int,
+              default=20,
+              help="Maximum amount of requests in flight, only used with --async, "
+                   "with --throttle it is the amount of the crawl workers")
+@click.option("--rate",
+              type=float,
+              default=10.0,
+              help="Maximum amount of requests per second, only used with --async and --no-throttle")
+@click.option("--resume",
+              is_flag=True,
+              default=False,
+              help="Keep the finished units and their crashes in the journal, units finished by a previous "
+                   "interrupted crawl are not requested again, the journal is emptied once the crawl is finished")
+@click.option("--journal", "journal_path",
+              default="./cache/crawl_journal.sqlite3",
+              help="Path to the journal of the finished crawl units, only used with --resume")
+def country(date_from: date, date_to: date, okato_path: str, output_format: str, workers: int,
+            use_async: bool, concurrency: int, rate: float,
+            resume: bool, journal_path: str) -> None:
+    from parser_gibdd.api.crashes import iter_country_crashes
+    from parser_gibdd.convert import package_crashes_stream
+    from parser_gibdd.journal import CrawlJournal
+    from parser_gibdd.snapshots import load_country
+
+    if use_async and (clients().options["record_path"] or clients().options["replay_path"]):
+        raise click.UsageError("--record and --replay only work without --async")
+    api = clients().api()
+    sync = clients().planner().sync
+    all_codes = load_country(okato_path)
+    journal = None
+    if resume:
+        journal = CrawlJournal(journal_path, raw=api.raw, compact=api.compact)
+        click.echo(f"Resuming the crawl, {journal.finished()} units are already finished")
+    if use_async:
+        from parser_gibdd.api.aio import iter_country_crashes_asyncio
+
+        country_stream = iter_country_crashes_asyncio(all_codes, period_start=date_from, period_end=date_to,
+                                                      concurrency=concurrency, rate=rate,
+                                                      cache=api.cache, journal=journal, raw=api.raw,
+                                                      throttle=api.throttle, compact=api.compact,
+                                                      parse_pool=api.parse_pool)
+    else:
+        country_stream = iter_country_crashes(all_codes, period_start=date_from, period_end=date_to,
+                                              journal=journal)
+    try:
+        package_crashes_stream(country_stream, output_format=output_format, workers=workers,
+                               append=sync is not None, country=all_codes, sync=sync)
+    except Exception:
+        if journal is not None:
+            click.echo(f"Crawl failed after {journal.finished()} finished units, continue it with --resume")
+        raise
+    else:
+        if journal is not None:
+            # a later crawl of the same months has to request them again
+            journal.reset()
+    finally:
+        if journal is not None:
+            journal.close()
+
+
+@main.command()
+@click.argument("queue_path")
+@click.option("-ds", "--dstart", "date_from",
+              required=True,
+              type=click.DateTime(formats=["%Y-%m"]),
+              default=date(year=2015, month=1, day=1).strftime("%Y-%m"),
+              help="Get crashes starting from this date")
+@click.option("-de", "--dend", "date_to",
+              required=True,
+              type=click.DateTime(formats=["%Y-%m"]),
+              default=date.today().strftime("%Y-%m"),
+              help="Get crashes ending on this date")
+@click.option("-o", "--okato", "okato_path",
+              required=False,
+              default="./cache/okato_codes_latest.json",
+              help="Name of the required region")
+@click.option("--reset",
+              is_flag=True,
+              default=False,
+              help="Remove all units of the previous crawl from the queue, including the finished ones")
+@click.option("--retry-failed",
+              is_flag=True,
+              default=False,
+              help="Queue the units that failed too many times again")
+@click.option("--wait",
+              is_flag=True,
+              default=False,
+              help="Report the progress of the workers until no units are pending or leased")
+@click.option("--poll",
+              type=float,
+              default=30.0,
+              help="Seconds between the progress reports with --wait")
+def coordinator(queue_path: str, date_from: date, date_to: date, okato_path: str, reset: bool,
+                retry_failed: bool, wait: bool, poll: float) -> None:
+    """Queue the crawl of the whole country into the QUEUE_PATH database shared with the workers"""
+    import time
+
+    from parser_gibdd.snapshots import load_country
+    from parser_gibdd.workqueue import WorkQueue, enqueue_country
+
+    clients().planner()
+    all_codes = load_country(okato_path)
+    with WorkQueue(queue_path) as queue:
+        if reset:
+            queue.reset()
+        if retry_failed:
+            click.echo(f"{queue.retry_failed()} failed units queued again")
+        added = enqueue_country(queue, all_codes, period_start=date_from, period_end=date_to)
+        click.echo(f"{added} units queued, {queue.states()}")
+        while wait and queue.unfinished():
+            time.sleep(poll)
+            click.echo(queue.states())
+
+
+@main.command()
+@click.argument("queue_path")
+@click.option("-o", "--output", "filename",
+              default="Российская Федерация",
+              help="Directory the units are written into, shared by all the workers")
+@click.option("-f", "--format", "output_format",
+              type=click.Choice([output for output in OUTPUT_FORMATS if output != "sqlite"]),
+              default="parquet",
+              help="parquet/arrow dataset partitioned by federal region and year "
+                   "or xlsx workbooks in the directories of the subregions")
+@click.option("--worker-id",
+              default=None,
+              help="Name of the worker in the queue, the host name and the process id by default")
+@click.option("--lease",
+              type=float,
+              default=600.0,
+              help="Seconds a unit belongs to the worker without a renewal, "
+                   "units of a dead worker are re-assigned after that time")
+@click.option("--max-attempts",
+              type=int,
+              default=5,
+              help="How many times a unit is leased before it is marked as failed")
+@click.option("--poll",
+              type=float,
+              default=10.0,
+              help="Seconds between the attempts to lease a unit while all of them are leased by the other workers")
+def worker(queue_path: str, filename: str, output_format: str, worker_id: Optional[str], lease: float,
+           max_attempts: int, poll: float) -> None:
+    """Crawl the units queued by the coordinator in QUEUE_PATH until none of them is left"""
+    from parser_gibdd.workqueue import WorkQueue, run_worker
+
+    if not Path(queue_path).exists():
+        raise click.BadParameter(f"{queue_path} does not exist, queue the crawl with the coordinator command",
+                                 param_hint="QUEUE_PATH")
+    clients().api()
+    with WorkQueue(queue_path, lease_seconds=lease, max_attempts=max_attempts) as queue:
+        finished = run_worker(queue, filename, output_format, worker=worker_id, poll_seconds=poll)
+        click.echo(f"{finished} units finished by this worker, {queue.states()}")
+
+
+@main.command()
+@click.argument("warehouse_path")
+@click.option("-o", "--output", "filename",
+              default="Российская Федерация",
+              help="Name of the zip archive or of the parquet/arrow directory")
+@click.option("-f", "--format", "output_format",
+              type=click.Choice([output for output in OUTPUT_FORMATS if output != "sqlite"]),
+              default="xlsx",
+              help="xlsx workbooks in a zip archive or a parquet/arrow dataset partitioned by federal region and year")
+@click.option("-ds", "--dstart", "date_from",
+              type=click.DateTime(formats=["%Y-%m-%d", "%Y-%m"]),
+              default=None,
+              help="Only the crashes starting from this date")
+@click.option("-de", "--dend", "date_to",
+              type=click.DateTime(formats=["%Y-%m-%d", "%Y-%m"]),
+              default=None,
+              help="Only the crashes up to this date, inclusive")
+@click.option("-R", "--federal", "federal_region",
+              default=None,
+              help="Only the crashes of the federal region with this name")
+@click.option("-r", "--okato",
+              default=None,
+              help="Only the crashes of the subregion with this OKATO code")
+def export(warehouse_path: str, filename: str, output_format: str, date_from: Optional[date],
+           date_to: Optional[date], federal_region: Optional[str], okato: Optional[str]) -> None:
+    """Export the crashes stored by --format sqlite from the WAREHOUSE_PATH database"""
+    from parser_gibdd.warehouse import CrashWarehouse
+
+    if not Path(warehouse_path).exists():
+        raise click.BadParameter(f"{warehouse_path} does not exist", param_hint="WAREHOUSE_PATH")
+    with CrashWarehouse(warehouse_path) as warehouse:
+        warehouse.export(filename, output_format, federal_region=federal_region, okato=okato,
+                         date_from=date_from.date() if date_from else None,
+                         date_to=date_to.date() if date_to else None)
 
 
 if __name__ == "__main__":
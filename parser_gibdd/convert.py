@@ -1,12 +1,30 @@
+import concurrent.futures
+import os
+import re
+import threading
 import zipfile
+from collections import deque
+from datetime import date
 from io import BytesIO
-from typing import Optional, List, Dict, Any, Tuple
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Tuple, Iterable, Iterator, Type, Deque, TYPE_CHECKING
 
-from pandas import DataFrame, ExcelWriter
+from pandas import DataFrame, ExcelWriter, Series, to_datetime
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_SINGLETON
 
+from parser_gibdd.api.planner import CrawlUnit, MonthKey
+from parser_gibdd.metrics import Metrics, current_labels, default_metrics, labelled, set_default_metrics
 from parser_gibdd.parsers import logger
-from parser_gibdd.models.gibdd.crash import CrashDataResponse
-from parser_gibdd.models.region import RegionName, FederalRegionName
+from parser_gibdd.models.gibdd.crash import CrashDataResponse, CrashCard, CrashInfo
+from parser_gibdd.models.gibdd.participant import DriverInfo
+from parser_gibdd.models.gibdd.vehicle import VehicleInfo
+from parser_gibdd.models.gibdd.views import ModelView, view_of
+from parser_gibdd.models.region import Country, RegionName, FederalRegionName
+from parser_gibdd.utils import OUTPUT_FORMATS  # noqa: F401
+
+if TYPE_CHECKING:  # pragma: no cover
+    from parser_gibdd.sync import SyncState
 
 
 def crash_to_excel(crash: DataFrame, filename: Optional[str] = None) -> None:
@@ -30,79 +48,761 @@ def crash_data_single_dataframe(data: CrashDataResponse) -> DataFrame:
     return df
 
 
+TABLE_NAMES = ("crashes", "vehicles", "participants")
+
+CATEGORICAL_COLUMNS = {
+    "crashes": ("crash_type", "District", "region_name", "motion_changes", "main_road", "road_category",
+                "road_significance", "street_category", "settlement", "light_conditions", "s_dtp",
+                "road_conditions"),
+    "vehicles": ("color", "property_form", "issued_year", "car_model", "car_brand", "o_pf", "r_rul",
+                 "technical_defects", "vehicle_type", "left_crash_site"),
+    "participants": ("alcohol_level", "gender", "left_crash_site", "injury_severity", "driver_experience",
+                     "SAFETY_BELT", "S_SEAT_GROUP"),
+}
+
+NUMERIC_DTYPES = {int: "int64", float: "float64"}
+
+# column name, alias of the field in the raw payload, default value, dtype
+Column = Tuple[str, str, Any, Any]
+
+
+def model_columns(model: Type[BaseModel], table: str, exclude: Iterable[str] = ()) -> List[Column]:
+    """Columns of a table made of the fields of a model
+
+    Small vocabulary strings are categorical, required ints and floats get numpy dtypes,
+    everything else stays an object column
+    """
+    columns = []
+    for name, field in model.__fields__.items():
+        if name in exclude:
+            continue
+        if name in CATEGORICAL_COLUMNS[table]:
+            dtype = "category"
+        elif field.shape == SHAPE_SINGLETON and field.required and field.type_ in NUMERIC_DTYPES:
+            dtype = NUMERIC_DTYPES[field.type_]
+        else:
+            dtype = object
+        columns.append((name, field.alias, field.default, dtype))
+    return columns
+
+
+CRASH_COLUMNS = model_columns(CrashCard, "crashes", exclude={"crash_info"})
+CRASH_INFO_COLUMNS = model_columns(CrashInfo, "crashes", exclude={"vehicle_info", "participant_info"})
+VEHICLE_COLUMNS = model_columns(VehicleInfo, "vehicles", exclude={"drivers_info"})
+PARTICIPANT_COLUMNS = model_columns(DriverInfo, "participants")
+
+
+def _frame(records: List[Any], model: Type[BaseModel], columns: List[Column], raw: bool) -> Dict[str, Series]:
+    fields = view_of(model).fields
+    if raw:
+        # the decoded values are coerced to the field types like the views do it
+        return {
+            name: Series(fields[name][4].column([record.get(alias, default) for record in records]), dtype=dtype)
+            for name, alias, default, dtype in columns
+        }
+    frame = {}
+    for name, alias, default, dtype in columns:
+        values = [getattr(record, name, default) for record in records]
+        frame[name] = Series(_lists(values) if fields[name][3] else values, dtype=dtype)
+    return frame
+
+
+def _lists(values: List[Any]) -> List[Any]:
+    """The lists of strings of the compact records are tuples, the tables hold lists like for the models"""
+    return [list(value) if type(value) is tuple else value for value in values]
+
+
 def crash_to_dataframes(data: CrashDataResponse) -> Tuple[DataFrame, DataFrame, DataFrame]:
-    crashes, vehicles, participants = [], [], []
-    for card in data.crashes:
-        crashes.append({**card.dict(exclude={'crash_info'}),
-                        **card.crash_info.dict(exclude={"vehicle_info", "participant_info"}),
-                        **{"region_name": data.region_name}
-                        })
-
-        vehicles.extend([
-            {**veh.dict(exclude={"driver_info"}), **{"crash_id": card.id}}
-            for veh in card.crash_info.vehicle_info
-        ])
-        participants.extend([
-            {**participant.dict(), **{"crash_id": card.id}}
-            for participant in card.crash_info.participant_info
-        ])
-        participants.extend([
-            {**driver.dict(), **{"crash_id": card.id}}
-            for veh in card.crash_info.vehicle_info
-            for driver in veh.drivers_info
-        ])
+    """Flatten a response into the crashes, vehicles and participants tables
+
+    Every column is built at once with an explicit dtype, straight from the decoded json for the raw views
+    and from the attributes for the models and the compact records, so nothing is dumped back into dicts.
+    Vehicles and participants reference their crash with ``crash_id``, participants are the passengers
+    and pedestrians of a crash followed by the drivers of its vehicles.
+    """
+    with default_metrics().timer("dataframe"):
+        frames = _crash_to_dataframes(data)
     logger.info(f"Region {data.region_name} successfully parsed")
-    return DataFrame(crashes), DataFrame(vehicles), DataFrame(participants)
+    return frames
+
+
+def _crash_to_dataframes(data: CrashDataResponse) -> Tuple[DataFrame, DataFrame, DataFrame]:
+    raw = isinstance(data, ModelView)
+    if raw:
+        cards = data.raw["tab"]
+        infos = [card["infoDtp"] for card in cards]
+        ids = [card["KartId"] for card in cards]
+        card_vehicles = [info["ts_info"] for info in infos]
+        card_participants = [
+            info["uchInfo"] + [driver for vehicle in vehicles for driver in vehicle["ts_uch"]]
+            for info, vehicles in zip(infos, card_vehicles)
+        ]
+    else:
+        cards = data.crashes
+        infos = [card.crash_info for card in cards]
+        ids = [card.id for card in cards]
+        card_vehicles = [info.vehicle_info for info in infos]
+        card_participants = [
+            [*info.participant_info, *(driver for vehicle in vehicles for driver in vehicle.drivers_info)]
+            for info, vehicles in zip(infos, card_vehicles)
+        ]
+
+    crashes = DataFrame({
+        **_frame(cards, CrashCard, CRASH_COLUMNS, raw),
+        **_frame(infos, CrashInfo, CRASH_INFO_COLUMNS, raw),
+        "region_name": Series([data.region_name] * len(cards), dtype="category"),
+    })
+    vehicles = DataFrame({
+        **_frame([vehicle for each in card_vehicles for vehicle in each], VehicleInfo, VEHICLE_COLUMNS, raw),
+        "crash_id": Series([crash_id for crash_id, each in zip(ids, card_vehicles) for _ in each], dtype="int64"),
+    })
+    participants = DataFrame({
+        **_frame([participant for each in card_participants for participant in each], DriverInfo,
+                 PARTICIPANT_COLUMNS, raw),
+        "crash_id": Series([crash_id for crash_id, each in zip(ids, card_participants) for _ in each],
+                           dtype="int64"),
+    })
+    return crashes, vehicles, participants
+
+
+Frames = Tuple[DataFrame, DataFrame, DataFrame]
+
+
+def crash_to_arrow(data: CrashDataResponse) -> Dict[str, Any]:
+    """Convert a response into arrow tables with explicit dtypes, see :func:`frames_to_arrow`"""
+    return frames_to_arrow(crash_to_dataframes(data))
+
+
+def frames_to_arrow(tables: Frames) -> Dict[str, Any]:
+    """Convert the crashes, vehicles and participants tables into arrow tables with explicit dtypes
+
+    Categorical columns and the strings in the list columns (weather, road deficiencies, violations)
+    are dictionary-encoded, the crash date becomes a proper date
+    and every table gets ``year`` and ``month`` columns used for partitioning.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("pyarrow is required for the parquet and arrow output, install it with `pip install pyarrow`")
+    frames = dict(zip(TABLE_NAMES, tables))
+    crashes = frames["crashes"]
+    if len(crashes):
+        crashes["date"] = to_datetime(crashes["date"], format="%d.%m.%Y").dt.date
+        crashes["year"] = [crash_date.year for crash_date in crashes["date"]]
+        crashes["month"] = [crash_date.month for crash_date in crashes["date"]]
+        for column in ("year", "month"):
+            values = dict(zip(crashes["id"], crashes[column]))
+            for name in ("vehicles", "participants"):
+                if len(frames[name]):
+                    frames[name][column] = frames[name]["crash_id"].map(values)
+    tables = {}
+    for name, frame in frames.items():
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        for index, field in enumerate(table.schema):
+            if pa.types.is_list(field.type) and pa.types.is_string(field.type.value_type):
+                encoded = table.column(index).cast(pa.list_(pa.dictionary(pa.int32(), pa.string())))
+                table = table.set_column(index, field.name, encoded)
+        tables[name] = table
+    return tables
+
+
+def write_columnar(data: CrashDataResponse,
+                   directory: Path,
+                   municipal: str,
+                   federal_region: Optional[str] = None,
+                   output_format: str = "parquet",
+                   by_month: bool = False) -> None:
+    """Write the three tables of a response into a hive-partitioned dataset
+
+    Layout is ``<directory>/<table>/federal_region=<name>/year=<year>/<municipal>-<part>.<format>``,
+    the federal_region level is skipped if no federal region is given.
+    Existing files are never overwritten, every response of the subregion gets its own part.
+    With ``by_month`` every month of the response gets its own ``<municipal>-<year>-<month>-<start>`` part,
+    so the months can be replaced one by one, see :func:`remove_columnar_months`.
+    """
+    write_columnar_tables(crash_to_arrow(data), directory, municipal=municipal, federal_region=federal_region,
+                          output_format=output_format, by_month=by_month, start=data.start)
+
+
+def write_columnar_tables(tables: Dict[str, Any],
+                          directory: Path,
+                          municipal: str,
+                          federal_region: Optional[str] = None,
+                          output_format: str = "parquet",
+                          by_month: bool = False,
+                          start: int = 0) -> None:
+    """Write the arrow tables made by :func:`frames_to_arrow` like :func:`write_columnar`,
+    ``start`` is the first card of the tables used in the names of the monthly parts"""
+    import pyarrow.compute as pc
+
+    for name, table in tables.items():
+        if not table.num_rows:
+            continue
+        partition = columnar_partition(directory, name, federal_region)
+        for year in pc.unique(table["year"]).to_pylist():
+            year_dir = partition / f"year={year}"
+            year_dir.mkdir(parents=True, exist_ok=True)
+            year_table = table.filter(pc.equal(table["year"], year))
+            if by_month:
+                parts = [
+                    (f"{municipal}-{year}-{month:02d}-{start}",
+                     year_table.filter(pc.equal(year_table["month"], month)))
+                    for month in sorted(pc.unique(year_table["month"]).to_pylist())
+                ]
+            else:
+                parts = [(f"{municipal}-{len(columnar_parts(year_dir, municipal, output_format))}", year_table)]
+            for part, part_table in parts:
+                with default_metrics().timer("write"):
+                    write_columnar_part(part_table.drop(["year", "month"]), year_dir / f"{part}.{output_format}",
+                                        output_format)
+
+
+def write_columnar_part(table: Any, path: Path, output_format: str = "parquet") -> None:
+    """Write the part atomically, the readers of a dataset shared by several workers never see half of it
+
+    The temporary file starts with a dot, so it is skipped by the dataset discovery of pyarrow
+    """
+    import pyarrow.parquet as pq
+    from pyarrow import ipc
+
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        if output_format == "parquet":
+            pq.write_table(table, tmp)
+        else:
+            with ipc.new_file(str(tmp), table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def read_columnar_part(path: Path, output_format: str = "parquet") -> Any:
+    import pyarrow.parquet as pq
+    from pyarrow import ipc
+
+    if output_format == "parquet":
+        return pq.read_table(path)
+    with ipc.open_file(str(path)) as reader:
+        return reader.read_all()
+
+
+def columnar_partition(directory: Path, table: str, federal_region: Optional[str] = None) -> Path:
+    partition = directory / table
+    if federal_region:
+        partition = partition / f"federal_region={federal_region}"
+    return partition
+
+
+def columnar_parts(year_dir: Path, municipal: str, output_format: str = "parquet",
+                   by_month: Optional[bool] = None) -> List[Path]:
+    """Parts of a subregion in a ``year=`` directory, only the monthly or only the other parts if ``by_month`` is set"""
+    plain = re.compile(rf"{re.escape(municipal)}-\d+\.{output_format}")
+    monthly = re.compile(rf"{re.escape(municipal)}-\d{{4}}-\d{{2}}-\d+\.{output_format}")
+    patterns = {None: (plain, monthly), False: (plain,), True: (monthly,)}[by_month]
+    if not year_dir.is_dir():
+        return []
+    return sorted(path for path in year_dir.iterdir() if any(pattern.fullmatch(path.name) for pattern in patterns))
+
+
+def remove_columnar_parts(directory: Path,
+                          municipal: str,
+                          federal_region: Optional[str] = None,
+                          output_format: str = "parquet") -> None:
+    """Remove all parts of a subregion, a subregion written again replaces its previous output"""
+    for name in TABLE_NAMES:
+        for year_dir in columnar_partition(directory, name, federal_region).glob("year=*"):
+            for path in columnar_parts(year_dir, municipal, output_format):
+                path.unlink()
+
+
+def remove_columnar_months(directory: Path,
+                           municipal: str,
+                           months: Iterable[Tuple[int, int]],
+                           federal_region: Optional[str] = None,
+                           output_format: str = "parquet") -> None:
+    """Remove the months from the output of a subregion
+
+    The parts of the months written by ``write_columnar(..., by_month=True)`` are removed,
+    the other parts of the same years are written again without the crashes of the months
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    months = set(months)
+    for year in sorted({year for year, _ in months}):
+        removed = set()
+        crashes_dir = columnar_partition(directory, "crashes", federal_region) / f"year={year}"
+        for path in columnar_parts(crashes_dir, municipal, output_format, by_month=False):
+            table = read_columnar_part(path, output_format)
+            removed.update(crash_id for crash_id, crash_date in zip(table["id"].to_pylist(), table["date"].to_pylist())
+                           if (crash_date.year, crash_date.month) in months)
+        for name in TABLE_NAMES:
+            year_dir = columnar_partition(directory, name, federal_region) / f"year={year}"
+            for path in columnar_parts(year_dir, municipal, output_format, by_month=True):
+                part_year, part_month = path.name[len(municipal) + 1:].split("-")[:2]
+                if (int(part_year), int(part_month)) in months:
+                    path.unlink()
+            if not removed:
+                continue
+            for path in columnar_parts(year_dir, municipal, output_format, by_month=False):
+                table = read_columnar_part(path, output_format)
+                kept = table.filter(pc.invert(pc.is_in(table["id" if name == "crashes" else "crash_id"],
+                                                       value_set=pa.array(sorted(removed), pa.int64()))))
+                if kept.num_rows == table.num_rows:
+                    continue
+                if kept.num_rows:
+                    write_columnar_part(kept, path, output_format)
+                else:
+                    path.unlink()
+
+
+def crash_months(crashes: List[CrashDataResponse]) -> List[Tuple[int, int]]:
+    """(year, month) of every month that has crashes in the responses"""
+    return sorted({(int(card.date[-4:]), int(card.date[3:5])) for crash in crashes for card in crash.crashes})
+
+
+def write_columnar_subregion(crashes: List[CrashDataResponse],
+                             directory: Path,
+                             municipal: str,
+                             federal_region: Optional[str] = None,
+                             output_format: str = "parquet",
+                             append: bool = False,
+                             months: Optional[Iterable[Tuple[int, int]]] = None) -> None:
+    """Write all responses of a subregion, replacing its previous output
+
+    With ``append`` only the ``months`` are replaced, the months that were requested again,
+    by default the months of the responses
+    """
+    if append:
+        remove_columnar_months(directory, municipal, crash_months(crashes) if months is None else months,
+                               federal_region, output_format)
+    else:
+        remove_columnar_parts(directory, municipal, federal_region, output_format)
+    for crash in crashes:
+        write_columnar(crash, directory, municipal=municipal, federal_region=federal_region,
+                       output_format=output_format, by_month=append)
+
+
+def response_part_name(crash: CrashDataResponse) -> str:
+    """Years of the crashes in a response, with the first card appended if the response is not the first page"""
+    years = sorted({card.date[-4:] for card in crash.crashes})
+    name = years[0] if len(years) == 1 else f"{years[0]}-{years[-1]}"
+    return f"{name}_{crash.start}" if crash.start else name
+
+
+def crash_to_excel_bytes(crash: CrashDataResponse) -> bytes:
+    """Render a response into an in-memory xlsx workbook with crashes, vehicles and participants sheets"""
+    return frames_to_excel_bytes(crash_to_dataframes(crash))
+
+
+def frames_to_excel_bytes(frames: Frames) -> bytes:
+    """Render the crashes, vehicles and participants tables into an in-memory xlsx workbook"""
+    parsed_crashes, vehicles, participants = frames
+    excel_memory = BytesIO()
+    with default_metrics().timer("render"):
+        with ExcelWriter(excel_memory) as writer:  # type: ignore
+            parsed_crashes.to_excel(writer, sheet_name="crashes")
+            vehicles.to_excel(writer, sheet_name="vehicles")
+            participants.to_excel(writer, sheet_name="participants")
+    return excel_memory.getvalue()
+
+
+def _render_in_worker(crash: CrashDataResponse,
+                      labels: Optional[Dict[str, str]] = None) -> Tuple[bytes, Metrics]:
+    """crash_to_excel_bytes in a process pool worker, the metrics recorded by it are sent back to the parent"""
+    metrics = Metrics()
+    previous = set_default_metrics(metrics)
+    try:
+        with labelled(**(labels or {})):
+            return crash_to_excel_bytes(crash), metrics
+    finally:
+        set_default_metrics(previous)
+
+
+def render_workbooks(workbooks: Iterable[Tuple[str, CrashDataResponse]],
+                     workers: int = 1) -> Iterator[Tuple[str, bytes]]:
+    """Render the (name, response) pairs into xlsx workbooks, the names are yielded back in the same order
+
+    openpyxl is CPU bound, with more than one worker the workbooks are rendered in a process pool.
+    At most ``2 * workers`` workbooks are in flight, the pairs are taken from ``workbooks`` lazily.
+
+    Parameters
+    ----------
+    workbooks : Iterable[Tuple[str, CrashDataResponse]]
+        name of the workbook in the archive and the response to render into it
+    workers : int
+        amount of processes rendering the workbooks, the workbooks are rendered in this process if 1
+    """
+    if workers <= 1:
+        for name, crash in workbooks:
+            yield name, crash_to_excel_bytes(crash)
+        return
+    metrics = default_metrics()
+
+    def rendered(future: concurrent.futures.Future) -> bytes:
+        workbook, worker_metrics = future.result()
+        metrics.merge(worker_metrics)
+        return workbook
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight: Deque[Tuple[str, concurrent.futures.Future]] = deque()
+        for name, crash in workbooks:
+            in_flight.append((name, executor.submit(_render_in_worker, crash, current_labels())))
+            if len(in_flight) >= 2 * workers:
+                name, future = in_flight.popleft()
+                yield name, rendered(future)
+        while in_flight:
+            name, future = in_flight.popleft()
+            yield name, rendered(future)
+
+
+# names of the workbooks made by response_part_name and months_part_name
+MONTHS_PART = re.compile(r"(\d{4})-(\d{2})_(\d{4})-(\d{2})(?:_\d+)?\.xlsx")
+YEARS_PART = re.compile(r"(\d{4})(?:-(\d{4}))?(?:_\d+)?\.xlsx")
+# directory of the runs appended before the archives were rewritten
+DATED_RUN = re.compile(r"\d{4}-\d{2}-\d{2}/")
+
+
+def months_part_name(crash: CrashDataResponse) -> str:
+    """First and last month of the crashes in a response, with the first card appended like in response_part_name"""
+    months = crash_months([crash])
+    name = f"{months[0][0]}-{months[0][1]:02d}_{months[-1][0]}-{months[-1][1]:02d}"
+    return f"{name}_{crash.start}" if crash.start else name
+
+
+def workbook_months(name: str) -> Optional[Tuple[str, MonthKey, MonthKey]]:
+    """Prefix of the part name of a workbook and the first and the last month it may contain, None if unknown"""
+    match = MONTHS_PART.search(name)
+    if match and match.end() == len(name):
+        first_year, first_month, last_year, last_month = map(int, match.groups())
+        return name[:match.start()], (first_year, first_month), (last_year, last_month)
+    match = YEARS_PART.search(name)
+    if match and match.end() == len(name):
+        first_year, last_year = match.group(1), match.group(2) or match.group(1)
+        return name[:match.start()], (int(first_year), 1), (int(last_year), 12)
+    return None
+
+
+def workbook_without_months(workbook: bytes, months: Iterable[MonthKey]) -> Optional[Tuple[bytes, List[MonthKey]]]:
+    """The workbook without the crashes of the months and the months left in it, None if no crashes are left
+
+    The same workbook is returned if it has no crashes in the months
+    """
+    from pandas import read_excel
+
+    months = set(months)
+    sheets = {name: frame.reset_index(drop=True)
+              for name, frame in read_excel(BytesIO(workbook), sheet_name=None, index_col=0).items()}
+    crashes, vehicles, participants = (sheets[name] for name in TABLE_NAMES)
+    dates = to_datetime(crashes["date"], format="%d.%m.%Y")
+    removed = Series([(crash_date.year, crash_date.month) in months for crash_date in dates], dtype=bool)
+    if not removed.any():
+        return workbook, sorted({(crash_date.year, crash_date.month) for crash_date in dates})
+    if removed.all():
+        return None
+    ids = set(crashes["id"][removed])
+    kept = crashes[~removed].reset_index(drop=True)
+    frames = (kept,
+              vehicles[~vehicles["crash_id"].isin(ids)].reset_index(drop=True),
+              participants[~participants["crash_id"].isin(ids)].reset_index(drop=True))
+    return frames_to_excel_bytes(frames), sorted({(crash_date.year, crash_date.month)
+                                                  for crash_date in dates[~removed]})
+
+
+def write_workbooks(archive_name: str,
+                    workbooks: Iterable[Tuple[str, CrashDataResponse]],
+                    workers: int = 1,
+                    append: bool = False,
+                    replaced: Optional[Dict[str, List[MonthKey]]] = None) -> None:
+    """Pack the rendered workbooks into a zip archive
+
+    With ``append`` the workbooks of the previous runs are kept, the archive is written again
+    with the new workbooks and without the replaced months: ``replaced`` maps a directory of the archive
+    to the months whose crashes are removed from the previous workbooks in it. ``replaced`` may be filled
+    while ``workbooks`` is consumed, the previous workbooks are only copied after that.
+    A previous workbook with the same name as a new one is replaced as a whole.
+    """
+    if not append or not Path(archive_name).exists():
+        with zipfile.ZipFile(archive_name, "w") as archive:
+            for name, workbook in render_workbooks(workbooks, workers):
+                archive.writestr(name, workbook)
+        return
+    replaced = replaced if replaced is not None else {}
+    tmp = f"{archive_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with zipfile.ZipFile(tmp, "w") as archive:
+            for name, workbook in render_workbooks(workbooks, workers):
+                archive.writestr(name, workbook)
+            new_names = set(archive.namelist())
+            written = set(new_names)
+            with zipfile.ZipFile(archive_name) as previous:
+                for entry in previous.infolist():
+                    name = entry.filename
+                    dated = DATED_RUN.match(name)
+                    if dated:
+                        name = name[dated.end():]
+                    if name in new_names or entry.is_dir():
+                        continue
+                    workbook = previous.read(entry)
+                    months = replaced.get(name[:name.rfind("/") + 1])
+                    span = workbook_months(name)
+                    if months and (span is None or any(span[1] <= month <= span[2] for month in months)):
+                        kept = workbook_without_months(workbook, months)
+                        if kept is None:
+                            continue
+                        filtered, kept_months = kept
+                        if span is not None and filtered is not workbook:
+                            (first_year, first_month), (last_year, last_month) = kept_months[0], kept_months[-1]
+                            name = f"{span[0]}{first_year}-{first_month:02d}_{last_year}-{last_month:02d}.xlsx"
+                        workbook = filtered
+                    stem, copy = name[:-len(".xlsx")], 1
+                    while name in written:
+                        name = f"{stem}_{copy}.xlsx"
+                        copy += 1
+                    archive.writestr(name, workbook)
+                    written.add(name)
+        os.replace(tmp, archive_name)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def subregion_codes(country: Optional[Country]) -> Dict[Tuple[str, str], Optional[str]]:
+    """OKATO codes of the subregions of the country by the names of their federal region and their own"""
+    if country is None:
+        return {}
+    return {
+        (federal.name, district.name): district.okato
+        for federal in country.regions
+        for district in federal.districts
+    }
+
+
+def replaced_months(crashes: List[CrashDataResponse],
+                    okato: Optional[str] = None,
+                    sync: Optional["SyncState"] = None) -> List[MonthKey]:
+    """Months of a subregion replaced by an appending run
+
+    These are the months of the responses and the months the sync requested again,
+    so the months without any crashes left are replaced as well
+    """
+    months = set(crash_months(crashes))
+    if sync is not None and okato is not None:
+        months.update(sync.fetched_months(okato))
+    return sorted(months)
+
+
+def synced(sync: Optional["SyncState"], okato: Optional[str]) -> None:
+    """Advance the high-water mark of a subregion once its output is written"""
+    if sync is not None and okato is not None:
+        sync.commit(okato)
 
 
 def package_crashes_subregion(crashes: List[CrashDataResponse],
                               filename: Optional[str] = None,
-                              to_archive=False) -> None:
+                              to_archive=False,
+                              output_format: str = "xlsx",
+                              workers: int = 1,
+                              append: bool = False,
+                              okato: Optional[str] = None,
+                              sync: Optional["SyncState"] = None) -> None:
     """
 
     """
+    if not crashes and not filename:
+        return
     if not filename:
         filename = f"{crashes[0].region_name}"
-    with zipfile.ZipFile(f"{filename}.zip", "w") as archive:
-        for crash in crashes:
-            parsed_crashes, vehicles, participants = crash_to_dataframes(crash)
-            excel_memory = BytesIO()
-            with ExcelWriter(excel_memory) as writer:  # type: ignore
-                parsed_crashes.to_excel(writer, sheet_name="crashes")
-                vehicles.to_excel(writer, sheet_name="vehicles")
-                participants.to_excel(writer, sheet_name="participants")
-            excel_memory.seek(0)
-            archive.writestr(f"{filename}_{crash.crashes[0].date[-4:]}.xlsx", excel_memory.read())
-
-
-def package_crashes_fed_region(federal_data: Dict[str, List[CrashDataResponse]], federal_region: str):
-    with zipfile.ZipFile(f"{federal_region}.zip", "w") as archive:
+    months = replaced_months(crashes, okato, sync)
+    with labelled(okato=okato):
+        if output_format == "sqlite":
+            from parser_gibdd.warehouse import CrashWarehouse
+
+            with CrashWarehouse(f"{filename}.sqlite3") as warehouse:
+                warehouse.upsert(crashes, subregion=filename, okato=okato, replace_months=append, months=months)
+        elif output_format != "xlsx":
+            write_columnar_subregion(crashes, Path(filename), municipal=filename, output_format=output_format,
+                                     append=append, months=months)
+        else:
+            part_name = months_part_name if append else response_part_name
+            write_workbooks(
+                f"{filename}.zip",
+                ((f"{filename}_{part_name(crash)}.xlsx", crash) for crash in crashes),
+                workers,
+                append,
+                {"": months}
+            )
+    synced(sync, okato)
+
+
+def package_crashes_fed_region(federal_data: Dict[str, List[CrashDataResponse]],
+                               federal_region: str,
+                               output_format: str = "xlsx",
+                               workers: int = 1,
+                               append: bool = False,
+                               country: Optional[Country] = None,
+                               sync: Optional["SyncState"] = None):
+    if output_format == "sqlite":
+        write_warehouse(((federal_region, municipal, crashes) for municipal, crashes in federal_data.items()),
+                        federal_region, country, append, sync)
+        return
+    codes = subregion_codes(country)
+    if output_format != "xlsx":
         for municipal, crashes in federal_data.items():
-            for crash in crashes:
-                parsed_crashes, vehicles, participants = crash_to_dataframes(crash)
-                excel_memory = BytesIO()
-                with ExcelWriter(excel_memory) as writer:
-                    parsed_crashes.to_excel(writer, sheet_name="crashes")
-                    vehicles.to_excel(writer, sheet_name="vehicles")
-                    participants.to_excel(writer, sheet_name="participants")
-                excel_memory.seek(0)
-                archive.writestr(f"{municipal}/_{crash.crashes[0].date[-4:]}.xlsx", excel_memory.read())
+            okato = codes.get((federal_region, municipal))
+            with labelled(okato=okato):
+                write_columnar_subregion(crashes, Path(federal_region), municipal=municipal,
+                                         federal_region=federal_region, output_format=output_format, append=append,
+                                         months=replaced_months(crashes, okato, sync))
+            synced(sync, okato)
+        return
+    part_name = months_part_name if append else response_part_name
+    replaced: Dict[str, List[MonthKey]] = {}
+
+    def workbooks():
+        for municipal, crashes in federal_data.items():
+            okato = codes.get((federal_region, municipal))
+            replaced[f"{municipal}/"] = replaced_months(crashes, okato, sync)
+            # the workbooks are rendered while the generator waits at yield, so they get the labels of the block
+            with labelled(okato=okato):
+                for crash in crashes:
+                    yield f"{municipal}/_{part_name(crash)}.xlsx", crash
+
+    write_workbooks(f"{federal_region}.zip", workbooks(), workers, append, replaced)
+    for municipal in federal_data:
+        synced(sync, codes.get((federal_region, municipal)))
+
+
+def write_warehouse(country_stream: Iterable[Tuple[str, str, List[CrashDataResponse]]],
+                    filename: str,
+                    country: Optional[Country] = None,
+                    append: bool = False,
+                    sync: Optional["SyncState"] = None) -> None:
+    """Upsert the (federal region, subregion, responses) of the stream into the ``<filename>.sqlite3`` warehouse"""
+    from parser_gibdd.warehouse import CrashWarehouse
+
+    codes = subregion_codes(country)
+    with CrashWarehouse(f"{filename}.sqlite3", country=country) as warehouse:
+        for federal_name, municipal, crashes in country_stream:
+            okato = codes.get((federal_name, municipal))
+            warehouse.upsert(crashes, federal_region=federal_name, subregion=municipal, replace_months=append,
+                             months=replaced_months(crashes, okato, sync))
+            synced(sync, okato)
 
 
 country_return_type = Dict[FederalRegionName, Dict[RegionName, List[CrashDataResponse]]]
+country_stream_type = Iterable[Tuple[FederalRegionName, RegionName, List[CrashDataResponse]]]
+
 
+def package_crashes_country(country_data: country_return_type,
+                            output_format: str = "xlsx",
+                            workers: int = 1,
+                            append: bool = False,
+                            country: Optional[Country] = None,
+                            sync: Optional["SyncState"] = None):
+    package_crashes_stream(
+        (
+            (federal_name, municipal, crashes)
+            for federal_name, federal_region in country_data.items()
+            for municipal, crashes in federal_region.items()
+        ),
+        output_format=output_format,
+        workers=workers,
+        append=append,
+        country=country,
+        sync=sync
+    )
+
+
+def package_crashes_stream(country_stream: country_stream_type,
+                           filename: str = "Российская Федерация",
+                           output_format: str = "xlsx",
+                           workers: int = 1,
+                           append: bool = False,
+                           country: Optional[Country] = None,
+                           sync: Optional["SyncState"] = None) -> None:
+    """Write every subregion as soon as it arrives from the stream
+
+    Only the subregion that is being written is held in memory, the stream can be a lazy crawl
+    like :func:`parser_gibdd.api.crashes.iter_country_crashes`.
+    xlsx workbooks are packed into ``<filename>.zip``, parquet and arrow files are written
+    into the ``<filename>`` directory partitioned by federal region and year.
+    Workbooks are rendered by ``workers`` processes, see :func:`render_workbooks`.
+    With ``append`` the output of the previous runs is kept and only the replaced months are written again,
+    see :func:`replaced_months`: the months the ``sync`` requested again, the subregions are found in it
+    by their OKATO codes from ``country``.
+    sqlite output is upserted into the ``<filename>.sqlite3`` warehouse, see :mod:`parser_gibdd.warehouse`,
+    the subregions are tagged with their OKATO codes from ``country``.
+    The high-water marks of the ``sync`` advance only after a subregion is written, see :meth:`SyncState.commit`.
+    """
+    if output_format == "sqlite":
+        write_warehouse(country_stream, filename, country, append, sync)
+        return
+    codes = subregion_codes(country)
+    if output_format != "xlsx":
+        for federal_name, municipal, crashes in country_stream:
+            okato = codes.get((federal_name, municipal))
+            with labelled(okato=okato):
+                write_columnar_subregion(crashes, Path(filename), municipal=municipal,
+                                         federal_region=federal_name, output_format=output_format, append=append,
+                                         months=replaced_months(crashes, okato, sync))
+            synced(sync, okato)
+            logger.info(f"Subregion {municipal} of {federal_name} written to {filename}")
+        return
+    part_name = months_part_name if append else response_part_name
+    replaced: Dict[str, List[MonthKey]] = {}
+    packed: List[Optional[str]] = []
 
-def package_crashes_country(country_data: country_return_type):
-    with zipfile.ZipFile(f"Российская Федерация.zip", "w") as archive:
-        for federal_name, federal_region in country_data:
-            for municipal, crashes in federal_region.items():
+    def workbooks():
+        for federal_name, municipal, crashes in country_stream:
+            okato = codes.get((federal_name, municipal))
+            replaced[f"{federal_name}/{municipal}/"] = replaced_months(crashes, okato, sync)
+            # the workbooks are rendered while the generator waits at yield, so they get the labels of the block
+            with labelled(okato=okato):
                 for crash in crashes:
-                    parsed_crashes, vehicles, participants = crash_to_dataframes(crash)
-                    excel_memory = BytesIO()
-                    with ExcelWriter(excel_memory) as writer:
-                        parsed_crashes.to_excel(writer, sheet_name="crashes")
-                        vehicles.to_excel(writer, sheet_name="vehicles")
-                        participants.to_excel(writer, sheet_name="participants")
-                    excel_memory.seek(0)
-                    archive.writestr(f"{federal_name}/{municipal}/{crash.crashes[0].date[-4:]}.xlsx",
-                                     excel_memory.read())
+                    yield f"{federal_name}/{municipal}/{part_name(crash)}.xlsx", crash
+            packed.append(okato)
+            logger.info(f"Subregion {municipal} of {federal_name} packed into {filename}.zip")
+
+    write_workbooks(f"{filename}.zip", workbooks(), workers, append, replaced)
+    # the archive is only replaced once all of the subregions are packed
+    for okato in packed:
+        synced(sync, okato)
+
+
+def unit_part_name(unit: CrawlUnit, crash: CrashDataResponse) -> str:
+    """Months of a crawl unit, with the first card appended if the response is not the first page"""
+    name = f"{unit.first[0]}-{unit.first[1]:02d}_{unit.last[0]}-{unit.last[1]:02d}"
+    return f"{name}_{crash.start}" if crash.start else name
+
+
+def package_crashes_unit(crashes: List[CrashDataResponse],
+                         unit: CrawlUnit,
+                         filename: str,
+                         output_format: str = "parquet",
+                         federal_region: Optional[str] = None,
+                         municipal: Optional[str] = None) -> None:
+    """Write the crashes of a single crawl unit into its own parts of the ``<filename>`` output
+
+    Used by the workers of a distributed crawl, see :mod:`parser_gibdd.workqueue`, which write
+    into the same output at the same time. parquet and arrow parts are named after the months like
+    ``package_crashes_stream(..., append=True)`` does, so the months of the unit replace their previous parts.
+    xlsx workbooks are not packed into an archive, every response is written into
+    ``<filename>/<federal region>/<subregion>/<first month>_<last month>.xlsx``.
+    """
+    municipal = municipal or unit.subregion
+    if output_format == "sqlite":
+        raise ValueError("Units are written into a partitioned output, use xlsx, parquet or arrow")
+    if output_format != "xlsx":
+        write_columnar_subregion(crashes, Path(filename), municipal=municipal, federal_region=federal_region,
+                                 output_format=output_format, append=True, months=unit.months)
+        return
+    directory = Path(filename, *([federal_region] if federal_region else []), municipal)
+    directory.mkdir(parents=True, exist_ok=True)
+    for crash in crashes:
+        path = directory / f"{unit_part_name(unit, crash)}.xlsx"
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(crash_to_excel_bytes(crash))
+        os.replace(tmp, path)
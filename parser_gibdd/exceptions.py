@@ -16,3 +16,7 @@ class RegionNotFoundError(Exception):
 
 class CrashesNotFoundError(Exception):
     pass
+
+
+class RecordingNotFoundError(Exception):
+    pass
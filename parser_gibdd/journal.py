@@ -0,0 +1,98 @@
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from pydantic import parse_raw_as
+
+from parser_gibdd.api.planner import CrawlUnit
+from parser_gibdd.jsonlib import loads
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+from parser_gibdd.models.gibdd.records import CrashDataResponseRecord
+from parser_gibdd.models.gibdd.views import CrashDataResponseView
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlJournal:
+    """Durable record of the finished crawl units kept in SQLite
+
+    The results of every finished unit are stored together with it, so an interrupted crawl
+    can be continued from where it stopped without losing the data that was already collected.
+
+    Parameters
+    ----------
+    path : str
+        path to the SQLite database of the journal
+    raw : bool
+        return the stored results as unvalidated views instead of the models, see GibddAPI
+    compact : bool
+        return the stored results as compact records, see GibddAPI
+    """
+
+    def __init__(self, path: str = "./cache/crawl_journal.sqlite3", raw: bool = False, compact: bool = False):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.raw = raw
+        self.compact = compact
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS crawl_units ("
+            " region TEXT NOT NULL,"
+            " subregion TEXT NOT NULL,"
+            " first_year INTEGER NOT NULL,"
+            " first_month INTEGER NOT NULL,"
+            " last_year INTEGER NOT NULL,"
+            " last_month INTEGER NOT NULL,"
+            " responses BLOB NOT NULL,"
+            " finished_at REAL NOT NULL,"
+            " PRIMARY KEY (region, subregion, first_year, first_month, last_year, last_month))"
+        )
+
+    @staticmethod
+    def _key(unit: CrawlUnit) -> Tuple[str, str, int, int, int, int]:
+        return str(unit.region), str(unit.subregion), *unit.first, *unit.last
+
+    def get(self, unit: CrawlUnit) -> Optional[List[CrashDataResponse]]:
+        """Results of a finished unit, None if the unit was not finished yet"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT responses FROM crawl_units"
+                " WHERE region = ? AND subregion = ?"
+                " AND first_year = ? AND first_month = ? AND last_year = ? AND last_month = ?",
+                self._key(unit)
+            ).fetchone()
+        if row is None:
+            return None
+        if self.compact:
+            return [CrashDataResponseRecord.from_raw(each) for each in loads(zlib.decompress(row[0]))]  # type: ignore
+        if self.raw:
+            return [CrashDataResponseView(each) for each in loads(zlib.decompress(row[0]))]  # type: ignore
+        return parse_raw_as(List[CrashDataResponse], zlib.decompress(row[0]))
+
+    def record(self, unit: CrawlUnit, responses: List[CrashDataResponse]) -> None:
+        """Mark the unit as finished"""
+        serialized = f"[{','.join(response.json(by_alias=True) for response in responses)}]"
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO crawl_units VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (*self._key(unit), zlib.compress(serialized.encode()), time.time())
+            )
+
+    def finished(self) -> int:
+        """Amount of the finished units"""
+        with self._lock:
+            return self._connection.execute("SELECT count(*) FROM crawl_units").fetchone()[0]
+
+    def reset(self) -> None:
+        """Forget all finished units, used when a new crawl is started"""
+        with self._lock:
+            self._connection.execute("DELETE FROM crawl_units")
+
+    def close(self) -> None:
+        self._connection.close()
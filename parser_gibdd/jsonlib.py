@@ -0,0 +1,39 @@
+"""JSON decoding with the fastest available backend
+
+orjson or msgspec are used if one of them is installed, the standard library json otherwise.
+Decoding errors of every backend are raised as ValueError.
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover
+    msgspec = None
+
+if orjson is not None:
+    BACKEND = "orjson"
+
+    def loads(data: Union[bytes, str]) -> Any:
+        return orjson.loads(data)
+
+elif msgspec is not None:  # pragma: no cover
+    BACKEND = "msgspec"
+    _decoder = msgspec.json.Decoder()
+
+    def loads(data: Union[bytes, str]) -> Any:
+        try:
+            return _decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+else:  # pragma: no cover
+    BACKEND = "json"
+
+    def loads(data: Union[bytes, str]) -> Any:
+        return json.loads(data)
@@ -0,0 +1,243 @@
+"""Timers and counters of the crawl stages
+
+Stages timed by the crawl and the conversion:
+
+``throttle``
+    waiting for a slot and a token of the throttle before sending a request
+``request``
+    the round trip of a request sent to the network, from sending it to downloading the body of the response
+``decode``
+    decoding the json of a response
+``validate``
+    building the models (or the raw views) from the decoded json
+``serialize``
+    dumping the models validated by a parse pool worker back into json, see :mod:`parser_gibdd.api.parsing`
+``dataframe``
+    flattening a response into the crashes, vehicles and participants tables
+``render``
+    writing the tables into an xlsx workbook
+``write``
+    writing the tables into parquet or arrow files
+
+Counters: ``response_bytes`` and ``cards`` of every response, ``cached_responses`` for the responses
+that did not come from the network. Both the request and the output stages are labelled with the ``okato``
+of the subregion, the names of the subregions are not unique.
+"""
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_labels: contextvars.ContextVar = contextvars.ContextVar("metrics_labels", default=())
+
+
+def _merged(labels: Dict[str, str]) -> Labels:
+    """Labels of the enclosing ``labelled`` blocks updated with the labels, the labels that are None are left out"""
+    current = _labels.get()
+    labels = {key: str(value) for key, value in labels.items() if value is not None}
+    if not labels:
+        return current
+    return tuple(sorted({**dict(current), **labels}.items()))
+
+
+@contextmanager
+def labelled(**labels: Optional[str]) -> Iterator[None]:
+    """Label everything recorded inside of the block in this thread or task"""
+    token = _labels.set(_merged(labels))
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def current_labels() -> Dict[str, str]:
+    """Labels of the enclosing ``labelled`` blocks, to label the records of another thread or process the same way"""
+    return dict(_labels.get())
+
+
+class TimerStats:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self, count: int = 0, total: float = 0.0, maximum: float = 0.0):
+        self.count = count
+        self.total = total
+        self.max = maximum
+
+    def add(self, count: int, total: float, maximum: float) -> None:
+        self.count += count
+        self.total += total
+        self.max = max(self.max, maximum)
+
+
+class Metrics:
+    """Thread safe registry of the timers and the counters, keyed by their name and labels"""
+
+    def __init__(self):
+        self.started = time.time()
+        self._timers: Dict[Tuple[str, Labels], TimerStats] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # sent back from the process pool workers, see Metrics.merge
+        return {"started": self.started, "timers": self._timers, "counters": self._counters}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.started = state["started"]
+        self._timers = state["timers"]
+        self._counters = state["counters"]
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        key = (name, _merged(labels))
+        with self._lock:
+            self._timers.setdefault(key, TimerStats()).add(1, seconds, seconds)
+
+    def count(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, _merged(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def merge(self, other: "Metrics") -> None:
+        """Add the records of another registry, e.g. the one of a process pool worker"""
+        with self._lock:
+            for key, stats in other._timers.items():
+                self._timers.setdefault(key, TimerStats()).add(stats.count, stats.total, stats.max)
+            for key, value in other._counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def __bool__(self) -> bool:
+        return bool(self._timers or self._counters)
+
+    def _totals(self, label: Optional[str] = None) -> Tuple[Dict[Tuple[str, str], TimerStats],
+                                                            Dict[Tuple[str, str], float]]:
+        """Timers and counters summed up over all labels except ``label``"""
+        timers: Dict[Tuple[str, str], TimerStats] = {}
+        counters: Dict[Tuple[str, str], float] = {}
+        with self._lock:
+            for (name, labels), stats in self._timers.items():
+                timers.setdefault((name, dict(labels).get(label, "") if label else ""), TimerStats()).add(
+                    stats.count, stats.total, stats.max)
+            for (name, labels), value in self._counters.items():
+                key = (name, dict(labels).get(label, "") if label else "")
+                counters[key] = counters.get(key, 0) + value
+        return timers, counters
+
+    def summary(self, top: int = 10) -> str:
+        """Table of the stages and of the ``top`` subregions that took the longest to download"""
+        timers, counters = self._totals()
+        elapsed = time.time() - self.started
+        lines = [f"{'stage':12} {'count':>8} {'total s':>10} {'mean ms':>10} {'max ms':>10} {'share':>6}"]
+        for (name, _), stats in sorted(timers.items(), key=lambda item: -item[1].total):
+            lines.append(f"{name:12} {stats.count:8d} {stats.total:10.2f} {stats.total / stats.count * 1000:10.1f} "
+                         f"{stats.max * 1000:10.1f} {stats.total / max(elapsed, 1e-9):6.0%}")
+        size = counters.get(("response_bytes", ""), 0)
+        cards = counters.get(("cards", ""), 0)
+        lines.append(f"{elapsed:.1f}s wall time, {size / 1024 ** 2:.1f} MiB and {int(cards)} cards downloaded "
+                     f"({size / 1024 ** 2 / max(elapsed, 1e-9):.2f} MiB/s, {cards / max(elapsed, 1e-9):.1f} cards/s), "
+                     f"{int(counters.get(('cached_responses', ''), 0))} responses from the caches")
+        by_okato, okato_counters = self._totals("okato")
+        slowest = sorted(((okato, stats) for (name, okato), stats in by_okato.items() if name == "request" and okato),
+                         key=lambda item: -item[1].total)[:top]
+        if slowest:
+            lines.append(f"{'okato':12} {'requests':>8} {'total s':>10} {'MiB':>10} {'cards':>10}")
+            for okato, stats in slowest:
+                lines.append(f"{okato:12} {stats.count:8d} {stats.total:10.2f} "
+                             f"{okato_counters.get(('response_bytes', okato), 0) / 1024 ** 2:10.2f} "
+                             f"{int(okato_counters.get(('cards', okato), 0)):10d}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _prometheus_labels(labels: Labels) -> str:
+        if not labels:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+    def prometheus(self, prefix: str = "gibdd") -> str:
+        """Prometheus text exposition format, timers are summaries without quantiles"""
+        lines: List[str] = []
+        with self._lock:
+            timers = sorted(self._timers.items())
+            counters = sorted(self._counters.items())
+        for name in sorted({name for (name, _), _ in timers}):
+            metric = f"{prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for (timer_name, labels), stats in timers:
+                if timer_name == name:
+                    lines.append(f"{metric}_count{self._prometheus_labels(labels)} {stats.count}")
+                    lines.append(f"{metric}_sum{self._prometheus_labels(labels)} {stats.total:.6f}")
+        for name in sorted({name for (name, _), _ in counters}):
+            metric = f"{prefix}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (counter_name, labels), value in counters:
+                if counter_name == name:
+                    lines.append(f"{metric}{self._prometheus_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def json_lines(self) -> Iterator[str]:
+        """One json object per timer and counter"""
+        with self._lock:
+            timers = sorted(self._timers.items())
+            counters = sorted(self._counters.items())
+        for (name, labels), stats in timers:
+            yield json.dumps({"metric": name, "type": "timer", "labels": dict(labels), "count": stats.count,
+                              "seconds": round(stats.total, 6), "max_seconds": round(stats.max, 6)},
+                             ensure_ascii=False)
+        for (name, labels), value in counters:
+            yield json.dumps({"metric": name, "type": "counter", "labels": dict(labels), "value": value},
+                             ensure_ascii=False)
+
+    def write(self, path: str, output_format: str = "prometheus") -> None:
+        """Write the metrics into a file in the ``prometheus`` or ``jsonl`` format"""
+        with open(path, "w", encoding="utf-8") as output:
+            if output_format == "jsonl":
+                output.writelines(f"{line}\n" for line in self.json_lines())
+            else:
+                output.write(self.prometheus())
+
+
+_default_metrics: Optional[Metrics] = None
+_default_metrics_lock = threading.Lock()
+
+
+def default_metrics() -> Metrics:
+    """Process-wide Metrics, created on the first use and shared by the crawl and the conversion"""
+    global _default_metrics
+    with _default_metrics_lock:
+        if _default_metrics is None:
+            _default_metrics = Metrics()
+        return _default_metrics
+
+
+def set_default_metrics(metrics: Optional[Metrics]) -> Optional[Metrics]:
+    """Replace the process-wide Metrics, returns the previous one"""
+    global _default_metrics
+    with _default_metrics_lock:
+        previous, _default_metrics = _default_metrics, metrics
+    return previous
+
+
+def record_response(size: int, seconds: float, from_cache: bool) -> None:
+    """Record the download of a response of ``size`` bytes into the process-wide Metrics
+
+    ``seconds`` is the round trip of the request, the responses from the caches have none
+    """
+    metrics = default_metrics()
+    metrics.count("response_bytes", size)
+    if from_cache:
+        metrics.count("cached_responses")
+    else:
+        metrics.observe("request", seconds)
@@ -0,0 +1,199 @@
+"""Compact records of the crash data for the country-scale crawls
+
+A pydantic model keeps its values in a ``__dict__`` and a ``__fields_set__`` set, and every card
+repeats the same strings: the weather, the road category, the light conditions and so on come
+from small vocabularies. The records keep the values of the same fields in ``__slots__``,
+every string is interned and the lists of strings become tuples shared by all equal lists,
+the nested lists of models become tuples of records.
+
+Records are built from the validated models, or from the decoded json like the raw views
+(see :mod:`parser_gibdd.models.gibdd.views`) with the plain values coerced to the field types
+and nothing validated. They expose the same field names as the models, so everything reading
+the models by attribute reads the records too.
+"""
+import json
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON
+from pydantic.json import pydantic_encoder
+
+from parser_gibdd.models.gibdd.crash import CrashDataResponse, CrashCard, CrashInfo
+from parser_gibdd.models.gibdd.participant import DriverInfo, ParticipantInfo
+from parser_gibdd.models.gibdd.vehicle import VehicleInfo
+from parser_gibdd.models.gibdd.views import Coercion
+
+# kinds of the values
+PLAIN, STRING, STRINGS, RECORD, RECORDS = range(5)
+
+# field name, alias, default, kind, record class of the nested models, coercion of the decoded plain values
+FieldSpec = Tuple[str, str, Any, int, Optional[Type["Record"]], Optional[Coercion]]
+
+# equal tuples of strings share a single instance, the vocabulary stops growing at this size
+MAX_VOCABULARY = 1 << 16
+
+_vocabulary: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+_vocabulary_lock = threading.Lock()
+
+
+def intern_strings(values: List[Any]) -> Tuple[Any, ...]:
+    """Tuple of the interned strings, the same instance for all equal lists while the vocabulary is not full"""
+    interned = tuple(sys.intern(value) if type(value) is str else value for value in values)
+    shared = _vocabulary.get(interned)
+    if shared is not None:
+        return shared
+    if len(_vocabulary) >= MAX_VOCABULARY:
+        return interned
+    with _vocabulary_lock:
+        return _vocabulary.setdefault(interned, interned)
+
+
+class Record:
+    """Slotted record of ``model_class``, see :func:`record_of`"""
+    __slots__ = ()
+    model_class: Type[BaseModel]
+    specs: List[FieldSpec]
+
+    @classmethod
+    def from_model(cls, model: BaseModel) -> "Record":
+        """Record of a validated model, its values already have the field types"""
+        record = object.__new__(cls)
+        for name, _, _, kind, nested, _ in cls.specs:
+            value = getattr(model, name)
+            if value is None or kind == PLAIN:
+                pass
+            elif kind == STRING:
+                value = sys.intern(value)
+            elif kind == STRINGS:
+                value = intern_strings(value)
+            elif kind == RECORD:
+                value = nested.from_model(value)  # type: ignore
+            else:
+                value = tuple(nested.from_model(each) for each in value)  # type: ignore
+            object.__setattr__(record, name, value)
+        return record
+
+    @classmethod
+    def from_raw(cls, raw: Dict[str, Any]) -> "Record":
+        """Record of the decoded json, nothing is validated but the plain values are coerced like in the views"""
+        record = object.__new__(cls)
+        for name, alias, default, kind, nested, coerce in cls.specs:
+            value = raw.get(alias, default)
+            if value is None:
+                pass
+            elif kind == PLAIN:
+                value = coerce(value)  # type: ignore
+            elif kind == STRING:
+                value = coerce(value)  # type: ignore
+                if type(value) is str:
+                    value = sys.intern(value)
+            elif kind == STRINGS:
+                value = intern_strings(coerce(value))  # type: ignore
+            elif kind == RECORD:
+                value = nested.from_raw(value)  # type: ignore
+            else:
+                value = tuple(nested.from_raw(each) for each in value)  # type: ignore
+            object.__setattr__(record, name, value)
+        return record
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __getstate__(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, name) for name, *_ in type(self).specs)
+
+    def __setstate__(self, state: Tuple[Any, ...]) -> None:
+        for (name, *_), value in zip(type(self).specs, state):
+            object.__setattr__(self, name, value)
+
+    def to_raw(self) -> Dict[str, Any]:
+        """The values of the record keyed by the aliases, the lists and the records become lists and dicts"""
+        result = {}
+        for name, alias, _, kind, _, _ in type(self).specs:
+            value = getattr(self, name)
+            if value is not None:
+                if kind == STRINGS:
+                    value = list(value)
+                elif kind == RECORD:
+                    value = value.to_raw()
+                elif kind == RECORDS:
+                    value = [each.to_raw() for each in value]
+            result[alias] = value
+        return result
+
+    @property
+    def model(self) -> BaseModel:
+        """The validated model of the record, built on every access"""
+        return self.model_class.parse_obj(self.to_raw())
+
+    def dict(self, exclude: Optional[set] = None, by_alias: bool = False) -> Dict[str, Any]:
+        """Same as ``BaseModel.dict`` for the field names, the lists of strings stay tuples"""
+        result = {}
+        for name, alias, _, kind, _, _ in type(self).specs:
+            if exclude and name in exclude:
+                continue
+            value = getattr(self, name)
+            if value is not None and kind == RECORD:
+                value = value.dict(by_alias=by_alias)
+            elif value is not None and kind == RECORDS:
+                value = [each.dict(by_alias=by_alias) for each in value]
+            result[alias if by_alias else name] = value
+        return result
+
+    def json(self, by_alias: bool = False) -> str:
+        return json.dumps(self.to_raw() if by_alias else self.dict(), ensure_ascii=False, default=pydantic_encoder)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, Record):
+            return type(self) is type(other) and all(
+                getattr(self, name) == getattr(other, name) for name, *_ in type(self).specs
+            )
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name, *_ in type(self).specs)
+        return f"{type(self).__name__}({values})"
+
+
+_records: Dict[Type[BaseModel], Type[Record]] = {}
+
+
+def record_of(model_class: Type[BaseModel]) -> Type[Record]:
+    """Record class of a pydantic model, created once per model
+
+    Only the field shapes used by the gibdd models are supported: plain values, strings,
+    lists of strings, nested models and lists of nested models
+    """
+    if model_class in _records:
+        return _records[model_class]
+    specs: List[FieldSpec] = []
+    for name, field in model_class.__fields__.items():
+        nested, coerce = None, None
+        if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            if field.shape not in (SHAPE_SINGLETON, SHAPE_LIST):
+                raise TypeError(f"Field {model_class.__name__}.{name} can not be recorded")
+            nested = record_of(field.type_)
+            kind = RECORDS if field.shape == SHAPE_LIST else RECORD
+        elif field.type_ is str:
+            kind = STRINGS if field.shape == SHAPE_LIST else STRING
+            coerce = Coercion(field)
+        else:
+            kind = PLAIN
+            coerce = Coercion(field)
+        specs.append((name, field.alias, field.default, kind, nested, coerce))
+    record = type(f"{model_class.__name__}Record", (Record,), {
+        "__slots__": tuple(name for name, *_ in specs), "__module__": __name__,
+        "model_class": model_class, "specs": specs,
+    })
+    _records[model_class] = record
+    return record
+
+
+CrashDataResponseRecord = record_of(CrashDataResponse)
+CrashCardRecord = record_of(CrashCard)
+CrashInfoRecord = record_of(CrashInfo)
+VehicleInfoRecord = record_of(VehicleInfo)
+DriverInfoRecord = record_of(DriverInfo)
+ParticipantInfoRecord = record_of(ParticipantInfo)
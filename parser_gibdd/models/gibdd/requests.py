@@ -1,5 +1,5 @@
 from datetime import date
-from typing import List
+from typing import List, Tuple
 
 from pydantic import BaseModel, Field
 
@@ -30,6 +30,11 @@ class GibddDateString(str):
             f'MONTHS:{_date.month}.{_date.year}'
         )
 
+    def year_month(self) -> Tuple[int, int]:
+        """Inverse of from_year_month"""
+        month, year = self.split(':', 1)[1].split('.')
+        return int(year), int(month)
+
 
 class GibddDateListString(str):
     """Very stupid structure but that is the easiest way to implement the website's structure
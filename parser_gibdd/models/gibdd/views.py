@@ -0,0 +1,165 @@
+"""Lightweight read-only views over the decoded gibdd json
+
+Views expose the same field names as the models, the alias of every field is resolved
+when an attribute is read, nested models are wrapped into views of their own and nothing is validated.
+Plain values are coerced to the field types the way the models do it, e.g. the time of a crash is
+a ``datetime.time`` and not the decoded string, so the tables of the views and of the models are the same.
+They are meant for the trusted bulk exports where building and dumping every nested model
+only to get the dicts back is the most expensive part of the conversion.
+The full model is built on the first access to anything that is not a field, e.g. ``view.copy()``,
+or explicitly through ``view.model``.
+"""
+import json
+from itertools import chain
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, TypeVar
+
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON, ModelField
+from pydantic.json import pydantic_encoder
+
+from parser_gibdd.models.gibdd.crash import CrashDataResponse, CrashCard, CrashInfo
+from parser_gibdd.models.gibdd.participant import DriverInfo, ParticipantInfo
+from parser_gibdd.models.gibdd.vehicle import VehicleInfo
+
+ModelType = TypeVar("ModelType", bound=BaseModel)
+
+# field name -> (alias, default, view of the nested model, is a list of nested models, coercion of a plain value)
+FieldSpec = Tuple[str, Any, Optional[Type["ModelView"]], bool, Optional["Coercion"]]
+
+
+class Coercion:
+    """Coercion of the decoded json values of a plain field to the type of the field
+
+    Values that already have the type of the field, or lists of such values, are returned as they are,
+    the others are validated by the field. Nothing is validated by the views, so a value rejected
+    by the field is returned as it was decoded.
+    """
+    __slots__ = ("field", "expected", "many")
+
+    def __init__(self, field: ModelField):
+        self.field = field
+        self.expected = field.type_
+        self.many = field.shape == SHAPE_LIST
+
+    def __call__(self, value: Any) -> Any:
+        if value is None:
+            return value
+        if self.many:
+            if type(value) is list and all(type(each) is self.expected for each in value):
+                return value
+        elif type(value) is self.expected:
+            return value
+        coerced, errors = self.field.validate(value, {}, loc=self.field.alias)
+        return value if errors else coerced
+
+    def column(self, values: List[Any]) -> List[Any]:
+        """Coerced values of a whole column, the same list if nothing has to be coerced"""
+        types = set(map(type, values))
+        if self.many and types <= {list, type(None)}:
+            if set(map(type, chain.from_iterable(filter(None, values)))) <= {self.expected}:
+                return values
+        elif types <= {self.expected, type(None)}:
+            return values
+        return [self(value) for value in values]
+
+
+class ModelView:
+    """View over the decoded json of ``model_class``, see :func:`view_of`"""
+    __slots__ = ("_raw", "_model")
+    model_class: Type[BaseModel]
+    fields: Dict[str, FieldSpec]
+
+    def __init__(self, raw: Dict[str, Any]):
+        self._raw = raw
+        self._model: Optional[BaseModel] = None
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        spec = type(self).fields.get(name)
+        if spec is None:
+            return getattr(self.model, name)
+        alias, default, view, many, coerce = spec
+        value = self._raw.get(alias, default)
+        if view is None:
+            return coerce(value)
+        if value is None:
+            return value
+        return [view(each) for each in value] if many else view(value)
+
+    @property
+    def model(self) -> BaseModel:
+        """The validated model, built once on the first access"""
+        if self._model is None:
+            self._model = self.model_class.parse_obj(self._raw)
+        return self._model
+
+    @property
+    def raw(self) -> Dict[str, Any]:
+        return self._raw
+
+    def dict(self, exclude: Optional[Set[str]] = None, by_alias: bool = False) -> Dict[str, Any]:
+        """Same as ``BaseModel.dict``, the plain values are coerced to the field types"""
+        result = {}
+        for name, (alias, default, view, many, coerce) in type(self).fields.items():
+            if exclude and name in exclude:
+                continue
+            value = self._raw.get(alias, default)
+            if view is None:
+                value = coerce(value)
+            elif value is not None:
+                value = [view(each).dict(by_alias=by_alias) for each in value] if many \
+                    else view(value).dict(by_alias=by_alias)
+            result[alias if by_alias else name] = value
+        return result
+
+    def json(self, by_alias: bool = False) -> str:
+        """The decoded json with ``by_alias``, otherwise the json of the coerced values"""
+        if by_alias:
+            return json.dumps(self._raw, ensure_ascii=False)
+        return json.dumps(self.dict(), ensure_ascii=False, default=pydantic_encoder)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, ModelView):
+            return self.model_class is other.model_class and self._raw == other._raw
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self._raw!r})"
+
+
+_views: Dict[Type[BaseModel], Type[ModelView]] = {}
+
+
+def view_of(model_class: Type[ModelType]) -> Type[ModelView]:
+    """View class of a pydantic model, created once per model
+
+    Only the field shapes used by the gibdd models are supported: plain values,
+    nested models and lists of nested models
+    """
+    if model_class in _views:
+        return _views[model_class]
+    view = type(f"{model_class.__name__}View", (ModelView,), {
+        "__slots__": (), "__module__": __name__, "model_class": model_class,
+    })
+    _views[model_class] = view
+    fields: Dict[str, FieldSpec] = {}
+    for name, field in model_class.__fields__.items():
+        nested, coerce = None, None
+        if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            if field.shape not in (SHAPE_SINGLETON, SHAPE_LIST):
+                raise TypeError(f"Field {model_class.__name__}.{name} can not be viewed")
+            nested = view_of(field.type_)
+        else:
+            coerce = Coercion(field)
+        fields[name] = (field.alias, field.default, nested, field.shape == SHAPE_LIST, coerce)
+    view.fields = fields
+    return view
+
+
+CrashDataResponseView = view_of(CrashDataResponse)
+CrashCardView = view_of(CrashCard)
+CrashInfoView = view_of(CrashInfo)
+VehicleInfoView = view_of(VehicleInfo)
+DriverInfoView = view_of(DriverInfo)
+ParticipantInfoView = view_of(ParticipantInfo)
@@ -1,8 +1,8 @@
 import logging
-from typing import Optional, List, Union
+from collections import Counter
+from typing import Any, Dict, Optional, List, NamedTuple, Union
 
-from fuzzywuzzy import fuzz
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 from parser_gibdd.exceptions import RegionNotFoundError
 
@@ -26,38 +26,161 @@ class FederalRegion(Region):
     districts: List[Region] = []
 
 
+def normalize_name(name: str) -> str:
+    """Lowercase name with ё replaced by е and the whitespace collapsed, used as the key of the name index"""
+    return " ".join(name.lower().replace("ё", "е").split())
+
+
+TRANSLITERATION = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z", "и": "i", "й": "i",
+    "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
+    "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch", "ъ": "", "ы": "y", "ь": "",
+    "э": "e", "ю": "iu", "я": "ia", "-": " ", ".": " ", ",": " ", "(": " ", ")": " ",
+})
+
+
+def search_form(name: str) -> str:
+    """Normalized latin transliteration of a name, both the names and the queries are compared in this form"""
+    return " ".join(normalize_name(name).translate(TRANSLITERATION).split())
+
+
+def trigrams(form: str) -> List[str]:
+    padded = f" {form} "
+    return [padded[ind:ind + 3] for ind in range(len(padded) - 2)]
+
+
+def partial_ratio(name: str, query: str) -> float:
+    """rapidfuzz if it is installed, fuzzywuzzy otherwise, imported on the first search to keep the imports light"""
+    global _fuzz
+    if _fuzz is None:
+        try:
+            from rapidfuzz import fuzz
+        except ImportError:  # pragma: no cover
+            from fuzzywuzzy import fuzz
+        _fuzz = fuzz
+    return _fuzz.partial_ratio(name, query)
+
+
+_fuzz: Any = None
+
+
+class RegionMatch(NamedTuple):
+    region: Region
+    score: float
+
+
+class RegionIndex:
+    """Lookup tables of a country built in a single pass over its regions
+
+    Parameters
+    ----------
+    regions : List[FederalRegion]
+        federal regions of the country with their districts
+    """
+
+    def __init__(self, regions: List[FederalRegion]):
+        self.federal: Dict[str, FederalRegion] = {}
+        self.districts: Dict[str, Region] = {}
+        self.parents: Dict[str, FederalRegion] = {}
+        self.names: Dict[str, List[Region]] = {}
+        self.all: List[Region] = []
+        self.forms: List[str] = []
+        self.gram_counts: List[int] = []
+        self.grams: Dict[str, List[int]] = {}
+        for federal in regions:
+            self._add(federal, federal)
+            self.federal.setdefault(federal.okato, federal)
+            for district in federal.districts:
+                self._add(district, federal)
+                self.districts.setdefault(district.okato, district)
+
+    def _add(self, region: Region, parent: FederalRegion) -> None:
+        position = len(self.all)
+        self.all.append(region)
+        self.parents.setdefault(region.okato, parent)
+        self.names.setdefault(normalize_name(region.name), []).append(region)
+        form = search_form(region.name)
+        self.forms.append(form)
+        grams = set(trigrams(form))
+        self.gram_counts.append(len(grams))
+        for gram in grams:
+            self.grams.setdefault(gram, []).append(position)
+
+    def search(self, query: str, threshold: float = 90, overlap: float = 0.5) -> List[RegionMatch]:
+        """Regions whose name is similar to the query or to a part of it, the best matches first
+
+        Names sharing at least ``overlap`` of the trigrams of the shorter of the two strings
+        are shortlisted from the inverted index, only the shortlist is scored with ``partial_ratio``.
+        """
+        form = search_form(query)
+        query_grams = set(trigrams(form))
+        shared = Counter(position for gram in query_grams for position in self.grams.get(gram, ()))
+        matches = []
+        for position, count in shared.items():
+            if count < overlap * min(len(query_grams), self.gram_counts[position]):
+                continue
+            score = partial_ratio(self.forms[position], form)
+            if score > threshold:
+                matches.append((position, score))
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        return [RegionMatch(self.all[position], score) for position, score in matches]
+
+
 class Country(Region):
+    """All federal regions of the country with their districts
+
+    OKATO codes and names are indexed when the country is created, if ``regions`` is changed afterwards
+    :meth:`reindex` has to be called.
+    """
     regions: List[FederalRegion] = []
     name = "Российская Федерация"
     okato = "877"
+    _index: RegionIndex = PrivateAttr()
+
+    def __init__(self, **data: Any):
+        super().__init__(**data)
+        self.reindex()
+
+    def reindex(self) -> None:
+        self._index = RegionIndex(self.regions)
 
     def get_region(self, okato: str, federal: bool = False) -> Union[Region, FederalRegion]:
-        for region in self.regions:
-            if region.okato == okato:
-                return region
-            if federal:
-                return None
-            for subregion in region.districts:
-                if subregion.okato == okato:
-                    return subregion
-        return None
+        region = self._index.federal.get(okato)
+        if region is not None or federal:
+            return region
+        return self._index.districts.get(okato)
 
-    def find_region(self, region_name: str) -> List[Region]:
-        found_regions: List[Region] = []
-        for region in self.regions:
-            if fuzz.partial_ratio(region.name, region_name) > 90:
-                found_regions.append(region)
+    def get_regions_by_name(self, region_name: str) -> List[Region]:
+        """Regions and districts with exactly this name, ignoring the case, ё and the extra whitespace"""
+        return list(self._index.names.get(normalize_name(region_name), []))
 
-            for inner in region.districts:
-                if fuzz.partial_ratio(inner.name, region_name) > 90:
-                    found_regions.append(inner)
-        return found_regions
+    def find_region(self, region_name: str) -> List[Region]:
+        """Regions and districts with a name similar to ``region_name``, the best matches first"""
+        return [match.region for match in self._index.search(region_name)]
+
+    def find_regions(self, names: List[str], threshold: float = 90, limit: Optional[int] = None
+                     ) -> List[List[RegionMatch]]:
+        """Ranked matches for every name, e.g. to geocode free-text addresses to OKATO in a batch
+
+        Parameters
+        ----------
+        names : List[str]
+            names or addresses to search for
+        threshold : float
+            minimal similarity score of a match, from 0 to 100
+        limit : int, optional
+            maximum amount of matches per name, all of them if not set
+        """
+        found: Dict[str, List[RegionMatch]] = {}
+        result = []
+        for name in names:
+            if name not in found:
+                found[name] = self._index.search(name, threshold)[:limit]
+            result.append(list(found[name]))
+        return result
 
     def get_parent_region(self, region: Region) -> FederalRegion:
-        for federal in self.regions:
-
-            if federal.okato == region.okato:
-                return federal
-            if region.okato in [inner.okato for inner in federal.districts]:
-                return federal
-        raise RegionNotFoundError(f"Region {region.name} not found in {self.name}")
+        parent = self._index.parents.get(region.okato)
+        if parent is None:
+            raise RegionNotFoundError(f"Region {region.name} not found in {self.name}")
+        return parent
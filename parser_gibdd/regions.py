@@ -1,22 +1,31 @@
+import concurrent.futures
 import logging
-from typing import List
+import time
+from typing import Callable, Iterable, List, NamedTuple, Optional, Tuple, TypeVar
 
+from pydantic import BaseModel
+
+from parser_gibdd.api.gibdd_api import GibddAPI
 from parser_gibdd.api.okato import request_all_federal_okato, request_inner_okato
 from parser_gibdd.parsers import parse_federal_okato, parse_inner_okato
-from parser_gibdd.models.region import FederalRegion, Country
+from parser_gibdd.models.region import FederalRegion, Country, Region
+from parser_gibdd.snapshots import OkatoSnapshots
+from parser_gibdd.utils import latest_yearmonth
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
-def get_federal_regions() -> List[FederalRegion]:
+def get_federal_regions(api: Optional[GibddAPI] = None) -> List[FederalRegion]:
     """Returns only high level federal regions, no inner data"""
-    unprocessed = request_all_federal_okato()
+    unprocessed = request_all_federal_okato(api=api)
     return parse_federal_okato(unprocessed)
 
 
-def get_municipalities_by_federal(region: FederalRegion) -> FederalRegion:
+def get_municipalities_by_federal(region: FederalRegion, api: Optional[GibddAPI] = None) -> FederalRegion:
     """Получаем все окато регионов входящих в запрашиваемый федеральный округ"""
-    unprocessed = request_inner_okato(region.okato)
+    unprocessed = request_inner_okato(region.okato, api=api)
     districts = parse_inner_okato(unprocessed)
     return FederalRegion(okato=region.okato,
                          name=region.name,
@@ -24,21 +33,167 @@ def get_municipalities_by_federal(region: FederalRegion) -> FederalRegion:
                          )
 
 
-def get_country_codes() -> Country:
-    """Returns all federal regions and their subregions with okato codes"""
-    all_codes = Country()
-    try:
-        fed_regions = get_federal_regions()
-    except Exception as e:
-        logger.exception(e)
-        return all_codes
-    for region in fed_regions:
+def with_retries(function: Callable[..., T], *args, retries: int = 3, retry_delay: float = 1.0, **kwargs) -> T:
+    """Call the function, retrying ``retries`` times with an exponential backoff if it raises"""
+    attempt = 0
+    while True:
         try:
-            full_region = get_municipalities_by_federal(region)
+            return function(*args, **kwargs)
         except Exception as e:
-            logger.exception(e)
-            continue
-        all_codes.regions.append(
-            full_region
-        )
-    return all_codes
+            attempt += 1
+            if attempt > retries:
+                raise
+            name = getattr(function, "__name__", function)
+            logger.warning(f"{name} failed, retrying ({attempt}/{retries}): {e!r}")
+            time.sleep(min(retry_delay * 2 ** (attempt - 1), 30))
+
+
+def request_country_regions(api: Optional[GibddAPI] = None,
+                            max_workers: int = 8,
+                            retries: int = 3,
+                            retry_delay: float = 1.0,
+                            reuse: Iterable[FederalRegion] = ()) -> Tuple[List[FederalRegion], List[FederalRegion]]:
+    """Federal regions with their districts, the districts of every region are requested concurrently
+
+    Parameters
+    ----------
+    api : GibddAPI, optional
+        client to send the requests with, the process-wide default client is used if not passed
+    max_workers : int
+        amount of federal regions requested at the same time
+    retries : int
+        how many times the request of a single region is retried
+    retry_delay : float
+        delay before the first retry in seconds, doubled after every retry
+    reuse : Iterable[FederalRegion]
+        regions with districts that are already known, they are not requested again
+        unless gibdd lists them under another name
+
+    Returns
+    -------
+    All federal regions in the order of gibdd and the regions that failed after all the retries,
+    the failed regions are returned without districts
+    """
+    fed_regions = with_retries(get_federal_regions, api=api, retries=retries, retry_delay=retry_delay)
+    names = {region.okato: region.name for region in fed_regions}
+    known = {region.okato: region for region in reuse if names.get(region.okato) == region.name}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            region.okato: executor.submit(with_retries, get_municipalities_by_federal, region, api=api,
+                                          retries=retries, retry_delay=retry_delay)
+            for region in fed_regions if region.okato not in known
+        }
+        regions, failed = [], []
+        for region in fed_regions:
+            if region.okato in known:
+                regions.append(known[region.okato])
+                continue
+            try:
+                regions.append(futures[region.okato].result())
+            except Exception as e:
+                logger.error(f"Districts of {region.name} ({region.okato}) could not be requested: {e!r}")
+                regions.append(region)
+                failed.append(region)
+    return regions, failed
+
+
+def get_country_codes(api: Optional[GibddAPI] = None, max_workers: int = 8, retries: int = 3) -> Country:
+    """Returns all federal regions and their subregions with okato codes
+
+    Regions that could not be requested are logged and left out
+    """
+    regions, failed = request_country_regions(api=api, max_workers=max_workers, retries=retries)
+    return Country(regions=[region for region in regions if region not in failed])
+
+
+class OkatoDiff(BaseModel):
+    """Changes of the OKATO tree between two snapshots, federal regions and districts alike"""
+    added: List[Region] = []
+    removed: List[Region] = []
+    renamed: List[Tuple[Region, Region]] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.renamed)
+
+    def report(self) -> str:
+        if not self:
+            return "OKATO codes did not change"
+        lines = [f"+ {region.okato} {region.name}" for region in self.added]
+        lines += [f"- {region.okato} {region.name}" for region in self.removed]
+        lines += [f"~ {old.okato} {old.name} -> {new.name}" for old, new in self.renamed]
+        return "\n".join(lines)
+
+
+def diff_country_codes(old: Country, new: Country) -> OkatoDiff:
+    old_regions = {region.okato: region for fed in old.regions for region in (fed, *fed.districts)}
+    new_regions = {region.okato: region for fed in new.regions for region in (fed, *fed.districts)}
+    return OkatoDiff(
+        added=[region for okato, region in new_regions.items() if okato not in old_regions],
+        removed=[region for okato, region in old_regions.items() if okato not in new_regions],
+        renamed=[
+            (old_regions[okato], region) for okato, region in new_regions.items()
+            if okato in old_regions and old_regions[okato].name != region.name
+        ],
+    )
+
+
+class OkatoRefresh(NamedTuple):
+    country: Country
+    failed: List[FederalRegion]
+    diff: OkatoDiff
+
+
+def refresh_country_codes(snapshots: Optional[OkatoSnapshots] = None,
+                          api: Optional[GibddAPI] = None,
+                          max_workers: int = 8,
+                          retries: int = 3,
+                          force: bool = False,
+                          period: Optional[Tuple[int, int]] = None,
+                          reuse_previous: bool = False) -> OkatoRefresh:
+    """OKATO tree of the ``latest_yearmonth()`` period, requested only if there is no snapshot of it yet
+
+    Regions saved by an unfinished refresh of the same period are reused. Regions that still fail
+    are taken from the previous snapshot, the snapshot is then saved as partial and completed by the next refresh.
+    The diff is made against the previous snapshot.
+
+    gibdd tells nothing about the changes of the districts, they are only seen by requesting the districts
+    of every federal region, so by default the whole tree is requested. With ``reuse_previous`` only the list
+    of federal regions is requested, the districts of the regions missing from the previous snapshot
+    or renamed since then are requested and the districts of the others are taken from the previous snapshot.
+
+    Parameters
+    ----------
+    snapshots : OkatoSnapshots, optional
+        snapshot store, ``./cache/okato`` is used if not passed
+    api : GibddAPI, optional
+        client to send the requests with, the process-wide default client is used if not passed
+    max_workers : int
+        amount of federal regions requested at the same time
+    retries : int
+        how many times the request of a single region is retried
+    force : bool
+        request the whole tree even if the period already has a snapshot
+    period : Tuple[int, int], optional
+        (year, month) the snapshot is saved for, ``latest_yearmonth()`` if not passed
+    reuse_previous : bool
+        take the districts of the federal regions known by the previous snapshot from it
+    """
+    snapshots = snapshots or OkatoSnapshots()
+    period = period or latest_yearmonth()
+    previous = snapshots.previous(period) or Country()
+    current = None if force else snapshots.load(period)
+    if current is not None:
+        logger.info(f"OKATO snapshot of {period} is up to date")
+        return OkatoRefresh(current, [], diff_country_codes(previous, current))
+    partial = None if force else snapshots.load(period, partial=True)
+    reuse = {region.okato: region for region in previous.regions} if reuse_previous else {}
+    reuse.update((region.okato, region) for region in (partial.regions if partial else ()))
+    regions, failed = request_country_regions(api=api, max_workers=max_workers, retries=retries,
+                                              reuse=reuse.values())
+    snapshots.save(period, Country(regions=[region for region in regions if region not in failed]),
+                   complete=not failed)
+    country = Country(regions=[
+        (previous.get_region(region.okato, federal=True) or region) if region in failed else region
+        for region in regions
+    ])
+    return OkatoRefresh(country, failed, diff_country_codes(previous, country))
@@ -0,0 +1,97 @@
+"""Record the responses of stat.gibdd.ru and replay them without the network
+
+In the ``record`` mode every successful getMainMapData and getDTPCardData response is saved,
+in the ``replay`` mode the saved responses are returned instead of sending the requests,
+a request that was never recorded fails with RecordingNotFoundError.
+Recordings are keyed by the endpoint and the canonical payload, so they replay under any host.
+
+Every recording is a gzipped json document with the endpoint, the payload and the body of the response,
+so they can be inspected with ``zcat`` and kept as test fixtures.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+from parser_gibdd.exceptions import RecordingNotFoundError
+
+logger = logging.getLogger(__name__)
+
+MODES = ("record", "replay")
+
+
+class ReplayStore:
+    """Recorded responses, plugged into :class:`parser_gibdd.api.gibdd_api.GibddAPI` with ``replay=``
+
+    Any object with the same ``replaying``, ``replay`` and ``record`` can be plugged in instead,
+    e.g. a generator of synthetic responses.
+
+    Parameters
+    ----------
+    path : str
+        directory of the recordings
+    mode : str
+        ``record`` to send the requests and save the responses, ``replay`` to only return the saved responses
+    delay : float
+        seconds every replayed response takes, emulates the latency of the network for the benchmarks
+    """
+    suffix = ".json.gz"
+
+    def __init__(self, path: str = "./cache/recordings", mode: str = "replay", delay: float = 0.0):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}")
+        self.path = Path(path)
+        self.mode = mode
+        self.delay = delay
+        self.recorded = 0
+        self.replayed = 0
+        self._lock = threading.Lock()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    @staticmethod
+    def key(url: str, payload: Optional[Dict[str, Any]]) -> str:
+        canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(f"{urlsplit(url).path} {canonical}".encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.path / f"{key}{self.suffix}"
+
+    def replay(self, url: str, payload: Optional[Dict[str, Any]]) -> bytes:
+        """Body of the recorded response to the request"""
+        entry = self._entry_path(self.key(url, payload))
+        try:
+            with gzip.open(entry, "rt", encoding="utf-8") as recording:
+                body = json.load(recording)["body"].encode("utf-8")
+        except FileNotFoundError:
+            raise RecordingNotFoundError(f"No recorded response to {urlsplit(url).path} with payload {payload}")
+        if self.delay:
+            time.sleep(self.delay)
+        with self._lock:
+            self.replayed += 1
+        return body
+
+    def record(self, url: str, payload: Optional[Dict[str, Any]], body: bytes) -> None:
+        entry = self._entry_path(self.key(url, payload))
+        tmp = entry.with_name(f"{entry.name}.{threading.get_ident()}.tmp")
+        with gzip.open(tmp, "wt", encoding="utf-8") as recording:
+            json.dump({"endpoint": urlsplit(url).path, "payload": payload, "body": body.decode("utf-8")},
+                      recording, ensure_ascii=False)
+        os.replace(tmp, entry)
+        with self._lock:
+            self.recorded += 1
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.path.glob(f"*{self.suffix}"))
+
+    def stats(self) -> Dict[str, int]:
+        return {"recorded": self.recorded, "replayed": self.replayed}
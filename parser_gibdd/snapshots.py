@@ -0,0 +1,106 @@
+import logging
+import os
+import pickle
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+from parser_gibdd.models.region import Country
+
+logger = logging.getLogger(__name__)
+
+Period = Tuple[int, int]
+
+# bump when Country or the models it consists of change, binary caches of the other versions are rebuilt
+OKATO_CACHE_VERSION = 1
+
+
+def binary_cache_path(path: Union[str, Path]) -> Path:
+    path = Path(path)
+    return path.with_name(f"{path.name}.pickle")
+
+
+def load_country(path: Union[str, Path]) -> Country:
+    """Load the OKATO tree from a json file through its binary cache
+
+    The validated Country is pickled next to the json file together with ``OKATO_CACHE_VERSION``,
+    the cache is used as long as it is newer than the json file and has the same version,
+    otherwise the json is validated again and the cache is rebuilt.
+    """
+    source = Path(path)
+    binary = binary_cache_path(source)
+    try:
+        if binary.stat().st_mtime >= source.stat().st_mtime:
+            with binary.open("rb") as cached:
+                version, country = pickle.load(cached)
+            if version == OKATO_CACHE_VERSION and isinstance(country, Country):
+                return country
+    except FileNotFoundError:
+        pass
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError, TypeError) as e:
+        logger.warning(f"Binary OKATO cache {binary} is broken, rebuilding it: {e!r}")
+    country = Country.parse_raw(source.read_bytes())
+    try:
+        tmp = binary.with_name(f"{binary.name}.{threading.get_ident()}.tmp")
+        with tmp.open("wb") as cache:
+            pickle.dump((OKATO_CACHE_VERSION, country), cache, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, binary)
+    except OSError as e:
+        logger.warning(f"Binary OKATO cache {binary} could not be written: {e!r}")
+    return country
+
+
+class OkatoSnapshots:
+    """Versioned on-disk snapshots of the OKATO tree, one per ``latest_yearmonth()`` period
+
+    A complete snapshot is ``<path>/<year>-<month>.json``. A refresh that could not request every
+    federal region saves the regions it got into ``<year>-<month>.partial.json``, so the next refresh
+    of the same period only requests the missing ones.
+
+    Parameters
+    ----------
+    path : str
+        directory to keep the snapshots in
+    """
+    suffix = ".json"
+
+    def __init__(self, path: str = "./cache/okato"):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _snapshot_path(self, period: Period, partial: bool = False) -> Path:
+        year, month = period
+        return self.path / f"{year:04d}-{month:02d}{'.partial' if partial else ''}{self.suffix}"
+
+    def periods(self) -> List[Period]:
+        """Periods of the complete snapshots, oldest first"""
+        periods = []
+        for entry in self.path.glob(f"*{self.suffix}"):
+            name = entry.name[:-len(self.suffix)]
+            try:
+                year, month = name.split("-")
+                periods.append((int(year), int(month)))
+            except ValueError:
+                continue
+        return sorted(periods)
+
+    def load(self, period: Period, partial: bool = False) -> Optional[Country]:
+        path = self._snapshot_path(period, partial)
+        if not path.exists():
+            return None
+        return load_country(path)
+
+    def previous(self, period: Period) -> Optional[Country]:
+        """Latest complete snapshot older than the period"""
+        older = [each for each in self.periods() if each < period]
+        return self.load(older[-1]) if older else None
+
+    def save(self, period: Period, country: Country, complete: bool = True) -> Path:
+        path = self._snapshot_path(period, partial=not complete)
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        tmp.write_text(country.json(ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+        if complete:
+            self._snapshot_path(period, partial=True).unlink(missing_ok=True)
+        logger.info(f"OKATO snapshot saved to {path}")
+        return path
@@ -0,0 +1,117 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from parser_gibdd.api.planner import CrawlUnit, MonthKey
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+
+logger = logging.getLogger(__name__)
+
+
+class SyncState:
+    """Per-subregion high-water marks of the incremental sync kept in SQLite
+
+    The amount of cards of every synced month is stored. The latest synced month of a subregion
+    is its high-water mark, the next sync only requests the months after it, the months that were
+    never synced and the last ``revise_months`` months up to the mark, since gibdd keeps revising them.
+    The fetched months are only kept in memory by :meth:`record` until the output of the subregion
+    is written and :meth:`commit` stores them, so a run interrupted before writing requests them again.
+
+    Parameters
+    ----------
+    path : str
+        path to the SQLite database of the sync state
+    revise_months : int
+        how many months up to the high-water mark are requested again
+    """
+
+    def __init__(self, path: str = "./cache/sync_state.sqlite3", revise_months: int = 3):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.revise_months = revise_months
+        self._lock = threading.Lock()
+        self._fetched: Dict[str, Set[MonthKey]] = {}
+        self._pending: Dict[str, List[Tuple[str, str, int, int, int]]] = {}
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS month_counts ("
+            " region TEXT NOT NULL,"
+            " subregion TEXT NOT NULL,"
+            " year INTEGER NOT NULL,"
+            " month INTEGER NOT NULL,"
+            " cards INTEGER NOT NULL,"
+            " synced_at REAL NOT NULL,"
+            " PRIMARY KEY (region, subregion, year, month))"
+        )
+
+    def months(self, region: str, subregion: str) -> Dict[MonthKey, int]:
+        """Amount of cards of every synced month of a subregion"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT year, month, cards FROM month_counts WHERE region = ? AND subregion = ?",
+                (str(region), str(subregion))
+            ).fetchall()
+        return {(year, month): cards for year, month, cards in rows}
+
+    def high_water_mark(self, region: str, subregion: str) -> Optional[MonthKey]:
+        """Latest synced month of a subregion, None if it was never synced"""
+        return max(self.months(region, subregion), default=None)
+
+    def pending_months(self, region: str, subregion: str, months: List[MonthKey]) -> List[MonthKey]:
+        """Months that have to be requested by the next sync of a subregion"""
+        synced = self.months(region, subregion)
+        if not synced:
+            return list(months)
+        year, month = max(synced)
+        revise_from = year * 12 + month - self.revise_months
+        return [
+            (year, month) for year, month in months
+            if (year, month) not in synced or year * 12 + month > revise_from
+        ]
+
+    def record(self, unit: CrawlUnit, responses: List[CrashDataResponse]) -> List[MonthKey]:
+        """Count the cards of every month of a fetched unit, returns the months whose amount changed
+
+        The counts are stored by :meth:`commit` once the subregion is written
+        """
+        counts = Counter((int(card.date[-4:]), int(card.date[3:5])) for response in responses
+                         for card in response.crashes)
+        previous = self.months(unit.region, unit.subregion)
+        changed = [month for month in unit.months if previous.get(month) != counts[month]]
+        with self._lock:
+            self._pending.setdefault(str(unit.subregion), []).extend(
+                (str(unit.region), str(unit.subregion), year, month, counts[(year, month)])
+                for year, month in unit.months
+            )
+            self._fetched.setdefault(str(unit.subregion), set()).update(unit.months)
+        if changed:
+            logger.info(f"{unit} fetched, changed months: {changed}")
+        return changed
+
+    def commit(self, subregion: str) -> None:
+        """Store the counts of the months of a subregion recorded since its last commit, advancing its mark"""
+        now = time.time()
+        with self._lock:
+            rows = self._pending.pop(str(subregion), [])
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO month_counts VALUES (?, ?, ?, ?, ?, ?)",
+                [row + (now,) for row in rows]
+            )
+        if rows:
+            logger.info(f"Subregion {subregion} synced up to {max((year, month) for _, _, year, month, _ in rows)}")
+
+    def fetched_months(self, subregion: str) -> List[MonthKey]:
+        """Months of a subregion requested by this sync, including the months that have no crashes anymore
+
+        The previous output of these months is replaced by the output of the sync
+        """
+        with self._lock:
+            return sorted(self._fetched.get(str(subregion), ()))
+
+    def close(self) -> None:
+        self._connection.close()
@@ -2,9 +2,12 @@ from datetime import datetime
 from typing import Tuple
 
 __all__ = [
-    'latest_yearmonth'
+    'latest_yearmonth',
+    'OUTPUT_FORMATS',
 ]
 
+OUTPUT_FORMATS = ("xlsx", "parquet", "arrow", "sqlite")
+
 
 def latest_yearmonth() -> Tuple[int, int]:
     """Gets the latest year and month values. Latest means the month is already over
@@ -0,0 +1,341 @@
+"""Crashes, vehicles and participants kept in an embedded SQLite database
+
+The three tables of :func:`parser_gibdd.convert.crash_to_dataframes` are stored with the crash cards
+keyed by ``KartId``, so the crawls can be repeated and only update the cards they downloaded again.
+Every crash is tagged with its federal region, subregion and OKATO code, which are indexed
+together with the date of the crash. The exports are queried from the database, see
+:meth:`CrashWarehouse.export`, and the database itself can be queried by any SQLite client.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zipfile
+from collections import Counter
+from datetime import date, time as day_time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pandas import DataFrame, Series, read_sql_query
+from pydantic.fields import SHAPE_SINGLETON
+
+from parser_gibdd.api.planner import MonthKey
+from parser_gibdd.convert import (CRASH_COLUMNS, CRASH_INFO_COLUMNS, Frames, PARTICIPANT_COLUMNS, TABLE_NAMES,
+                                  VEHICLE_COLUMNS, Column, crash_months, crash_to_dataframes, frames_to_arrow,
+                                  frames_to_excel_bytes, subregion_codes, write_columnar_tables)
+from parser_gibdd.metrics import default_metrics, labelled
+from parser_gibdd.models.gibdd.crash import CrashCard, CrashDataResponse, CrashInfo
+from parser_gibdd.models.gibdd.participant import DriverInfo
+from parser_gibdd.models.gibdd.vehicle import VehicleInfo
+from parser_gibdd.models.region import Country
+
+logger = logging.getLogger(__name__)
+
+SQL_TYPES = {"int64": "INTEGER", "float64": "REAL"}
+
+# columns of the crashes table that are not in the flattened tables
+LOCATION_COLUMNS = ("federal_region", "subregion", "okato", "crash_date", "updated_at")
+
+TABLE_COLUMNS: Dict[str, List[Column]] = {
+    "crashes": [*CRASH_COLUMNS, *CRASH_INFO_COLUMNS, ("region_name", "RegName", None, "category")],
+    "vehicles": [*VEHICLE_COLUMNS, ("crash_id", "KartId", None, "int64")],
+    "participants": [*PARTICIPANT_COLUMNS, ("crash_id", "KartId", None, "int64")],
+}
+
+# lists of strings like the weather or the violations are stored as json arrays
+LIST_COLUMNS = {
+    name
+    for model in (CrashCard, CrashInfo, VehicleInfo, DriverInfo)
+    for name, field in model.__fields__.items()
+    if field.shape != SHAPE_SINGLETON
+}
+
+
+def _definitions(table: str) -> str:
+    return ", ".join(f'"{name}" {SQL_TYPES.get(str(dtype), "")}'.rstrip() for name, _, _, dtype in TABLE_COLUMNS[table])
+
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS crashes (
+    {_definitions("crashes")},
+    federal_region TEXT, subregion TEXT, okato TEXT, crash_date TEXT NOT NULL, updated_at REAL NOT NULL,
+    PRIMARY KEY ("id")
+);
+CREATE TABLE IF NOT EXISTS vehicles ({_definitions("vehicles")});
+CREATE TABLE IF NOT EXISTS participants ({_definitions("participants")});
+CREATE INDEX IF NOT EXISTS crashes_okato ON crashes (okato, crash_date);
+CREATE INDEX IF NOT EXISTS crashes_date ON crashes (crash_date);
+CREATE INDEX IF NOT EXISTS crashes_region ON crashes (federal_region, subregion, crash_date);
+CREATE INDEX IF NOT EXISTS vehicles_crash ON vehicles (crash_id);
+CREATE INDEX IF NOT EXISTS participants_crash ON participants (crash_id);
+"""
+
+
+def _sql_value(value: Any) -> Any:
+    if isinstance(value, (list, tuple)):
+        return json.dumps(value, ensure_ascii=False)
+    if isinstance(value, day_time):
+        return value.isoformat()
+    return value
+
+
+def _rows(frame: DataFrame) -> Iterator[Tuple[Any, ...]]:
+    for row in frame.itertuples(index=False, name=None):
+        yield tuple(map(_sql_value, row))
+
+
+def iso_date(gibdd_date: str) -> str:
+    """dd.mm.yyyy date of a card as yyyy-mm-dd, so the dates are sorted and compared as strings"""
+    return f"{gibdd_date[6:10]}-{gibdd_date[3:5]}-{gibdd_date[0:2]}"
+
+
+class CrashWarehouse:
+    """Crash cards of any amount of crawls in a single SQLite database
+
+    Parameters
+    ----------
+    path : str
+        path to the SQLite database
+    country : Country, optional
+        OKATO codes of the subregions, the crashes are tagged with the code of their subregion found by its name
+        if the code is not given to :meth:`upsert`
+    """
+
+    def __init__(self, path: str = "./cache/warehouse.sqlite3", country: Optional[Country] = None):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._okato = subregion_codes(country)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+
+    def upsert(self,
+               crashes: List[CrashDataResponse],
+               federal_region: Optional[str] = None,
+               subregion: Optional[str] = None,
+               okato: Optional[str] = None,
+               replace_months: bool = False,
+               months: Optional[Iterable[MonthKey]] = None) -> int:
+        """Insert the cards of the responses of a subregion or replace the stored cards with the same ``KartId``
+
+        The vehicles and the participants of a replaced card are replaced too. With ``replace_months``
+        the stored cards of the subregion in the months of the responses are removed first,
+        so the cards that gibdd removed from these months disappear as well.
+        Returns the amount of stored cards.
+
+        Parameters
+        ----------
+        crashes : List[CrashDataResponse]
+            responses of the subregion, models, raw views or compact records
+        federal_region : str, optional
+            name of the federal region of the subregion
+        subregion : str, optional
+            name of the subregion, the region name of the responses by default
+        okato : str, optional
+            OKATO code of the subregion, looked up by the names in the country of the warehouse by default
+        replace_months : bool
+            remove the stored cards of the subregion in the ``months``
+        months : Iterable[Tuple[int, int]], optional
+            (year, month) removed with ``replace_months``, the months of the responses by default,
+            the months requested again by a sync are removed even if there are no crashes in them anymore
+        """
+        months = (crash_months(crashes) if months is None else list(months)) if replace_months else []
+        if not crashes and not months:
+            return 0
+        subregion = subregion or (crashes[0].region_name if crashes else None)
+        if okato is None:
+            okato = self._okato.get((federal_region, subregion))
+        stored = 0
+        with labelled(okato=okato), default_metrics().timer("warehouse"):
+            frames = [crash_to_dataframes(crash) for crash in crashes]
+            now = time.time()
+            with self._lock:
+                connection = self._connection
+                connection.execute("BEGIN")
+                try:
+                    # same-named subregions are told apart by their OKATO codes when they are known
+                    where, key = ("okato = ?", (okato,)) if okato is not None else \
+                        ("federal_region IS ? AND subregion IS ?", (federal_region, subregion))
+                    for year, month in months:
+                        self._delete(f"{where} AND crash_date LIKE ?", (*key, f"{year:04d}-{month:02d}-%"))
+                    for crash_frame, vehicles, participants in frames:
+                        date_index = crash_frame.columns.get_loc("date")
+                        ids = [(crash_id,) for crash_id in crash_frame["id"].tolist()]
+                        connection.executemany("DELETE FROM vehicles WHERE crash_id = ?", ids)
+                        connection.executemany("DELETE FROM participants WHERE crash_id = ?", ids)
+                        placeholders = ", ".join("?" * (len(crash_frame.columns) + len(LOCATION_COLUMNS)))
+                        connection.executemany(
+                            f"INSERT OR REPLACE INTO crashes VALUES ({placeholders})",
+                            (
+                                (*row, federal_region, subregion, okato, iso_date(row[date_index]), now)
+                                for row in _rows(crash_frame)
+                            )
+                        )
+                        for name, frame in (("vehicles", vehicles), ("participants", participants)):
+                            connection.executemany(
+                                f"INSERT INTO {name} VALUES ({', '.join('?' * len(frame.columns))})", _rows(frame)
+                            )
+                        stored += len(crash_frame)
+                    connection.execute("COMMIT")
+                except BaseException:
+                    connection.execute("ROLLBACK")
+                    raise
+        logger.info(f"{stored} cards of {subregion} stored in {self.path}")
+        return stored
+
+    def _delete(self, where: str, params: Tuple[Any, ...]) -> None:
+        for name in ("vehicles", "participants"):
+            self._connection.execute(
+                f"DELETE FROM {name} WHERE crash_id IN (SELECT id FROM crashes WHERE {where})", params
+            )
+        self._connection.execute(f"DELETE FROM crashes WHERE {where}", params)
+
+    @staticmethod
+    def _filters(federal_region: Optional[str] = None,
+                 subregion: Optional[str] = None,
+                 okato: Optional[str] = None,
+                 date_from: Optional[date] = None,
+                 date_to: Optional[date] = None) -> Tuple[str, Tuple[Any, ...]]:
+        conditions, params = ["1"], []
+        for column, value in (("federal_region", federal_region), ("subregion", subregion), ("okato", okato)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(str(value))
+        if date_from is not None:
+            conditions.append("crash_date >= ?")
+            params.append(date_from.isoformat())
+        if date_to is not None:
+            conditions.append("crash_date <= ?")
+            params.append(date_to.isoformat())
+        return " AND ".join(conditions), tuple(params)
+
+    def count(self, **filters) -> int:
+        """Amount of stored cards matching the filters of :meth:`frames`"""
+        where, params = self._filters(**filters)
+        with self._lock:
+            return self._connection.execute(f"SELECT count(*) FROM crashes WHERE {where}", params).fetchone()[0]
+
+    def subregions(self, **filters) -> List[Tuple[Optional[str], Optional[str], Optional[str]]]:
+        """(federal region, subregion, OKATO code) of the stored cards matching the filters of :meth:`frames`"""
+        where, params = self._filters(**filters)
+        with self._lock:
+            return self._connection.execute(
+                f"SELECT DISTINCT federal_region, subregion, okato FROM crashes WHERE {where} "
+                f"ORDER BY federal_region, subregion, okato", params
+            ).fetchall()
+
+    def frames(self,
+               federal_region: Optional[str] = None,
+               subregion: Optional[str] = None,
+               okato: Optional[str] = None,
+               date_from: Optional[date] = None,
+               date_to: Optional[date] = None) -> Frames:
+        """Stored crashes, vehicles and participants with the columns and the dtypes of
+        :func:`parser_gibdd.convert.crash_to_dataframes`, the crashes are sorted by the date
+
+        Parameters
+        ----------
+        federal_region : str, optional
+            only the cards of this federal region
+        subregion : str, optional
+            only the cards of the subregion with this name
+        okato : str, optional
+            only the cards of the subregion with this OKATO code
+        date_from : date, optional
+            only the cards from this day
+        date_to : date, optional
+            only the cards up to this day, inclusive
+        """
+        return self._frames(*self._filters(federal_region, subregion, okato, date_from, date_to))
+
+    def _frames(self, where: str, params: Tuple[Any, ...]) -> Frames:
+        queries = {
+            "crashes": f"SELECT {self._select('crashes')} FROM crashes WHERE {where} ORDER BY crash_date, id",
+            **{
+                name: f"SELECT {self._select(name)} FROM {name} "
+                      f"WHERE crash_id IN (SELECT id FROM crashes WHERE {where}) ORDER BY rowid"
+                for name in ("vehicles", "participants")
+            },
+        }
+        with self._lock:
+            frames = [read_sql_query(queries[name], self._connection, params=params) for name in TABLE_NAMES]
+        return tuple(self._restore_dtypes(frame, TABLE_COLUMNS[name])
+                     for name, frame in zip(TABLE_NAMES, frames))  # type: ignore
+
+    @staticmethod
+    def _select(table: str) -> str:
+        return ", ".join(f'"{name}"' for name, _, _, _ in TABLE_COLUMNS[table])
+
+    @staticmethod
+    def _restore_dtypes(frame: DataFrame, columns: List[Column]) -> DataFrame:
+        for name, _, _, dtype in columns:
+            if name in LIST_COLUMNS:
+                frame[name] = Series([json.loads(value) if value is not None else None for value in frame[name]],
+                                     dtype=object)
+            else:
+                frame[name] = frame[name].astype(dtype)
+        return frame
+
+    def export(self,
+               filename: str,
+               output_format: str = "xlsx",
+               **filters) -> None:
+        """Export the stored cards matching the filters of :meth:`frames`
+
+        xlsx workbooks of every subregion and year are packed into ``<filename>.zip``
+        as ``<federal region>/<subregion>/<year>.xlsx``, parquet and arrow files are written
+        into the ``<filename>`` directory partitioned by federal region and year like the crawls.
+        Only one subregion is held in memory at a time. Subregions are told apart by their OKATO codes,
+        a subregion sharing its name with another one of the same federal region, or of an unknown one,
+        is exported as ``<subregion> (<okato>)``.
+        """
+        groups = self.subregions(**filters)
+        where, params = self._filters(**filters)
+        names = Counter((federal_region, subregion) for federal_region, subregion, _ in groups)
+
+        def subregion_frames(federal_region: Optional[str], subregion: Optional[str], okato: Optional[str]) -> Frames:
+            return self._frames(f"{where} AND federal_region IS ? AND subregion IS ? AND okato IS ?",
+                                (*params, federal_region, subregion, okato))
+
+        def output_name(federal_region: Optional[str], subregion: Optional[str], okato: Optional[str]) -> str:
+            return f"{subregion} ({okato})" if names[(federal_region, subregion)] > 1 else str(subregion)
+
+        if output_format != "xlsx":
+            for group in groups:
+                with labelled(okato=group[2]):
+                    write_columnar_tables(frames_to_arrow(subregion_frames(*group)), Path(filename),
+                                          municipal=output_name(*group), federal_region=group[0],
+                                          output_format=output_format)
+            return
+        with zipfile.ZipFile(f"{filename}.zip", "w") as archive:
+            for group in groups:
+                name = output_name(*group)
+                with labelled(okato=group[2]):
+                    for year, frames in self._years(subregion_frames(*group)):
+                        archive.writestr(f"{group[0]}/{name}/{year}.xlsx", frames_to_excel_bytes(frames))
+        logger.info(f"{len(groups)} subregions exported from {self.path} to {filename}")
+
+    @staticmethod
+    def _years(frames: Frames) -> Iterable[Tuple[str, Frames]]:
+        crashes, vehicles, participants = frames
+        years = crashes["date"].str[-4:]
+        for year in sorted(years.unique()):
+            year_crashes = crashes[years == year].reset_index(drop=True)
+            ids = set(year_crashes["id"])
+            yield year, (
+                year_crashes,
+                vehicles[vehicles["crash_id"].isin(ids)].reset_index(drop=True),
+                participants[participants["crash_id"].isin(ids)].reset_index(drop=True),
+            )
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
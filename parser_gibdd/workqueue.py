@@ -0,0 +1,299 @@
+"""Work queue of a crawl shared by several worker hosts
+
+The coordinator expands the country into crawl units (see :class:`parser_gibdd.api.planner.CrawlUnit`)
+and puts them into a :class:`WorkQueue`, a SQLite database on a filesystem shared by the workers.
+Every worker leases one unit at a time, crawls it and writes its own part of the partitioned output.
+A lease has to be renewed while the unit is crawled, the unit of a worker that died or lost
+the connection goes back to the other workers once its lease expires.
+
+The leases are compared with the clocks of the workers, so the clocks of the hosts have to be synchronized,
+and the shared filesystem has to support the SQLite locks.
+"""
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
+
+from parser_gibdd.api.crashes import subregion_unit_crashes
+from parser_gibdd.api.gibdd_api import GibddAPI
+from parser_gibdd.api.planner import CrawlUnit, RequestPlanner, default_planner
+from parser_gibdd.convert import package_crashes_unit
+from parser_gibdd.metrics import default_metrics, labelled
+from parser_gibdd.models.region import Country
+
+logger = logging.getLogger(__name__)
+
+# states of the units in the queue
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+
+class QueuedUnit(NamedTuple):
+    """A crawl unit together with the names its output is written under"""
+    federal_region: str
+    subregion_name: str
+    unit: CrawlUnit
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """Crawl units leased by the workers, kept in SQLite
+
+    A unit is pending until a worker leases it for ``lease_seconds``, the worker renews the lease
+    while it crawls the unit and marks the unit as done when its output is written.
+    A unit whose lease has expired is leased again by any worker, a unit that failed ``max_attempts``
+    times is not leased anymore.
+
+    Parameters
+    ----------
+    path : str
+        path to the SQLite database of the queue, on a filesystem shared by all the workers
+    lease_seconds : float
+        how long a leased unit belongs to its worker without a renewal
+    max_attempts : int
+        how many times a unit is leased before it is marked as failed
+    """
+
+    def __init__(self, path: str = "./cache/work_queue.sqlite3", lease_seconds: float = 600.0,
+                 max_attempts: int = 5):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # the workers of the other hosts hold the write lock for a moment on every lease
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS units ("
+            " region TEXT NOT NULL,"
+            " subregion TEXT NOT NULL,"
+            " first_year INTEGER NOT NULL,"
+            " first_month INTEGER NOT NULL,"
+            " last_year INTEGER NOT NULL,"
+            " last_month INTEGER NOT NULL,"
+            " federal_region TEXT NOT NULL,"
+            " subregion_name TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " worker TEXT,"
+            " lease_until REAL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " cards INTEGER,"
+            " error TEXT,"
+            " PRIMARY KEY (region, subregion, first_year, first_month, last_year, last_month))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS units_state ON units (state, lease_until)")
+
+    @staticmethod
+    def _key(unit: CrawlUnit) -> Tuple[str, str, int, int, int, int]:
+        return str(unit.region), str(unit.subregion), *unit.first, *unit.last
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def add(self, units: Iterable[QueuedUnit]) -> int:
+        """Put the units into the queue, returns the amount of the new ones, queued units are kept as they are"""
+        with self._transaction() as connection:
+            before = connection.total_changes
+            connection.executemany(
+                "INSERT OR IGNORE INTO units (region, subregion, first_year, first_month, last_year, last_month,"
+                " federal_region, subregion_name, state) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((*self._key(queued.unit), queued.federal_region, queued.subregion_name, PENDING)
+                 for queued in units)
+            )
+            return connection.total_changes - before
+
+    def lease(self, worker: str) -> Optional[QueuedUnit]:
+        """Lease the next pending unit or a unit whose lease has expired, None if there is none right now"""
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE units SET state = ?, lease_until = NULL, error = 'lease expired'"
+                " WHERE state = ? AND lease_until < ? AND attempts >= ?",
+                (FAILED, LEASED, now, self.max_attempts)
+            )
+            row = connection.execute(
+                "SELECT rowid, region, subregion, first_year, first_month, last_year, last_month,"
+                " federal_region, subregion_name, state, worker FROM units"
+                " WHERE state = ? OR (state = ? AND lease_until < ?) ORDER BY rowid LIMIT 1",
+                (PENDING, LEASED, now)
+            ).fetchone()
+            if row is None:
+                return None
+            rowid, region, subregion, first_year, first_month, last_year, last_month, federal_region, \
+                subregion_name, state, previous = row
+            connection.execute(
+                "UPDATE units SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1 WHERE rowid = ?",
+                (LEASED, worker, now + self.lease_seconds, rowid)
+            )
+        if state == LEASED:
+            logger.warning(f"Lease of {previous} on {subregion_name} expired, the unit is re-assigned to {worker}")
+            default_metrics().count("reassigned_units")
+        unit = CrawlUnit(region, subregion, (first_year, first_month), (last_year, last_month))
+        return QueuedUnit(federal_region, subregion_name, unit)
+
+    def renew(self, unit: CrawlUnit, worker: str) -> bool:
+        """Extend the lease of the worker, False if the unit was re-assigned to another worker"""
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE units SET lease_until = ? WHERE region = ? AND subregion = ? AND first_year = ?"
+                " AND first_month = ? AND last_year = ? AND last_month = ? AND state = ? AND worker = ?",
+                (time.time() + self.lease_seconds, *self._key(unit), LEASED, worker)
+            ).rowcount == 1
+
+    def finish(self, unit: CrawlUnit, worker: str, cards: int) -> None:
+        """Mark the unit as done, also when it was re-assigned meanwhile, the output of a unit is the same"""
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE units SET state = ?, worker = ?, lease_until = NULL, cards = ?, error = NULL"
+                " WHERE region = ? AND subregion = ? AND first_year = ? AND first_month = ?"
+                " AND last_year = ? AND last_month = ?",
+                (DONE, worker, cards, *self._key(unit))
+            )
+
+    def fail(self, unit: CrawlUnit, worker: str, error: str) -> None:
+        """Release the unit of the worker, it is marked as failed after ``max_attempts`` attempts"""
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE units SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, lease_until = NULL, error = ?"
+                " WHERE region = ? AND subregion = ? AND first_year = ? AND first_month = ?"
+                " AND last_year = ? AND last_month = ? AND state = ? AND worker = ?",
+                (self.max_attempts, FAILED, PENDING, error, *self._key(unit), LEASED, worker)
+            )
+
+    def states(self) -> Dict[str, int]:
+        """Amount of the units in every state"""
+        with self._lock:
+            rows = self._connection.execute("SELECT state, count(*) FROM units GROUP BY state").fetchall()
+        return {state: dict(rows).get(state, 0) for state in (PENDING, LEASED, DONE, FAILED)}
+
+    def unfinished(self) -> bool:
+        """Whether some units are still pending or leased"""
+        states = self.states()
+        return bool(states[PENDING] or states[LEASED])
+
+    def retry_failed(self) -> int:
+        """Put the failed units back into the queue with their attempts reset, returns their amount"""
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE units SET state = ?, worker = NULL, attempts = 0 WHERE state = ?", (PENDING, FAILED)
+            ).rowcount
+
+    def reset(self) -> None:
+        """Forget all units, used when a new crawl is queued"""
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM units")
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def enqueue_country(queue: WorkQueue,
+                    country: Country,
+                    period_start: date,
+                    period_end: date,
+                    planner: Optional[RequestPlanner] = None) -> int:
+    """Expand every subregion of the country into the crawl units of the planner and queue them
+
+    Returns the amount of the new units
+    """
+    planner = planner or default_planner()
+    for fed in country.regions:
+        if not fed.okato:
+            raise Exception(
+                f"No okato code for federal region: {fed.name}, update the cache for federal regions"
+            )
+    return queue.add(
+        QueuedUnit(fed.name, subregion.name, unit)
+        for fed in country.regions
+        for subregion in fed.districts
+        for unit in planner.units(fed.okato, subregion.okato, period_start, period_end)
+    )
+
+
+class _Heartbeat(threading.Thread):
+    """Renews the lease of a unit every third of the lease time until it is stopped"""
+
+    def __init__(self, queue: WorkQueue, unit: CrawlUnit, worker: str):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.unit = unit
+        self.worker = worker
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.queue.lease_seconds / 3):
+            if not self.queue.renew(self.unit, self.worker):
+                # the unit is still finished, the output of the other worker is the same
+                logger.warning(f"{self.worker} lost the lease of {self.unit}")
+                return
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+
+def run_worker(queue: WorkQueue,
+               filename: str = "Российская Федерация",
+               output_format: str = "parquet",
+               worker: Optional[str] = None,
+               poll_seconds: float = 10.0,
+               api: Optional[GibddAPI] = None,
+               planner: Optional[RequestPlanner] = None) -> int:
+    """Lease, crawl and write the units of the queue until none of them is pending or leased
+
+    Every unit is written into its own parts of the ``<filename>`` output, see
+    :func:`parser_gibdd.convert.package_crashes_unit`, so a unit crawled again after a re-assignment
+    replaces its parts. While the units of the other workers are leased the worker waits ``poll_seconds``
+    between the attempts and takes them over if their leases expire.
+    Returns the amount of the units finished by this worker.
+    """
+    worker = worker or default_worker_id()
+    finished = 0
+    while True:
+        queued = queue.lease(worker)
+        if queued is None:
+            if not queue.unfinished():
+                break
+            time.sleep(poll_seconds)
+            continue
+        federal_region, subregion_name, unit = queued
+        heartbeat = _Heartbeat(queue, unit, worker)
+        heartbeat.start()
+        try:
+            with labelled(okato=unit.subregion):
+                crashes = subregion_unit_crashes(unit, api=api, planner=planner)
+                package_crashes_unit(crashes, unit, filename, output_format,
+                                     federal_region=federal_region, municipal=subregion_name)
+        except Exception as e:
+            heartbeat.stop()
+            logger.exception(f"{worker} failed to crawl {unit}")
+            queue.fail(unit, worker, repr(e))
+            continue
+        heartbeat.stop()
+        queue.finish(unit, worker, sum(len(crash.crashes) for crash in crashes))
+        finished += 1
+        logger.info(f"{worker} finished {unit} of {subregion_name}, {federal_region}")
+    logger.info(f"{worker} finished {finished} units, no units are left in the queue")
+    return finished
@@ -0,0 +1,21 @@
+"""Raw gibdd payloads for the tests"""
+
+
+def crash_card(kart_id: int, date_string: str) -> dict:
+    return {
+        "KartId": kart_id, "DTP_V": "Столкновение", "District": "Район", "K_TS": 1, "K_UCH": 1,
+        "POG": 0, "RAN": 1, "date": date_string, "Time": "12:30", "rowNum": kart_id,
+        "infoDtp": {
+            "COORD_L": 37.6, "COORD_W": 55.7, "OBJ_DTP": [], "change_org_motion": "", "dor": "", "dor_k": "",
+            "dor_z": "", "factor": [], "house": "1", "k_ul": "", "km": "", "m": "", "n_p": "Москва",
+            "ndu": [], "osv": "Светлое время суток", "s_dtp": "", "s_pch": "Сухое", "s_pog": ["Ясно"],
+            "sdor": [], "street": "", "ts_info": [], "uchInfo": [],
+        },
+    }
+
+
+def crash_data(region_name: str, cards: list) -> dict:
+    return {
+        "RegName": region_name, "countCard": len(cards), "end": len(cards), "pokName": "", "posl": "",
+        "ran": 0, "pog": 0, "start": 0, "tab": cards,
+    }
@@ -0,0 +1,219 @@
+import asyncio
+import contextlib
+import json
+import threading
+from datetime import date, time
+from unittest import mock
+
+import pytest
+
+from parser_gibdd.models.region import FederalRegion, Region, Country
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web  # noqa: E402
+
+from parser_gibdd.api.aio import AsyncGibddAPI, country_crashes_all_async, country_crashes_all_asyncio, \
+    iter_country_crashes_asyncio, region_crashes_all_async, subregion_crashes_async, unit_crashes_async  # noqa: E402
+from parser_gibdd.api.gibdd_api import parse_dtp_card_data  # noqa: E402
+from parser_gibdd.api.parsing import ParsePool  # noqa: E402
+from parser_gibdd.api.planner import CrawlUnit, RequestPlanner  # noqa: E402
+from parser_gibdd.api.throttle import ConcurrencyController, Throttle  # noqa: E402
+from parser_gibdd.exceptions import CrashesNotFoundError, ResourceRequestFailed  # noqa: E402
+from parser_gibdd.metrics import current_labels  # noqa: E402
+from parser_gibdd.models.gibdd.views import CrashDataResponseView  # noqa: E402
+from tests.samples import crash_card  # noqa: E402
+from tests.test_api.test_planner import fake_dtp_card_data  # noqa: E402
+
+CARDS_PER_MONTH = 3
+
+
+def fake_gibdd_app(requests_log: list) -> web.Application:
+    """Local fake of stat.gibdd.ru that returns CARDS_PER_MONTH cards for every requested month"""
+
+    async def dtp_card_data(request: web.Request) -> web.Response:
+        payload = json.loads((await request.json())["data"])
+        requests_log.append(payload)
+        start, end = int(payload["st"]), int(payload["en"])
+        cards = [
+            crash_card(ind, f"01.{month_year}")
+            for ind, month_year in enumerate(
+                d.split(":")[1] for d in payload["date"] for _ in range(CARDS_PER_MONTH)
+            )
+        ]
+        data = {
+            "RegName": payload["reg"], "countCard": len(cards), "end": end, "pokName": "", "posl": "",
+            "ran": 0, "pog": 0, "start": start, "tab": cards[start:end],
+        }
+        return web.json_response({"data": json.dumps(data)})
+
+    app = web.Application()
+    app.router.add_post("/map/getDTPCardData", dtp_card_data)
+    return app
+
+
+async def with_fake_server(coroutine_factory, requests_log: list, throttle=None):
+    runner = web.AppRunner(fake_gibdd_app(requests_log))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with AsyncGibddAPI(f"http://127.0.0.1:{port}", concurrency=4, rate=0, throttle=throttle) as api:
+            return await coroutine_factory(api)
+    finally:
+        await runner.cleanup()
+
+
+@contextlib.contextmanager
+def fake_server_host(requests_log: list):
+    """Run the fake server on its own event loop, for the blocking entrypoints that start a loop themselves"""
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(fake_gibdd_app(requests_log))
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+
+def small_country() -> Country:
+    return Country(regions=[
+        FederalRegion(name=f"Регион {fed}", okato=str(fed), districts=[
+            Region(name=f"Район {fed}-{sub}", okato=f"{fed}{sub}") for sub in range(3)
+        ])
+        for fed in range(1, 4)
+    ])
+
+
+def test_region_crashes_all_async():
+    region = FederalRegion(name="Москва", okato="45", districts=[Region(name="Центр", okato="45286")])
+    requests_log: list = []
+    result = asyncio.run(with_fake_server(
+        lambda api: region_crashes_all_async(api, region, date(2020, 11, 1), date(2021, 2, 1)),
+        requests_log
+    ))
+    crashes = result["Центр"]
+    assert sum(len(response.crashes) for response in crashes) == 4 * CARDS_PER_MONTH
+    # all four months fit into a single request
+    assert len(requests_log) == 1
+    assert len(requests_log[0]["date"]) == 4
+
+
+def test_throttled_pages_async():
+    throttle = Throttle(rate=0, controller=ConcurrencyController(initial=1, maximum=2))
+    requests_log: list = []
+    crashes = asyncio.run(with_fake_server(
+        lambda api: subregion_crashes_async(api, "45", "45286", date(2020, 1, 1), date(2020, 12, 1),
+                                            planner=RequestPlanner(card_limit=5)),
+        requests_log, throttle
+    ))
+    assert sum(len(response.crashes) for response in crashes) == 12 * CARDS_PER_MONTH
+    assert throttle.dict()["requests"] == len(requests_log) == 8
+    assert throttle.controller.in_flight == 0
+    assert throttle.controller.limit == 2
+
+
+def test_subregion_crashes_async_pages():
+    planner = RequestPlanner(card_limit=5)
+    requests_log: list = []
+    crashes = asyncio.run(with_fake_server(
+        lambda api: subregion_crashes_async(api, "45", "45286", date(2020, 11, 1), date(2021, 2, 1),
+                                            planner=planner),
+        requests_log
+    ))
+    assert [len(response.crashes) for response in crashes] == [5, 5, 2]
+    assert [(log["st"], log["en"]) for log in requests_log] == [("0", "5"), ("5", "10"), ("10", "15")]
+
+
+def test_country_crashes_all_async():
+    country = small_country()
+    requests_log: list = []
+    result = asyncio.run(with_fake_server(
+        lambda api: country_crashes_all_async(api, country, date(2021, 1, 1), date(2021, 3, 1)),
+        requests_log
+    ))
+    assert list(result) == [fed.name for fed in country.regions]
+    assert list(result["Регион 2"]) == ["Район 2-0", "Район 2-1", "Район 2-2"]
+    assert len(requests_log) == 9
+
+
+def test_failed_later_page_async():
+    async def failing_later_pages(api, request_data, sizer=None):
+        if int(request_data.st) >= 4:
+            raise CrashesNotFoundError()
+        return fake_dtp_card_data(request_data)
+
+    unit = CrawlUnit("45", "45286", (2019, 1), (2019, 1))
+    with mock.patch("parser_gibdd.api.aio.dtp_card_data_async", side_effect=failing_later_pages):
+        with pytest.raises(ResourceRequestFailed):
+            asyncio.run(unit_crashes_async(mock.Mock(), unit, RequestPlanner(card_limit=2)))
+
+
+def test_parsing_and_journal_run_off_the_loop():
+    threads: dict = {}
+
+    def parse(body, **kwargs):
+        threads["parse"] = threading.get_ident(), current_labels()
+        return parse_dtp_card_data(body, **kwargs)
+
+    def record(*args):
+        threads["journal"] = threading.get_ident()
+
+    journal = mock.Mock(get=mock.Mock(return_value=None), record=mock.Mock(side_effect=record))
+
+    async def crawl(api):
+        threads["loop"] = threading.get_ident()
+        return await subregion_crashes_async(api, "45", "45286", date(2021, 1, 1), date(2021, 1, 1), journal=journal,
+                                             planner=RequestPlanner())
+
+    with mock.patch("parser_gibdd.api.aio.parse_dtp_card_data", side_effect=parse):
+        crashes = asyncio.run(with_fake_server(crawl, []))
+    assert sum(len(response.crashes) for response in crashes) == CARDS_PER_MONTH
+    assert threads["parse"][0] != threads["loop"]
+    assert threads["parse"][1] == {"okato": "45286"}
+    assert threads["journal"] != threads["loop"]
+
+
+def test_parse_pool_async():
+    async def crawl(api):
+        api.parse_pool = pool
+        return await subregion_crashes_async(api, "45", "45286", date(2020, 11, 1), date(2021, 2, 1),
+                                             planner=RequestPlanner(card_limit=5))
+
+    with ParsePool(workers=1) as pool:
+        crashes = asyncio.run(with_fake_server(crawl, []))
+    # the pool hands back views over the validated json
+    assert all(isinstance(response, CrashDataResponseView) for response in crashes)
+    assert [len(response.crashes) for response in crashes] == [5, 5, 2]
+    assert crashes[0].crashes[0].Time == time(12, 30)
+
+
+def test_country_crashes_all_asyncio():
+    country = small_country()
+    requests_log: list = []
+    with fake_server_host(requests_log) as host:
+        result = country_crashes_all_asyncio(country, date(2021, 1, 1), date(2021, 3, 1), concurrency=4, rate=0,
+                                             host=host)
+    assert list(result) == [fed.name for fed in country.regions]
+    assert sum(len(response.crashes) for response in result["Регион 3"]["Район 3-1"]) == 3 * CARDS_PER_MONTH
+    assert len(requests_log) == 9
+
+
+def test_iter_country_crashes_asyncio_parse_pool():
+    country = small_country()
+    with ParsePool(workers=1) as pool, mock.patch.object(pool, "submit", wraps=pool.submit) as submit:
+        with fake_server_host([]) as host:
+            items = list(iter_country_crashes_asyncio(country, date(2021, 1, 1), date(2021, 3, 1), concurrency=4,
+                                                      rate=0, host=host, parse_pool=pool))
+    assert len(items) == 9
+    # every response body went through the worker pool
+    assert submit.call_count == 9
+    assert all(isinstance(response, CrashDataResponseView) for _, _, crashes in items for response in crashes)
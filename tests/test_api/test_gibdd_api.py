@@ -1,7 +1,14 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
 from requests import Request
 
+from parser_gibdd.api.crashes import dtp_card_data
 from parser_gibdd.api.gibdd_api import GibddAPI
+from parser_gibdd.cache import ResponseCache
+from parser_gibdd.exceptions import CrashesNotFoundError
 from parser_gibdd.models.gibdd.requests import GibddMainMapData, GibddDateListString, GibddDateString, GibddDTPCardData, \
     DtpCardDataOrder
 
@@ -42,3 +49,84 @@ def test_request_dtp_card_data(gibdd_api: GibddAPI):
     assert isinstance(request, Request)
     assert request_data.to_request_form() == request.json
     assert gibdd_api.host + '/map/getDTPCardData' == request.url
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = b'{"data": ""}'
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def local_host():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_connections_are_reused(local_host: str):
+    with GibddAPI(host=local_host, pool_size=2) as api:
+        for _ in range(5):
+            api.send_request(Request(method='POST', url=f'{local_host}/map/getDTPCardData', json={}))
+        assert api.pool_stats.dict() == {"requests": 5, "hits": 4, "misses": 1}
+
+
+def test_shared_api_between_threads(local_host: str):
+    with GibddAPI(host=local_host, pool_size=2) as api:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(
+                lambda _: api.send_request(Request(method='POST', url=f'{local_host}/map/getDTPCardData', json={})),
+                range(20)
+            ))
+        assert api.pool_stats.requests == 20
+        assert api.pool_stats.misses <= 2
+
+
+def test_cached_responses_skip_network(local_host: str, tmp_path):
+    request_data = GibddDTPCardData(
+        date=[GibddDateString.from_year_month(2019, m) for m in range(1, 12 + 1)],
+        ParReg='45',
+        order=DtpCardDataOrder(type=1, fieldName='dat'),
+        reg='45286',
+        ind='1',
+        st=str(0),
+        en=str(50)
+    )
+    with GibddAPI(host=local_host, cache=ResponseCache(str(tmp_path))) as api:
+        first = api.send_request(api.request_dtp_card_data(request_data))
+        second = api.send_request(api.request_dtp_card_data(request_data))
+        assert first.content == second.content
+        assert api.pool_stats.requests == 1
+
+
+def test_unparsable_bodies_leave_the_cache(local_host: str, tmp_path):
+    request_data = GibddDTPCardData(
+        date=[GibddDateString.from_year_month(2019, 1)],
+        ParReg='45',
+        order=DtpCardDataOrder(type=1, fieldName='dat'),
+        reg='45286',
+        ind='1',
+        st=str(0),
+        en=str(50)
+    )
+    cache = ResponseCache(str(tmp_path))
+    with GibddAPI(host=local_host, cache=cache) as api:
+        # the local server answers with an empty "data", like gibdd does on errors
+        with pytest.raises(CrashesNotFoundError):
+            dtp_card_data(request_data, api=api)
+        assert cache.get(request_data.to_request_form()) is None
+        with pytest.raises(CrashesNotFoundError):
+            dtp_card_data(request_data, api=api)
+        assert api.pool_stats.requests == 2
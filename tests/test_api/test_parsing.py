@@ -0,0 +1,66 @@
+import json
+from datetime import date, time
+
+import pytest
+
+from parser_gibdd.api.crashes import subregion_crashes
+from parser_gibdd.api.gibdd_api import GibddAPI
+from parser_gibdd.api.parsing import ParsePool
+from parser_gibdd.api.planner import RequestPlanner
+from parser_gibdd.exceptions import CrashesNotFoundError
+from parser_gibdd.metrics import Metrics, labelled, set_default_metrics
+from parser_gibdd.models.gibdd.views import CrashDataResponseView
+from tests.samples import crash_card, crash_data
+
+CARDS = [crash_card(ind, "01.01.2019") for ind in range(7)]
+
+
+def body(cards: list) -> bytes:
+    return json.dumps({"data": json.dumps(crash_data("Центр", cards))}).encode()
+
+
+class Pages:
+    """Answers the getDTPCardData requests with the pages of CARDS"""
+    replaying = True
+
+    def replay(self, url, payload) -> bytes:
+        request = json.loads(payload["data"])
+        page = crash_data("Центр", CARDS[int(request["st"]):int(request["en"])])
+        page["countCard"] = len(CARDS)
+        return json.dumps({"data": json.dumps(page)}).encode()
+
+    def record(self, url, payload, body) -> None:
+        pass
+
+
+@pytest.fixture(scope="module")
+def parse_pool():
+    with ParsePool(workers=2) as pool:
+        yield pool
+
+
+def test_validated_in_worker(parse_pool: ParsePool):
+    metrics = Metrics()
+    previous = set_default_metrics(metrics)
+    try:
+        with labelled(okato="45286"):
+            response = parse_pool.parse(body(CARDS[:2]))
+    finally:
+        set_default_metrics(previous)
+    assert isinstance(response, CrashDataResponseView)
+    assert [card.id for card in response.crashes] == [0, 1]
+    assert response.crashes[0].Time == time(12, 30)
+    recorded = {(line["metric"], line["labels"]["okato"]) for line in map(json.loads, metrics.json_lines())}
+    assert recorded == {(stage, "45286") for stage in ("decode", "validate", "serialize")}
+
+
+def test_invalid_body(parse_pool: ParsePool):
+    with pytest.raises(CrashesNotFoundError):
+        parse_pool.parse(b'{"data": ""}')
+
+
+def test_pages_parsed_in_pool(parse_pool: ParsePool):
+    with GibddAPI(replay=Pages(), parse_pool=parse_pool) as api:
+        crashes = subregion_crashes("45", "45286", date(2019, 1, 1), date(2019, 1, 1), api=api,
+                                    planner=RequestPlanner(card_limit=3))
+    assert [card.id for response in crashes for card in response.crashes] == list(range(7))
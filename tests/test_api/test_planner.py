@@ -0,0 +1,127 @@
+import json
+from datetime import date
+from unittest import mock
+
+import pytest
+
+from parser_gibdd.api.crashes import subregion_crashes, subregion_unit_crashes, dtp_card_data
+from parser_gibdd.api.planner import RequestPlanner, CrawlUnit, PageSizer, months_between
+from parser_gibdd.exceptions import CrashesNotFoundError, ResourceRequestFailed, ResourceUnreachable
+from parser_gibdd.journal import CrawlJournal
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+from tests.samples import crash_card, crash_data
+
+
+def test_months_between():
+    assert months_between(date(2019, 11, 1), date(2020, 2, 1)) == [(2019, 11), (2019, 12), (2020, 1), (2020, 2)]
+    assert months_between(date(2020, 5, 1), date(2020, 5, 1)) == [(2020, 5)]
+
+
+def test_units():
+    planner = RequestPlanner()
+    assert planner.units("45", "45286", date(2015, 1, 1), date(2021, 6, 1)) == [
+        CrawlUnit("45", "45286", (2015, 1), (2021, 6))
+    ]
+    planner = RequestPlanner(max_months=12)
+    units = planner.units("45", "45286", date(2019, 3, 1), date(2020, 4, 1))
+    assert units == [CrawlUnit("45", "45286", (2019, 3), (2020, 2)), CrawlUnit("45", "45286", (2020, 3), (2020, 4))]
+
+
+def test_pages():
+    planner = RequestPlanner(card_limit=100)
+    unit = CrawlUnit("45", "45286", (2019, 11), (2020, 1))
+    pages = planner.pages(unit, 250)
+    assert [(page.st, page.en) for page in pages] == [("0", "100"), ("100", "200"), ("200", "300")]
+    assert pages[0] == planner.first_page(unit)
+    assert pages[0].date == ["MONTHS:11.2019", "MONTHS:12.2019", "MONTHS:1.2020"]
+
+
+def test_known_count():
+    planner = RequestPlanner()
+    unit = CrawlUnit("45", "45286", (2019, 11), (2020, 1))
+    assert planner.known_count(unit) is None
+    for month, count in (((2019, 11), 1), ((2019, 12), 2), ((2020, 1), 3)):
+        planner.record(CrawlUnit("45", "45286", month, month), count)
+    assert planner.known_count(unit) == 6
+    planner.record(unit, 7)
+    assert planner.known_count(unit) == 7
+
+
+def fake_dtp_card_data(request_data, **kwargs):
+    start, end = int(request_data.st), int(request_data.en)
+    cards = [crash_card(ind, "01.01.2019") for ind in range(7)]
+    data = crash_data("Центр", cards[start:end])
+    data["countCard"] = len(cards)
+    return CrashDataResponse.parse_raw(json.dumps(data))
+
+
+def test_subregion_crashes_skips_probes():
+    planner = RequestPlanner(card_limit=5)
+    with mock.patch("parser_gibdd.api.crashes.dtp_card_data", side_effect=fake_dtp_card_data) as fetch:
+        crashes = subregion_crashes("45", "45286", date(2019, 1, 1), date(2019, 12, 1), planner=planner)
+        assert [len(response.crashes) for response in crashes] == [5, 2]
+        assert fetch.call_count == 2
+        # the count is known now, empty subregions are not requested at all
+        planner.record(CrawlUnit("45", "45287", (2019, 1), (2019, 12)), 0)
+        assert subregion_crashes("45", "45287", date(2019, 1, 1), date(2019, 12, 1), planner=planner) == []
+        assert fetch.call_count == 2
+
+
+def test_failed_later_page_is_not_finished(tmp_path):
+    def failing_later_pages(request_data, **kwargs):
+        if int(request_data.st) >= 4:
+            raise CrashesNotFoundError()
+        return fake_dtp_card_data(request_data)
+
+    planner = RequestPlanner(card_limit=2, page_workers=1)
+    journal = CrawlJournal(str(tmp_path / "journal.sqlite3"))
+    unit = CrawlUnit("45", "45286", (2019, 1), (2019, 1))
+    with mock.patch("parser_gibdd.api.crashes.dtp_card_data", side_effect=failing_later_pages):
+        with pytest.raises(ResourceRequestFailed):
+            subregion_unit_crashes(unit, journal=journal, planner=planner)
+    assert journal.get(unit) is None
+    assert planner.known_count(unit) == 7
+    journal.close()
+
+
+def test_empty_first_page_is_an_empty_unit():
+    planner = RequestPlanner()
+    unit = CrawlUnit("45", "45286", (2019, 1), (2019, 1))
+    with mock.patch("parser_gibdd.api.crashes.dtp_card_data", side_effect=CrashesNotFoundError()):
+        assert subregion_unit_crashes(unit, planner=planner) == []
+    assert planner.known_count(unit) == 0
+
+
+def test_page_sizer():
+    sizer = PageSizer(initial=500, minimum=50, maximum=5000, target_seconds=10, target_bytes=10 ** 6)
+    assert sizer.page_size() == 500
+    # 10ms and 1kb per card: latency allows 1000 cards, body size allows 976
+    sizer.observe(cards=100, seconds=1.0, size=100 * 1024)
+    assert sizer.page_size() == 950
+    sizer.observe(cards=0, seconds=100.0, size=10 ** 9)
+    assert sizer.page_size() == 950
+    for _ in range(20):
+        sizer.observe(cards=100, seconds=100.0, size=100)
+    assert sizer.page_size() == 50
+
+
+def test_adaptive_pages_follow_sizer():
+    sizer = PageSizer(initial=3, minimum=1)
+    planner = RequestPlanner(card_limit=5, sizer=sizer, page_workers=2)
+    with mock.patch("parser_gibdd.api.crashes.dtp_card_data", side_effect=fake_dtp_card_data) as fetch:
+        crashes = subregion_crashes("45", "45286", date(2019, 1, 1), date(2019, 12, 1), planner=planner)
+    assert [(call.args[0].st, call.args[0].en) for call in fetch.call_args_list] == [("0", "3"), ("3", "6"), ("6", "9")]
+    assert sum(len(response.crashes) for response in crashes) == 7
+
+
+def test_single_page_is_retried():
+    api = mock.Mock()
+    api.send_request.side_effect = [ResourceUnreachable(), mock.Mock(content=json.dumps(
+        {"data": json.dumps(crash_data("Центр", [crash_card(1, "01.01.2019")]))}
+    ).encode(), from_cache=False, round_trip=0.1)]
+    planner = RequestPlanner()
+    with mock.patch("parser_gibdd.api.crashes.time.sleep") as sleep:
+        response = dtp_card_data(planner.first_page(CrawlUnit("45", "45286", (2019, 1), (2019, 1))), api=api,
+                                 retries=2)
+    sleep.assert_called_once()
+    assert len(response.crashes) == 1
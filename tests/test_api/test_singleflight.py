@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import pytest
+
+from parser_gibdd.api.gibdd_api import GibddAPI, DtpCardDataResponseHandler
+from parser_gibdd.api.singleflight import SingleFlight, MISS, HIT, COALESCED
+from parser_gibdd.models.gibdd.requests import GibddDTPCardData, GibddDateString, DtpCardDataOrder
+from tests.samples import crash_card, crash_data
+
+
+def wait_until(condition, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_concurrent_calls_are_coalesced():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(single_flight.do, "key", call) for _ in range(4)]
+        wait_until(lambda: single_flight.coalesced == 3)
+        release.set()
+        flights = [future.result() for future in futures]
+    assert len(calls) == 1
+    assert sorted(flight.outcome for flight in flights) == [COALESCED] * 3 + [MISS]
+    assert len({id(flight.shared) for flight in flights}) == 1
+    hit = single_flight.do("key", call)
+    assert (hit.result, hit.outcome, hit.shared) == ("result", HIT, None)
+    assert single_flight.stats()["hits"] == 1
+
+
+def test_lru_is_bounded_by_size():
+    # the bodies are measured by default
+    single_flight = SingleFlight(max_bytes=10)
+    for key in "abc":
+        single_flight.do(key, lambda: mock.Mock(content=b"x" * 4))
+    assert single_flight.stats()["entries"] == 2
+    assert single_flight.stats()["size"] == 8
+    assert single_flight.do("a", lambda: "y").outcome == MISS
+    assert single_flight.do("c", lambda: "y").outcome == HIT
+
+
+def test_lru_is_bounded_by_entries():
+    single_flight = SingleFlight(max_entries=2)
+    for key in "abc":
+        single_flight.do(key, lambda: b"x")
+    assert single_flight.stats()["entries"] == 2
+    assert single_flight.do("a", lambda: b"y").outcome == MISS
+
+
+def test_exceptions_are_shared_and_not_remembered():
+    single_flight = SingleFlight()
+
+    def fail():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        single_flight.do("key", fail)
+    assert single_flight.do("key", lambda: 1).outcome == MISS
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    calls = 0
+    release = threading.Event()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        CountingHandler.calls += 1
+        CountingHandler.release.wait(5)
+        body = json.dumps({"data": json.dumps(crash_data("Центр", [crash_card(1, "01.01.2019")]))}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def counting_host():
+    CountingHandler.calls = 0
+    CountingHandler.release = threading.Event()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CountingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_identical_requests_share_the_call_and_the_parsed_result(counting_host: str):
+    request_data = GibddDTPCardData(
+        date=[GibddDateString.from_year_month(2019, 1)], ParReg='45', order=DtpCardDataOrder(type=1, fieldName='dat'),
+        reg='45286', ind='1', st='0', en='50'
+    )
+    single_flight = SingleFlight()
+    with GibddAPI(host=counting_host, single_flight=single_flight) as api:
+        def fetch(_):
+            response = api.send_request(api.request_dtp_card_data(request_data))
+            return response, DtpCardDataResponseHandler(response).parse()
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(fetch, each) for each in range(3)]
+            wait_until(lambda: single_flight.coalesced == 2)
+            CountingHandler.release.set()
+            results = [future.result() for future in futures]
+        later, _ = fetch(None)
+
+    assert CountingHandler.calls == 1
+    assert len({id(parsed) for _, parsed in results}) == 1
+    assert sorted(getattr(response, "from_cache", False) for response, _ in results) == [False, True, True]
+    assert later.from_cache and later.content == results[0][0].content
+    assert single_flight.stats()["hits"] == 1
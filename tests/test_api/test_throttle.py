@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from requests import Request
+
+from parser_gibdd.api.gibdd_api import GibddAPI
+from parser_gibdd.api.throttle import ConcurrencyController, Throttle, TokenBucket
+from parser_gibdd.exceptions import ResourceRequestFailed
+from parser_gibdd.metrics import Metrics, set_default_metrics
+
+
+def test_token_bucket_spaces_out_requests():
+    bucket = TokenBucket(rate=10, burst=2)
+    delays = [bucket.reserve() for _ in range(4)]
+    assert delays[:2] == [0.0, 0.0]
+    assert delays[2] == pytest.approx(0.1, abs=0.02)
+    assert delays[3] == pytest.approx(0.2, abs=0.02)
+    assert TokenBucket(rate=0).reserve() == 0.0
+
+
+def test_additive_increase():
+    controller = ConcurrencyController(initial=2, maximum=3)
+    for _ in range(2):
+        assert controller.try_acquire()
+    assert not controller.try_acquire()
+    for _ in range(2):
+        controller.release(time.monotonic(), 0.1, overloaded=False)
+    assert controller.limit == pytest.approx(2 + 1 / 2 + 1 / 2.5)
+    for _ in range(20):
+        controller.acquire()
+        controller.release(time.monotonic(), 0.1, overloaded=False)
+    assert controller.limit == 3
+    assert controller.successes == 22
+
+
+def test_multiplicative_decrease_once_per_burst():
+    controller = ConcurrencyController(initial=8, minimum=2)
+    sent = [time.monotonic() for _ in range(4) if controller.try_acquire()]
+    for each in sent:
+        controller.release(each, 0.1, overloaded=True)
+    # the requests were in flight together, only the first of them decreases the limit
+    assert controller.limit == 4
+    assert (controller.overloads, controller.decreases) == (4, 1)
+    for _ in range(3):
+        controller.acquire()
+        controller.release(time.monotonic(), 0.1, overloaded=True)
+    assert controller.limit == 2
+
+
+def test_slow_responses_decrease_the_limit():
+    controller = ConcurrencyController(initial=4, latency_tolerance=3.0)
+    for latency in (0.1, 0.1, 1.0):
+        controller.acquire()
+        controller.release(time.monotonic(), latency, overloaded=False)
+    assert controller.decreases == 1
+    assert controller.limit < 4
+
+
+def test_neutral_outcomes_keep_the_limit():
+    throttle = Throttle(rate=0, controller=ConcurrencyController(initial=4))
+    throttle.release(throttle.acquire(), 404)
+    throttle.cancel(throttle.acquire())
+    assert throttle.controller.limit == 4
+    assert throttle.dict()["in_flight"] == 0
+    assert throttle.dict()["requests"] == 2
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Returns 503 to every other request"""
+    protocol_version = "HTTP/1.1"
+    calls = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        FlakyHandler.calls += 1
+        status, body = (503, b"busy") if FlakyHandler.calls % 2 else (200, b'{"data": ""}')
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def flaky_host():
+    FlakyHandler.calls = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_5xx_are_retried_and_back_off_the_throttle(flaky_host: str):
+    throttle = Throttle(rate=0, controller=ConcurrencyController(initial=4))
+    with GibddAPI(host=flaky_host, backoff=0, throttle=throttle) as api:
+        response = api.send_request(Request(method='POST', url=f'{flaky_host}/map/getDTPCardData', json={}))
+    assert response.status_code == 200
+    assert FlakyHandler.calls == 2
+    assert throttle.controller.limit == 2
+    assert throttle.dict()["overloads"] == 1
+
+
+def test_wait_and_round_trip_are_timed_apart(flaky_host: str):
+    FlakyHandler.calls = 1
+    metrics = Metrics()
+    previous = set_default_metrics(metrics)
+    try:
+        with GibddAPI(host=flaky_host, throttle=Throttle(rate=0)) as api:
+            api.throttle.bucket.reserve = lambda: 0.2
+            response = api.send_request(Request(method='POST', url=f'{flaky_host}/map/getDTPCardData', json={}))
+    finally:
+        set_default_metrics(previous)
+    waits = [line for line in map(json.loads, metrics.json_lines()) if line["metric"] == "throttle"]
+    assert len(waits) == 1 and waits[0]["seconds"] == pytest.approx(0.2, abs=0.05)
+    assert response.round_trip < 0.2
+
+
+def test_exhausted_retries_fail(flaky_host: str):
+    with GibddAPI(host=flaky_host, retries=0, throttle=Throttle(rate=0)) as api:
+        with pytest.raises(ResourceRequestFailed):
+            api.send_request(Request(method='POST', url=f'{flaky_host}/map/getDTPCardData', json={}))
+        assert api.throttle.controller.in_flight == 0
@@ -0,0 +1,58 @@
+import os
+import time
+
+import pytest
+
+from parser_gibdd.cache import ResponseCache
+from parser_gibdd.models.gibdd.requests import GibddDTPCardData, GibddDateString, DtpCardDataOrder
+
+
+def payload(year: int, months=(1, 12), cards=(0, 50)) -> dict:
+    return GibddDTPCardData(
+        date=[GibddDateString.from_year_month(year, m) for m in range(months[0], months[1] + 1)],
+        ParReg='45',
+        order=DtpCardDataOrder(type=1, fieldName='dat'),
+        reg='45286',
+        ind='1',
+        st=str(cards[0]),
+        en=str(cards[1])
+    ).to_request_form()
+
+
+@pytest.fixture()
+def cache(tmp_path):
+    return ResponseCache(str(tmp_path), ttl=60, max_size=10 * 1024)
+
+
+def test_get_set(cache: ResponseCache):
+    assert cache.get(payload(2019)) is None
+    cache.set(payload(2019), b'{"data": "body"}')
+    assert cache.get(payload(2019)) == b'{"data": "body"}'
+    assert cache.get(payload(2019, cards=(0, 1))) is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_is_immutable(cache: ResponseCache):
+    assert cache.is_immutable(payload(2021, months=(1, 7)), now=(2021, 10))
+    assert not cache.is_immutable(payload(2021, months=(1, 8)), now=(2021, 10))
+    assert cache.is_immutable(payload(2020, months=(10, 12)), now=(2021, 3))
+
+
+def test_recent_months_expire(cache: ResponseCache):
+    this_year = time.localtime().tm_year
+    recent, closed = payload(this_year + 1), payload(2015)
+    cache.set(recent, b'recent')
+    cache.set(closed, b'closed')
+    for entry in cache.path.glob("*/*.zz"):
+        old = time.time() - 120
+        os.utime(entry, (old, old))
+    assert cache.get(recent) is None
+    assert cache.get(closed) == b'closed'
+
+
+def test_eviction(cache: ResponseCache):
+    for year in range(2000, 2020):
+        cache.set(payload(year), os.urandom(1024))
+    assert cache.size <= cache.max_size
+    assert cache.get(payload(2019)) is not None
+    assert cache.get(payload(2000)) is None
@@ -0,0 +1,28 @@
+from unittest import mock
+
+from click.testing import CliRunner
+
+from parser_gibdd.cli.shell import main
+
+
+def test_help_creates_no_clients(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runner = CliRunner()
+    for args in (["name", "--help"], ["--sync", "country", "--help"], ["--help"]):
+        result = runner.invoke(main, args)
+        assert result.exit_code == 0, result.output
+    # neither the response cache nor the sync state is created
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_clients_are_built_by_the_crawling_commands(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with mock.patch("parser_gibdd.workqueue.run_worker", return_value=0) as run_worker, \
+            mock.patch("parser_gibdd.api.gibdd_api.set_default_api") as set_default_api, \
+            mock.patch("parser_gibdd.api.planner.set_default_planner"):
+        (tmp_path / "queue.sqlite3").touch()
+        result = CliRunner().invoke(main, ["--no-cache", "--raw", "worker", "queue.sqlite3"])
+    assert result.exit_code == 0, result.output
+    run_worker.assert_called_once()
+    api = set_default_api.call_args[0][0]
+    assert api.raw and api.cache is None
@@ -0,0 +1,128 @@
+import io
+import zipfile
+from datetime import date
+from unittest import mock
+
+import pytest
+
+from parser_gibdd.api.crashes import iter_country_crashes
+from parser_gibdd.convert import package_crashes_stream, package_crashes_subregion, crash_to_dataframes, \
+    render_workbooks
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+from parser_gibdd.models.region import Country, FederalRegion, Region
+from tests.samples import crash_card, crash_data
+
+
+@pytest.fixture()
+def crash_response():
+    return CrashDataResponse.parse_obj(
+        crash_data("Центр", [crash_card(ind, "01.01.2019") for ind in range(5)])
+    )
+
+
+def test_crash_to_dataframes(crash_response: CrashDataResponse):
+    crashes, vehicles, participants = crash_to_dataframes(crash_response)
+    assert len(crashes) == 5
+    assert (crashes["region_name"] == "Центр").all()
+
+
+def test_crash_to_dataframes_dtypes():
+    card = crash_card(7, "01.01.2019")
+    driver = {"ALCO": "", "K_UCH": "Водитель", "POL": "Мужской", "NPDD": [], "N_UCH": "1", "SOP_NPDD": [],
+              "S_SM": "", "S_T": "", "V_ST": "12", "INJURED_CARD_ID": "", "SAFETY_BELT": "Да", "S_SEAT_GROUP": ""}
+    card["infoDtp"]["ts_info"] = [{
+        "color": "Белый", "f_sob": "", "g_v": "2014", "m_pov": "", "m_ts": "Rio", "marka_ts": "KIA", "n_ts": "1",
+        "o_pf": "", "r_rul": "", "t_n": "", "t_ts": "", "ts_s": "", "ts_uch": [driver],
+    }]
+    card["infoDtp"]["uchInfo"] = [{key: value for key, value in driver.items()
+                                   if key not in ("INJURED_CARD_ID", "SAFETY_BELT", "S_SEAT_GROUP")}]
+    crashes, vehicles, participants = crash_to_dataframes(CrashDataResponse.parse_obj(crash_data("Центр", [card])))
+    assert crashes["id"].dtype == "int64"
+    assert crashes["longitude"].dtype == "float64"
+    assert crashes["crash_type"].dtype == "category"
+    assert crashes["weather"].tolist() == [["Ясно"]]
+    assert vehicles["car_brand"].dtype == "category"
+    assert vehicles["crash_id"].tolist() == [7]
+    # passengers and pedestrians go first, the drivers of the vehicles after them
+    assert participants["SAFETY_BELT"].tolist()[1] == "Да"
+    assert participants["SAFETY_BELT"].isna().tolist() == [True, False]
+    assert participants["crash_id"].tolist() == [7, 7]
+
+
+def test_package_crashes_stream(crash_response: CrashDataResponse, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    events = []
+
+    def stream():
+        for fed in ("Москва", "Тверь"):
+            events.append(fed)
+            yield fed, "Центр", [crash_response]
+
+    with mock.patch("parser_gibdd.convert.crash_to_excel_bytes",
+                    side_effect=lambda crash: events.append("xlsx") or b""):
+        package_crashes_stream(stream(), filename="country")
+    # every subregion is written before the next one is requested
+    assert events == ["Москва", "xlsx", "Тверь", "xlsx"]
+    with zipfile.ZipFile(tmp_path / "country.zip") as archive:
+        assert archive.namelist() == ["Москва/Центр/2019.xlsx", "Тверь/Центр/2019.xlsx"]
+
+
+def test_iter_country_crashes_keeps_order():
+    country = Country(regions=[
+        FederalRegion(name=f"Регион {fed}", okato=str(fed), districts=[
+            Region(name=f"Район {fed}-{sub}", okato=f"{fed}{sub}") for sub in range(4)
+        ])
+        for fed in range(1, 4)
+    ])
+    with mock.patch("parser_gibdd.api.crashes.subregion_crashes",
+                    side_effect=lambda subregion, **kwargs: [subregion]):
+        result = list(iter_country_crashes(country, date(2019, 1, 1), date(2019, 12, 1), api=mock.Mock(),
+                                           max_workers=2))
+    assert [(fed, sub) for fed, sub, _ in result] == [
+        (fed.name, sub.name) for fed in country.regions for sub in fed.districts
+    ]
+    assert [crashes for _, _, crashes in result][:2] == [["10"], ["11"]]
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "arrow"])
+def test_package_crashes_stream_columnar(crash_response: CrashDataResponse, output_format: str, tmp_path, monkeypatch):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.dataset as ds
+    monkeypatch.chdir(tmp_path)
+    package_crashes_stream([("Москва", "Центр", [crash_response, crash_response])], filename="country",
+                           output_format=output_format)
+    files = sorted(p.relative_to(tmp_path).as_posix() for p in (tmp_path / "country").rglob(f"*.{output_format}"))
+    assert files == [
+        f"country/crashes/federal_region=Москва/year=2019/Центр-0.{output_format}",
+        f"country/crashes/federal_region=Москва/year=2019/Центр-1.{output_format}",
+    ]
+    table = ds.dataset(tmp_path / "country" / "crashes", format="ipc" if output_format == "arrow" else "parquet",
+                       partitioning="hive").to_table()
+    assert table.num_rows == 10
+    assert pa.types.is_dictionary(table.schema.field("crash_type").type)
+    assert pa.types.is_date32(table.schema.field("date").type)
+    assert pa.types.is_floating(table.schema.field("longitude").type)
+    assert pa.types.is_dictionary(table.schema.field("weather").type.value_type)
+
+
+def test_package_crashes_subregion_rerun_replaces_parts(crash_response: CrashDataResponse, tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    import pyarrow.dataset as ds
+    monkeypatch.chdir(tmp_path)
+    for _ in range(2):
+        package_crashes_subregion([crash_response], filename="Центр", output_format="parquet")
+    (tmp_path / "Центр" / "crashes" / "year=2019" / "Центр-1-0.parquet").write_bytes(b"")
+    package_crashes_subregion([crash_response], filename="Центр", output_format="parquet")
+    # the parts of another subregion with a similar name are kept
+    assert sorted(path.name for path in (tmp_path / "Центр" / "crashes" / "year=2019").iterdir()) == \
+        ["Центр-0.parquet", "Центр-1-0.parquet"]
+    table = ds.dataset(tmp_path / "Центр" / "crashes" / "year=2019" / "Центр-0.parquet").to_table()
+    assert table.num_rows == len(crash_response.crashes)
+
+
+def test_render_workbooks_in_process_pool(crash_response: CrashDataResponse):
+    names = [f"{ind}.xlsx" for ind in range(5)]
+    rendered = list(render_workbooks(((name, crash_response) for name in names), workers=2))
+    assert [name for name, _ in rendered] == names
+    with zipfile.ZipFile(io.BytesIO(rendered[0][1])) as workbook:
+        assert "xl/workbook.xml" in workbook.namelist()
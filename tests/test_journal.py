@@ -0,0 +1,47 @@
+from unittest import mock
+
+import pytest
+
+from parser_gibdd.api.crashes import subregion_unit_crashes
+from parser_gibdd.api.planner import CrawlUnit
+from parser_gibdd.journal import CrawlJournal
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+from parser_gibdd.models.gibdd.views import CrashDataResponseView
+from tests.samples import crash_card, crash_data
+
+
+@pytest.fixture()
+def journal(tmp_path):
+    journal = CrawlJournal(str(tmp_path / "journal.sqlite3"))
+    yield journal
+    journal.close()
+
+
+def test_record_and_get(journal: CrawlJournal):
+    unit = CrawlUnit("45", "45286", (2019, 1), (2019, 12))
+    response = CrashDataResponse.parse_obj(crash_data("Центр", [crash_card(1, "01.01.2019")]))
+    assert journal.get(unit) is None
+    journal.record(unit, [response])
+    journal.record(CrawlUnit("45", "45287", (2019, 1), (2019, 12)), [])
+    assert journal.get(unit) == [response]
+    assert journal.get(CrawlUnit("45", "45287", (2019, 1), (2019, 12))) == []
+    assert journal.finished() == 2
+    journal.reset()
+    assert journal.get(unit) is None
+
+
+def test_finished_units_are_skipped(journal: CrawlJournal):
+    unit = CrawlUnit("45", "45286", (2019, 1), (2019, 12))
+    with mock.patch("parser_gibdd.api.crashes.unit_crashes", return_value=[]) as fetch:
+        subregion_unit_crashes(unit, journal=journal)
+        subregion_unit_crashes(unit, journal=journal)
+    fetch.assert_called_once()
+
+
+def test_raw_journal_returns_views(tmp_path):
+    journal = CrawlJournal(str(tmp_path / "journal.sqlite3"), raw=True)
+    unit = CrawlUnit("45", "45286", (2019, 1), (2019, 12))
+    response = CrashDataResponseView(crash_data("Центр", [crash_card(1, "01.01.2019")]))
+    journal.record(unit, [response])
+    assert journal.get(unit) == [response]
+    journal.close()
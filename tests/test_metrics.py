@@ -0,0 +1,102 @@
+import json
+import pickle
+import time
+from unittest import mock
+
+import pytest
+
+from parser_gibdd.api.crashes import dtp_card_data
+from parser_gibdd.api.planner import CrawlUnit, PageSizer, RequestPlanner
+from parser_gibdd.convert import _render_in_worker, package_crashes_stream
+from parser_gibdd.metrics import Metrics, labelled, set_default_metrics
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+from parser_gibdd.models.region import Country, FederalRegion, Region
+from tests.samples import crash_card, crash_data
+
+
+@pytest.fixture()
+def metrics():
+    metrics = Metrics()
+    previous = set_default_metrics(metrics)
+    yield metrics
+    set_default_metrics(previous)
+
+
+def test_labels_and_exposition():
+    metrics = Metrics()
+    with labelled(okato="45286"):
+        metrics.observe("request", 0.5)
+        metrics.count("response_bytes", 100)
+    metrics.count("response_bytes", 50, okato='4"5')
+    exposition = metrics.prometheus()
+    assert '# TYPE gibdd_request_seconds summary' in exposition
+    assert 'gibdd_request_seconds_count{okato="45286"} 1' in exposition
+    assert 'gibdd_response_bytes_total{okato="45286"} 100' in exposition
+    assert 'gibdd_response_bytes_total{okato="4\\"5"} 50' in exposition
+    lines = [json.loads(line) for line in metrics.json_lines()]
+    assert lines[0] == {"metric": "request", "type": "timer", "labels": {"okato": "45286"}, "count": 1,
+                        "seconds": 0.5, "max_seconds": 0.5}
+    assert len(lines) == 3
+
+
+def test_merge_after_pickling():
+    metrics, worker = Metrics(), Metrics()
+    metrics.observe("render", 1.0, okato="45286")
+    worker.observe("render", 3.0, okato="45286")
+    metrics.merge(pickle.loads(pickle.dumps(worker)))
+    line = json.loads(next(metrics.json_lines()))
+    assert (line["count"], line["seconds"], line["max_seconds"]) == (2, 4.0, 3.0)
+
+
+def test_crawl_stages_are_tagged_by_okato(metrics: Metrics):
+    api = mock.Mock(raw=False)
+    api.send_request.return_value = mock.Mock(content=json.dumps(
+        {"data": json.dumps(crash_data("Центр", [crash_card(1, "01.01.2019"), crash_card(2, "02.01.2019")]))}
+    ).encode(), from_cache=False, round_trip=0.1)
+    unit = CrawlUnit("45", "45286", (2019, 1), (2019, 1))
+    dtp_card_data(RequestPlanner().first_page(unit), api=api)
+    recorded = {(line["metric"], line["labels"].get("okato")) for line in map(json.loads, metrics.json_lines())}
+    assert recorded == {(stage, "45286") for stage in ("request", "decode", "validate", "response_bytes", "cards")}
+    summary = metrics.summary()
+    assert "2 cards downloaded" in summary
+    assert "45286" in summary
+
+
+def test_request_timer_excludes_the_waits(metrics: Metrics):
+    def send_request(request):
+        # the throttle, a coalesced request or the cache kept the request waiting
+        time.sleep(0.2)
+        return mock.Mock(content=json.dumps({"data": json.dumps(crash_data("Центр", [crash_card(1, "01.01.2019")]))})
+                         .encode(), from_cache=False, round_trip=0.01)
+
+    api = mock.Mock(raw=False, parse_pool=None, send_request=send_request)
+    sizer = mock.Mock(spec=PageSizer)
+    dtp_card_data(RequestPlanner().first_page(CrawlUnit("45", "45286", (2019, 1), (2019, 1))), api=api, sizer=sizer)
+    request = next(json.loads(line) for line in metrics.json_lines() if json.loads(line)["metric"] == "request")
+    assert request["seconds"] == 0.01
+    assert sizer.observe.call_args[0][1] == 0.01
+
+
+def test_worker_metrics_are_returned(metrics: Metrics):
+    response = CrashDataResponse.parse_obj(crash_data("Центр", [crash_card(1, "01.01.2019")]))
+    workbook, worker_metrics = _render_in_worker(response)
+    assert workbook.startswith(b"PK")
+    assert {json.loads(line)["metric"] for line in worker_metrics.json_lines()} == {"dataframe", "render"}
+    assert not metrics
+
+
+@pytest.mark.parametrize("output_format", ["xlsx", "parquet"])
+def test_output_stages_are_tagged_by_okato(metrics: Metrics, tmp_path, output_format: str):
+    if output_format == "parquet":
+        pytest.importorskip("pyarrow")
+    # two subregions of different federal regions share the name
+    country = Country(regions=[
+        FederalRegion(name="Москва", okato="45", districts=[Region(name="Центр", okato="45286")]),
+        FederalRegion(name="Тверь", okato="28", districts=[Region(name="Центр", okato="28401")]),
+    ])
+    response = CrashDataResponse.parse_obj(crash_data("Центр", [crash_card(1, "01.01.2019")]))
+    package_crashes_stream([("Москва", "Центр", [response]), ("Тверь", "Центр", [response])],
+                           filename=str(tmp_path / "country"), output_format=output_format, country=country)
+    stage = "render" if output_format == "xlsx" else "write"
+    recorded = {(line["metric"], line["labels"].get("okato")) for line in map(json.loads, metrics.json_lines())}
+    assert recorded >= {(name, okato) for name in ("dataframe", stage) for okato in ("45286", "28401")}
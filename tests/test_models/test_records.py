@@ -0,0 +1,88 @@
+import json
+import pickle
+from datetime import time
+from unittest import mock
+
+import pytest
+
+from parser_gibdd.api.gibdd_api import parse_dtp_card_data
+from parser_gibdd.api.planner import CrawlUnit
+from parser_gibdd.convert import crash_to_dataframes, frames_to_arrow
+from parser_gibdd.exceptions import CrashesNotFoundError
+from parser_gibdd.journal import CrawlJournal
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+from parser_gibdd.models.gibdd.records import CrashDataResponseRecord, VehicleInfoRecord
+from tests.samples import crash_card, crash_data
+from tests.test_models.test_views import VEHICLE
+
+
+@pytest.fixture()
+def body() -> bytes:
+    cards = [crash_card(ind, "01.01.2019") for ind in range(3)]
+    cards[0]["infoDtp"]["ts_info"] = [VEHICLE]
+    return json.dumps({"data": json.dumps(crash_data("Центр", cards))}).encode()
+
+
+def test_record_fields(body: bytes):
+    record = parse_dtp_card_data(body, compact=True)
+    assert isinstance(record, CrashDataResponseRecord)
+    assert record.cards_amount == 3
+    assert [card.id for card in record.crashes] == [0, 1, 2]
+    vehicle = record.crashes[0].crash_info.vehicle_info[0]
+    assert isinstance(vehicle, VehicleInfoRecord)
+    assert vehicle.drivers_info[0].SAFETY_BELT == "Да"
+    assert not hasattr(vehicle, "__dict__")
+    with pytest.raises(AttributeError):
+        vehicle.color = "Черный"
+    assert record.model == parse_dtp_card_data(body)
+
+
+def test_repeated_values_are_shared(body: bytes):
+    first, second = parse_dtp_card_data(body, compact=True).crashes[:2]
+    assert first.crash_info.weather == ("Ясно",)
+    assert first.crash_info.weather is second.crash_info.weather
+    assert first.crash_info.light_conditions is second.crash_info.light_conditions
+
+
+def test_compact_is_validated_unless_raw(body: bytes):
+    invalid = json.dumps({"data": json.dumps(crash_data("Центр", [{"KartId": "not a number"}]))}).encode()
+    with pytest.raises(CrashesNotFoundError):
+        parse_dtp_card_data(invalid, compact=True)
+    assert parse_dtp_card_data(invalid, raw=True, compact=True).crashes[0].id == "not a number"
+
+
+def test_record_dataframes_match_models(body: bytes):
+    from_models = crash_to_dataframes(parse_dtp_card_data(body))
+    for compact in (parse_dtp_card_data(body, compact=True), parse_dtp_card_data(body, raw=True, compact=True)):
+        for record_frame, model_frame in zip(crash_to_dataframes(compact), from_models):
+            assert record_frame.dtypes.equals(model_frame.dtypes)
+            assert record_frame.equals(model_frame)
+
+
+def test_records_of_models_and_json_are_equal(body: bytes):
+    model = parse_dtp_card_data(body)
+    with mock.patch.object(CrashDataResponse, "parse_obj", wraps=CrashDataResponse.parse_obj) as parse_obj:
+        record = parse_dtp_card_data(body, compact=True)
+    # the record is built from the validated model, the json is not parsed again
+    assert parse_obj.call_count == 1
+    assert record.crashes[0].Time == time(12, 30)
+    assert record == CrashDataResponseRecord.from_raw(json.loads(model.json(by_alias=True)))
+    assert record == parse_dtp_card_data(body, raw=True, compact=True)
+
+
+def test_record_tables_schema(body: bytes):
+    pytest.importorskip("pyarrow")
+    from_records = frames_to_arrow(crash_to_dataframes(parse_dtp_card_data(body, compact=True)))
+    from_models = frames_to_arrow(crash_to_dataframes(parse_dtp_card_data(body)))
+    assert {name: table.schema for name, table in from_records.items()} == \
+        {name: table.schema for name, table in from_models.items()}
+
+
+def test_pickle_and_journal(body: bytes, tmp_path):
+    record = parse_dtp_card_data(body, compact=True)
+    assert pickle.loads(pickle.dumps(record)) == record
+    journal = CrawlJournal(str(tmp_path / "journal.sqlite3"), compact=True)
+    unit = CrawlUnit("45", "45286", (2019, 1), (2019, 1))
+    journal.record(unit, [record])
+    assert journal.get(unit) == [record]
+    journal.close()
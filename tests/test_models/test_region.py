@@ -0,0 +1,59 @@
+import pytest
+
+from parser_gibdd.exceptions import RegionNotFoundError
+from parser_gibdd.models.region import Country, FederalRegion, Region
+
+
+@pytest.fixture()
+def country() -> Country:
+    return Country.parse_obj({"regions": [
+        {"name": "Москва", "okato": "45", "districts": [{"name": "Центральный", "okato": "45286"}]},
+        {"name": "Тверская область", "okato": "28", "districts": [
+            {"name": "Центральный", "okato": "28401"}, {"name": "Кимрский район", "okato": "28226"},
+        ]},
+    ]})
+
+
+def test_get_region(country: Country):
+    assert country.get_region("45").name == "Москва"
+    assert country.get_region("28226").name == "Кимрский район"
+    # federal regions after the first one are found too
+    assert country.get_region("28", federal=True).name == "Тверская область"
+    assert country.get_region("28226", federal=True) is None
+    assert country.get_region("1") is None
+
+
+def test_get_parent_region(country: Country):
+    assert country.get_parent_region(Region(name="Кимрский район", okato="28226")).okato == "28"
+    assert country.get_parent_region(country.get_region("45")).okato == "45"
+    with pytest.raises(RegionNotFoundError):
+        country.get_parent_region(Region(name="Нигде", okato="0"))
+
+
+def test_regions_by_name(country: Country):
+    assert [region.okato for region in country.get_regions_by_name(" центральный ")] == ["45286", "28401"]
+    assert [region.okato for region in country.find_region("Кимрский")] == ["28226"]
+
+
+def test_reindex(country: Country):
+    country.regions.append(FederalRegion(name="Тула", okato="70"))
+    assert country.get_region("70") is None
+    country.reindex()
+    assert country.get_region("70").name == "Тула"
+
+
+def test_find_region_transliterated(country: Country):
+    assert [region.okato for region in country.find_region("Kimrskii raion")] == ["28226"]
+    assert country.find_region("Екатеринбург") == []
+
+
+def test_find_regions(country: Country):
+    found = country.find_regions(["г. Москва, ул. Тверская, 1", "тверская обл", "г. Москва, ул. Тверская, 1"], limit=1)
+    assert [[match.region.okato for match in matches] for matches in found] == [["45"], ["28"], ["45"]]
+    assert found[0][0].score == 100
+
+
+def test_search_overlap_counts_distinct_trigrams():
+    # the name repeats its trigrams, it has fewer distinct trigrams than characters
+    country = Country(regions=[FederalRegion(name="Аааааааааа", okato="1")])
+    assert [region.okato for region in country.find_region("Аааааааааа Беларусь")] == ["1"]
@@ -0,0 +1,73 @@
+import json
+import pickle
+from datetime import time
+
+import pytest
+
+from parser_gibdd.api.gibdd_api import parse_dtp_card_data
+from parser_gibdd.convert import crash_to_dataframes
+from parser_gibdd.exceptions import CrashesNotFoundError
+from parser_gibdd.models.gibdd.views import CrashDataResponseView, VehicleInfoView
+from tests.samples import crash_card, crash_data
+
+VEHICLE = {
+    "color": "Белый", "f_sob": "Частная", "g_v": "2014", "m_pov": "", "m_ts": "Rio", "marka_ts": "KIA", "n_ts": "1",
+    "o_pf": "", "r_rul": "", "t_n": "", "t_ts": "", "ts_s": "",
+    "ts_uch": [{"ALCO": "", "K_UCH": "Водитель", "POL": "Мужской", "NPDD": [], "N_UCH": "1", "SOP_NPDD": [],
+                "S_SM": "", "S_T": "", "V_ST": "12", "INJURED_CARD_ID": "", "SAFETY_BELT": "Да", "S_SEAT_GROUP": ""}],
+}
+
+
+@pytest.fixture()
+def body() -> bytes:
+    cards = [crash_card(ind, "01.01.2019") for ind in range(3)]
+    cards[0]["infoDtp"]["ts_info"] = [VEHICLE]
+    return json.dumps({"data": json.dumps(crash_data("Центр", cards))}).encode()
+
+
+def test_view_resolves_aliases(body: bytes):
+    view = parse_dtp_card_data(body, raw=True)
+    assert isinstance(view, CrashDataResponseView)
+    assert view.cards_amount == 3
+    assert [card.id for card in view.crashes] == [0, 1, 2]
+    vehicle = view.crashes[0].crash_info.vehicle_info[0]
+    assert isinstance(vehicle, VehicleInfoView)
+    assert vehicle.car_brand == "KIA"
+    assert vehicle.drivers_info[0].SAFETY_BELT == "Да"
+    # plain values are coerced like the models do it, the model is only built on demand
+    assert view.crashes[0].Time == time(12, 30)
+    assert view.raw["tab"][0]["Time"] == "12:30"
+    assert view.model == parse_dtp_card_data(body)
+
+
+def test_view_dataframes_match_models(body: bytes):
+    from_views = crash_to_dataframes(parse_dtp_card_data(body, raw=True))
+    from_models = crash_to_dataframes(parse_dtp_card_data(body))
+    for view_frame, model_frame in zip(from_views, from_models):
+        assert list(view_frame.columns) == list(model_frame.columns)
+        assert view_frame.dtypes.equals(model_frame.dtypes)
+        assert view_frame.equals(model_frame)
+
+
+def test_view_coerces_plain_values(body: bytes):
+    data = json.loads(json.loads(body)["data"])
+    data["tab"][0].update(K_TS="2", Time="08:05:30")
+    data["tab"][0]["infoDtp"]["COORD_L"] = 37
+    view = CrashDataResponseView(data)
+    card = view.crashes[0]
+    assert (card.vehicles_amount, card.Time, card.crash_info.longitude) == (2, time(8, 5, 30), 37.0)
+    assert view.dict() == view.model.dict()
+    # nothing is validated, values the model rejects are returned as they were decoded
+    data["tab"][1]["Time"] = "noon"
+    assert view.crashes[1].Time == "noon"
+
+
+def test_view_round_trips(body: bytes):
+    view = parse_dtp_card_data(body, raw=True)
+    assert pickle.loads(pickle.dumps(view)) == view
+    assert CrashDataResponseView(json.loads(view.json(by_alias=True))) == view
+
+
+def test_raw_missing_data():
+    with pytest.raises(CrashesNotFoundError):
+        parse_dtp_card_data(json.dumps({"data": json.dumps({"error": 1})}).encode(), raw=True)
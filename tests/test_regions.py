@@ -0,0 +1,95 @@
+from unittest import mock
+
+import pytest
+
+from parser_gibdd.exceptions import ResourceUnreachable
+from parser_gibdd.models.region import FederalRegion, Region, Country
+from parser_gibdd.regions import refresh_country_codes, diff_country_codes, get_country_codes
+from parser_gibdd.snapshots import OkatoSnapshots
+
+FEDERAL = [FederalRegion(name="Москва", okato="45"), FederalRegion(name="Тверская область", okato="28")]
+DISTRICTS = {
+    "45": [Region(name="Центральный", okato="45286")],
+    "28": [Region(name="Кимрский район", okato="28226")],
+}
+
+
+def municipalities(region, api=None):
+    return FederalRegion(name=region.name, okato=region.okato, districts=DISTRICTS[region.okato])
+
+
+@pytest.fixture()
+def gibdd():
+    with mock.patch("parser_gibdd.regions.get_federal_regions", return_value=FEDERAL), \
+            mock.patch("parser_gibdd.regions.get_municipalities_by_federal", side_effect=municipalities) as inner, \
+            mock.patch("parser_gibdd.regions.time.sleep"):
+        yield inner
+
+
+def test_get_country_codes_retries(gibdd):
+    gibdd.side_effect = [ResourceUnreachable(), *[municipalities(region) for region in FEDERAL]]
+    country = get_country_codes(max_workers=1)
+    assert [(fed.okato, len(fed.districts)) for fed in country.regions] == [("45", 1), ("28", 1)]
+    assert gibdd.call_count == 3
+
+
+def test_refresh_uses_snapshots(gibdd, tmp_path):
+    snapshots = OkatoSnapshots(str(tmp_path))
+    first = refresh_country_codes(snapshots, period=(2021, 5))
+    assert not first.failed and snapshots.periods() == [(2021, 5)]
+    assert [region.okato for region in first.diff.added] == ["45", "45286", "28", "28226"]
+
+    gibdd.reset_mock()
+    assert refresh_country_codes(snapshots, period=(2021, 5)).country == first.country
+    assert gibdd.call_count == 0
+
+    DISTRICTS_JUNE = {"45": [Region(name="Центральный округ", okato="45286")],
+                      "28": [Region(name="Кашинский район", okato="28225")]}
+    with mock.patch.dict(DISTRICTS, DISTRICTS_JUNE):
+        june = refresh_country_codes(snapshots, period=(2021, 6))
+    assert [region.okato for region in june.diff.added] == ["28225"]
+    assert [region.okato for region in june.diff.removed] == ["28226"]
+    assert [(old.name, new.name) for old, new in june.diff.renamed] == [("Центральный", "Центральный округ")]
+
+
+def test_failed_regions_are_completed_later(gibdd, tmp_path):
+    snapshots = OkatoSnapshots(str(tmp_path))
+    refresh_country_codes(snapshots, period=(2021, 5))
+    gibdd.side_effect = lambda region, api=None: (_ for _ in ()).throw(ResourceUnreachable()) \
+        if region.okato == "28" else municipalities(region)
+    refresh = refresh_country_codes(snapshots, period=(2021, 6), retries=1)
+    assert [region.okato for region in refresh.failed] == ["28"]
+    # the failed region is taken from the previous snapshot
+    assert refresh.country.get_region("28226").name == "Кимрский район"
+    assert not refresh.diff
+    assert snapshots.periods() == [(2021, 5)]
+
+    gibdd.side_effect = municipalities
+    gibdd.reset_mock()
+    refresh = refresh_country_codes(snapshots, period=(2021, 6))
+    assert not refresh.failed
+    assert [call.args[0].okato for call in gibdd.call_args_list] == ["28"]
+    assert snapshots.periods() == [(2021, 5), (2021, 6)]
+
+
+def test_diff_report():
+    old = Country(regions=[FederalRegion(name="Москва", okato="45")])
+    assert diff_country_codes(old, old).report() == "OKATO codes did not change"
+    new = Country(regions=[FederalRegion(name="г. Москва", okato="45")])
+    assert diff_country_codes(old, new).report() == "~ 45 Москва -> г. Москва"
+
+
+def test_refresh_reuses_previous_snapshot(gibdd, tmp_path):
+    snapshots = OkatoSnapshots(str(tmp_path))
+    refresh_country_codes(snapshots, period=(2021, 5))
+    gibdd.reset_mock()
+    june_federal = [FederalRegion(name="г. Москва", okato="45"), *FEDERAL[1:], FederalRegion(name="Крым", okato="35")]
+    with mock.patch("parser_gibdd.regions.get_federal_regions", return_value=june_federal), \
+            mock.patch.dict(DISTRICTS, {"35": [Region(name="Ялта", okato="35243")]}):
+        june = refresh_country_codes(snapshots, period=(2021, 6), reuse_previous=True)
+    # only the renamed and the new federal regions are requested
+    assert sorted(call.args[0].okato for call in gibdd.call_args_list) == ["35", "45"]
+    assert [fed.okato for fed in june.country.regions] == ["45", "28", "35"]
+    assert june.country.get_region("28226").name == "Кимрский район"
+    assert [region.okato for region in june.diff.added] == ["35", "35243"]
+    assert [(old.name, new.name) for old, new in june.diff.renamed] == [("Москва", "г. Москва")]
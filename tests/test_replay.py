@@ -0,0 +1,73 @@
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from parser_gibdd.api.crashes import dtp_card_data
+from parser_gibdd.api.gibdd_api import GibddAPI
+from parser_gibdd.exceptions import RecordingNotFoundError
+from parser_gibdd.models.gibdd.requests import DtpCardDataOrder, GibddDateString, GibddDTPCardData
+from parser_gibdd.replay import ReplayStore
+from tests.samples import crash_card, crash_data
+
+
+class CrashDataHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        type(self).requests += 1
+        body = json.dumps({"data": json.dumps(crash_data("Центр", [crash_card(1, "01.01.2019")]))}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def local_host():
+    CrashDataHandler.requests = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CrashDataHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def card_request(reg: str = "45286") -> GibddDTPCardData:
+    return GibddDTPCardData(date=[GibddDateString.from_year_month(2019, 1)], ParReg="45",
+                            order=DtpCardDataOrder(type=1, fieldName="dat"), reg=reg, ind="1", st="1", en="100")
+
+
+def test_record_then_replay_offline(local_host: str, tmp_path):
+    with GibddAPI(host=local_host, replay=ReplayStore(str(tmp_path), mode="record")) as api:
+        recorded = dtp_card_data(card_request(), api=api)
+    assert CrashDataHandler.requests == 1
+    entry, = tmp_path.glob("*.json.gz")
+    with gzip.open(entry, "rt", encoding="utf-8") as recording:
+        assert json.load(recording)["endpoint"] == "/map/getDTPCardData"
+
+    store = ReplayStore(str(tmp_path))
+    with GibddAPI(host="http://127.0.0.1:9", replay=store) as api:
+        replayed = dtp_card_data(card_request(), api=api)
+    assert replayed == recorded
+    assert CrashDataHandler.requests == 1
+    assert store.stats() == {"recorded": 0, "replayed": 1}
+
+
+def test_missing_recording(tmp_path):
+    with GibddAPI(host="http://127.0.0.1:9", replay=ReplayStore(str(tmp_path))) as api:
+        with pytest.raises(RecordingNotFoundError):
+            dtp_card_data(card_request("45287"), api=api)
+
+
+def test_unknown_mode(tmp_path):
+    with pytest.raises(ValueError):
+        ReplayStore(str(tmp_path), mode="replace")
@@ -0,0 +1,38 @@
+import os
+import pickle
+from unittest import mock
+
+import pytest
+
+from parser_gibdd.models.region import Country
+from parser_gibdd.snapshots import load_country, binary_cache_path, OKATO_CACHE_VERSION
+
+
+@pytest.fixture()
+def okato_json(tmp_path):
+    path = tmp_path / "okato_codes_latest.json"
+    path.write_text(Country.parse_obj({"regions": [
+        {"name": "Москва", "okato": "45", "districts": [{"name": "Центральный", "okato": "45286"}]},
+    ]}).json(ensure_ascii=False), encoding="utf-8")
+    return path
+
+
+def test_binary_cache_is_used(okato_json):
+    country = load_country(okato_json)
+    assert binary_cache_path(okato_json).exists()
+    with mock.patch.object(Country, "parse_raw") as parse_raw:
+        cached = load_country(okato_json)
+    parse_raw.assert_not_called()
+    assert cached == country
+    assert cached.get_parent_region(cached.get_region("45286")).name == "Москва"
+
+
+def test_binary_cache_is_rebuilt(okato_json):
+    load_country(okato_json)
+    binary = binary_cache_path(okato_json)
+    binary.write_bytes(pickle.dumps((OKATO_CACHE_VERSION + 1, Country())))
+    assert load_country(okato_json).get_region("45").name == "Москва"
+    # a json file newer than the cache wins
+    okato_json.write_text(Country().json(), encoding="utf-8")
+    os.utime(binary, (0, 0))
+    assert load_country(okato_json).regions == []
@@ -0,0 +1,161 @@
+import io
+import zipfile
+from datetime import date
+from unittest import mock
+
+import pytest
+from pandas import read_excel
+
+from parser_gibdd.api.crashes import subregion_crashes
+from parser_gibdd.api.planner import RequestPlanner, CrawlUnit
+from parser_gibdd.convert import package_crashes_stream, write_columnar_subregion
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+from parser_gibdd.models.region import Country, FederalRegion, Region
+from parser_gibdd.sync import SyncState
+from parser_gibdd.warehouse import CrashWarehouse
+from tests.samples import crash_card, crash_data
+
+COUNTRY = Country(regions=[FederalRegion(name="Москва", okato="45", districts=[Region(name="Центр", okato="45286")])])
+
+
+@pytest.fixture()
+def state(tmp_path):
+    state = SyncState(str(tmp_path / "sync.sqlite3"), revise_months=2)
+    yield state
+    state.close()
+
+
+def fake_dtp_card_data(request_data, **kwargs):
+    """One card on the first day of every requested month"""
+    cards = [crash_card(ind, f"01.{month_year.split(':')[1].zfill(7)}") for ind, month_year in
+             enumerate(request_data.date)]
+    return CrashDataResponse.parse_obj(crash_data("Центр", cards))
+
+
+def test_pending_months(state: SyncState):
+    months = [(2019, month) for month in range(1, 7)]
+    assert state.pending_months("45", "45286", months) == months
+    assert state.record(CrawlUnit("45", "45286", (2019, 1), (2019, 4)), []) == months[:4]
+    # nothing is stored until the subregion is written
+    assert state.high_water_mark("45", "45286") is None
+    state.commit("45286")
+    assert state.high_water_mark("45", "45286") == (2019, 4)
+    # the two latest synced months may be revised, the next ones are new
+    assert state.pending_months("45", "45286", months) == [(2019, 3), (2019, 4), (2019, 5), (2019, 6)]
+    response = CrashDataResponse.parse_obj(crash_data("Центр", [crash_card(1, "05.04.2019")]))
+    assert state.record(CrawlUnit("45", "45286", (2019, 3), (2019, 4)), [response]) == [(2019, 4)]
+    state.commit("45286")
+    assert state.months("45", "45286")[(2019, 4)] == 1
+
+
+def test_sync_requests_only_pending_months(state: SyncState):
+    planner = RequestPlanner(sync=state)
+    with mock.patch("parser_gibdd.api.crashes.dtp_card_data", side_effect=fake_dtp_card_data) as fetch:
+        subregion_crashes("45", "45286", date(2019, 1, 1), date(2019, 10, 1), planner=planner)
+        assert len(fetch.call_args_list[0][0][0].date) == 10
+        state.commit("45286")
+        fetch.reset_mock()
+        crashes = subregion_crashes("45", "45286", date(2019, 1, 1), date(2019, 12, 1), planner=planner)
+    assert fetch.call_args_list[0][0][0].date == [
+        "MONTHS:9.2019", "MONTHS:10.2019", "MONTHS:11.2019", "MONTHS:12.2019"
+    ]
+    assert len(crashes[0].crashes) == 4
+    assert state.high_water_mark("45", "45286") == (2019, 10)
+    state.commit("45286")
+    assert state.high_water_mark("45", "45286") == (2019, 12)
+
+
+def test_marks_advance_after_writing(state: SyncState, tmp_path):
+    planner = RequestPlanner(sync=state)
+    filename = str(tmp_path / "country")
+
+    def crawl():
+        with mock.patch("parser_gibdd.api.crashes.dtp_card_data", side_effect=fake_dtp_card_data):
+            yield "Москва", "Центр", subregion_crashes("45", "45286", date(2019, 1, 1), date(2019, 3, 1),
+                                                       planner=planner)
+
+    with mock.patch("parser_gibdd.convert.write_workbooks", side_effect=KeyboardInterrupt):
+        with pytest.raises(KeyboardInterrupt):
+            package_crashes_stream(crawl(), filename=filename, append=True, country=COUNTRY, sync=state)
+    # the crawl was interrupted before the archive was written, the months are requested again
+    assert state.high_water_mark("45", "45286") is None
+    package_crashes_stream(crawl(), filename=filename, append=True, country=COUNTRY, sync=state)
+    assert state.high_water_mark("45", "45286") == (2019, 3)
+
+
+def test_units_of_gaps(state: SyncState):
+    state.record(CrawlUnit("45", "45286", (2019, 1), (2019, 6)), [])
+    state.record(CrawlUnit("45", "45286", (2019, 9), (2019, 10)), [])
+    state.commit("45286")
+    planner = RequestPlanner(sync=state)
+    assert planner.units("45", "45286", date(2019, 1, 1), date(2019, 12, 1)) == [
+        CrawlUnit("45", "45286", (2019, 7), (2019, 12)),
+    ]
+    assert RequestPlanner(sync=state, max_months=4).units("45", "45286", date(2019, 7, 1), date(2019, 12, 1)) == [
+        CrawlUnit("45", "45286", (2019, 7), (2019, 10)), CrawlUnit("45", "45286", (2019, 11), (2019, 12)),
+    ]
+
+
+def test_append_replaces_synced_months(tmp_path):
+    pytest.importorskip("pyarrow")
+    import pyarrow.dataset as ds
+
+    write_columnar_subregion([response(["01.01.2019", "01.02.2019"])], tmp_path, "Центр", "Москва", append=True)
+    # february was revised, march is new
+    write_columnar_subregion([response(["01.02.2019", "02.02.2019", "01.03.2019"])], tmp_path, "Центр", "Москва",
+                             append=True)
+    table = ds.dataset(tmp_path / "crashes", partitioning="hive").to_table()
+    assert sorted(table["date"].to_pylist()) == [
+        date(2019, 1, 1), date(2019, 2, 1), date(2019, 2, 2), date(2019, 3, 1)
+    ]
+
+
+def response(dates):
+    return CrashDataResponse.parse_obj(crash_data("Центр", [crash_card(ind, d) for ind, d in enumerate(dates)]))
+
+
+def synced(state: SyncState, first, last) -> SyncState:
+    state.record(CrawlUnit("45", "45286", first, last), [])
+    state.commit("45286")
+    return state
+
+
+def test_append_replaces_parts_of_full_runs(state: SyncState, tmp_path):
+    pytest.importorskip("pyarrow")
+    import pyarrow.dataset as ds
+
+    country = [("Москва", "Центр", [response(["01.01.2019", "01.02.2019", "01.03.2019"])])]
+    package_crashes_stream(country, filename=str(tmp_path / "country"), output_format="parquet")
+    # february was revised, march has no crashes anymore
+    package_crashes_stream([("Москва", "Центр", [response(["02.02.2019"])])], filename=str(tmp_path / "country"),
+                           output_format="parquet", append=True, country=COUNTRY,
+                           sync=synced(state, (2019, 2), (2019, 3)))
+    table = ds.dataset(tmp_path / "country" / "crashes", partitioning="hive").to_table()
+    assert sorted(table["date"].to_pylist()) == [date(2019, 1, 1), date(2019, 2, 2)]
+
+
+def test_append_rewrites_the_archive(state: SyncState, tmp_path):
+    filename = str(tmp_path / "country")
+    package_crashes_stream([("Москва", "Центр", [response(["01.01.2019", "01.02.2019", "01.03.2019"])])],
+                           filename=filename)
+    for _ in range(2):
+        # february was revised, march has no crashes anymore, the same sync runs twice a day
+        package_crashes_stream([("Москва", "Центр", [response(["02.02.2019"])])], filename=filename, append=True,
+                               country=COUNTRY, sync=synced(state, (2019, 2), (2019, 3)))
+    with zipfile.ZipFile(f"{filename}.zip") as archive:
+        names = archive.namelist()
+        assert sorted(names) == ["Москва/Центр/2019-01_2019-01.xlsx", "Москва/Центр/2019-02_2019-02.xlsx"]
+        dates = {name: read_excel(io.BytesIO(archive.read(name)), sheet_name="crashes")["date"].tolist()
+                 for name in names}
+    assert dates == {"Москва/Центр/2019-01_2019-01.xlsx": ["01.01.2019"],
+                     "Москва/Центр/2019-02_2019-02.xlsx": ["02.02.2019"]}
+
+
+def test_append_removes_emptied_months_from_warehouse(state: SyncState, tmp_path):
+    filename = str(tmp_path / "country")
+    package_crashes_stream([("Москва", "Центр", [response(["01.01.2019", "01.03.2019"])])], filename=filename,
+                           output_format="sqlite", country=COUNTRY)
+    package_crashes_stream([("Москва", "Центр", [])], filename=filename, output_format="sqlite", append=True,
+                           country=COUNTRY, sync=synced(state, (2019, 3), (2019, 3)))
+    with CrashWarehouse(f"{filename}.sqlite3") as warehouse:
+        assert warehouse.count(okato="45286") == 1
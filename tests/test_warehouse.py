@@ -0,0 +1,97 @@
+import io
+import zipfile
+from datetime import date
+
+import pytest
+from pandas import read_excel
+
+from parser_gibdd.convert import crash_to_dataframes, package_crashes_stream
+from parser_gibdd.models.gibdd.crash import CrashDataResponse
+from parser_gibdd.models.gibdd.views import CrashDataResponseView
+from parser_gibdd.models.region import Country, FederalRegion, Region
+from parser_gibdd.warehouse import CrashWarehouse
+from tests.samples import crash_card, crash_data
+
+
+def response(cards: list, raw: bool = False) -> CrashDataResponse:
+    data = crash_data("Центр", cards)
+    return CrashDataResponseView(data) if raw else CrashDataResponse.parse_obj(data)
+
+
+def with_vehicle(card: dict, brand: str) -> dict:
+    card["infoDtp"]["ts_info"] = [{
+        "color": "Белый", "f_sob": "", "g_v": "2014", "m_pov": "", "m_ts": "Rio", "marka_ts": brand, "n_ts": "1",
+        "o_pf": "", "r_rul": "", "t_n": "", "t_ts": "", "ts_s": "", "ts_uch": [],
+    }]
+    return card
+
+
+@pytest.fixture()
+def warehouse(tmp_path):
+    with CrashWarehouse(str(tmp_path / "warehouse.sqlite3")) as warehouse:
+        yield warehouse
+
+
+def test_frames_round_trip(warehouse: CrashWarehouse):
+    crash = response([with_vehicle(crash_card(ind, f"0{ind + 1}.01.2019"), "KIA") for ind in range(3)])
+    assert warehouse.upsert([crash], federal_region="Центральный", okato="45286") == 3
+    crashes, vehicles, participants = warehouse.frames(okato="45286")
+    expected_crashes, expected_vehicles, _ = crash_to_dataframes(crash)
+    assert crashes.columns.tolist() == expected_crashes.columns.tolist()
+    assert crashes.dtypes.tolist() == expected_crashes.dtypes.tolist()
+    assert crashes["weather"].tolist() == [["Ясно"]] * 3
+    assert crashes["Time"].tolist() == ["12:30:00"] * 3
+    assert vehicles.drop(columns="car_brand").equals(expected_vehicles.drop(columns="car_brand"))
+    assert warehouse.count(date_from=date(2019, 1, 2)) == 2
+
+
+def test_repeated_crawls_upsert(warehouse: CrashWarehouse):
+    warehouse.upsert([response([with_vehicle(crash_card(1, "01.01.2019"), "KIA"), crash_card(2, "01.02.2019")])],
+                     federal_region="Центральный")
+    warehouse.upsert([response([with_vehicle(crash_card(1, "01.01.2019"), "LADA")], raw=True)],
+                     federal_region="Центральный")
+    crashes, vehicles, _ = warehouse.frames()
+    assert crashes["id"].tolist() == [1, 2]
+    assert vehicles["car_brand"].tolist() == ["LADA"]
+
+
+def test_replace_months(warehouse: CrashWarehouse):
+    warehouse.upsert([response([crash_card(1, "01.01.2019"), crash_card(2, "02.01.2019"),
+                                crash_card(3, "01.02.2019")])])
+    warehouse.upsert([response([crash_card(2, "02.01.2019")])], replace_months=True)
+    assert warehouse.frames()[0]["id"].tolist() == [2, 3]
+
+
+def test_stream_into_warehouse_and_export(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    country = Country(regions=[FederalRegion(name="Центральный", okato="45", districts=[
+        Region(name="Центр", okato="45286"), Region(name="Север", okato="45287")
+    ])])
+    package_crashes_stream(
+        [("Центральный", "Центр", [response([crash_card(1, "01.01.2019"), crash_card(2, "01.01.2020")])]),
+         ("Центральный", "Север", [response([crash_card(3, "01.01.2019")])])],
+        filename="warehouse", output_format="sqlite", country=country
+    )
+    with CrashWarehouse("warehouse.sqlite3") as warehouse:
+        assert warehouse.count(okato="45287") == 1
+        warehouse.export("export")
+    with zipfile.ZipFile("export.zip") as archive:
+        assert sorted(archive.namelist()) == ["Центральный/Север/2019.xlsx", "Центральный/Центр/2019.xlsx",
+                                              "Центральный/Центр/2020.xlsx"]
+
+
+def test_export_keeps_same_named_subregions_apart(warehouse: CrashWarehouse, tmp_path):
+    warehouse.upsert([response([crash_card(1, "01.01.2019")])], federal_region="Центральный", okato="45286")
+    warehouse.upsert([response([crash_card(2, "01.01.2019")])], federal_region="Южный", okato="60401")
+    warehouse.upsert([response([crash_card(3, "01.01.2019")])], okato="1")
+    warehouse.upsert([response([crash_card(4, "01.01.2019")])], okato="2")
+    # the months of one subregion are replaced without touching its namesakes
+    warehouse.upsert([response([])], federal_region="Южный", okato="60401", replace_months=True,
+                     months=[(2019, 1)], subregion="Центр")
+    assert warehouse.count() == 3
+    warehouse.export(str(tmp_path / "export"))
+    with zipfile.ZipFile(tmp_path / "export.zip") as archive:
+        assert sorted(archive.namelist()) == ["None/Центр (1)/2019.xlsx", "None/Центр (2)/2019.xlsx",
+                                              "Центральный/Центр/2019.xlsx"]
+        assert [read_excel(io.BytesIO(archive.read(name)), sheet_name="crashes")["id"].tolist()
+                for name in sorted(archive.namelist())] == [[3], [4], [1]]
@@ -0,0 +1,122 @@
+import json
+import threading
+from datetime import date
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from parser_gibdd.api.gibdd_api import GibddAPI
+from parser_gibdd.api.planner import CrawlUnit, RequestPlanner
+from parser_gibdd.models.gibdd.requests import GibddDateString
+from parser_gibdd.models.region import Country, FederalRegion, Region
+from parser_gibdd.workqueue import DONE, FAILED, LEASED, PENDING, QueuedUnit, WorkQueue, enqueue_country, run_worker
+from tests.samples import crash_card, crash_data
+
+COUNTRY = Country(regions=[
+    FederalRegion(name=f"Регион {fed}", okato=str(fed), districts=[
+        Region(name=f"Район {fed}-{sub}", okato=f"{fed}{sub}") for sub in range(3)
+    ]) for fed in (45, 46)
+])
+UNIT = CrawlUnit("45", "450", (2019, 1), (2019, 6))
+
+
+class Months:
+    """Answers the getDTPCardData requests with a card on the first day of every requested month"""
+    replaying = True
+
+    def replay(self, url, payload) -> bytes:
+        request = json.loads(payload["data"])
+        months = [GibddDateString(value).year_month() for value in request["date"]]
+        cards = [crash_card(int(f"{request['reg']}{ind}"), f"01.{month:02d}.{year}")
+                 for ind, (year, month) in enumerate(months)]
+        return json.dumps({"data": json.dumps(crash_data("Район", cards))}).encode()
+
+    def record(self, url, payload, body) -> None:
+        pass
+
+
+@pytest.fixture()
+def queue(tmp_path):
+    with WorkQueue(str(tmp_path / "queue.sqlite3"), lease_seconds=60, max_attempts=2) as queue:
+        yield queue
+
+
+def test_enqueue_country(queue: WorkQueue):
+    planner = RequestPlanner(max_months=6)
+    assert enqueue_country(queue, COUNTRY, date(2019, 1, 1), date(2019, 12, 1), planner=planner) == 12
+    assert enqueue_country(queue, COUNTRY, date(2019, 1, 1), date(2019, 12, 1), planner=planner) == 0
+    assert queue.states() == {PENDING: 12, LEASED: 0, DONE: 0, FAILED: 0}
+    assert queue.lease("first") == QueuedUnit("Регион 45", "Район 45-0", UNIT)
+
+
+def test_expired_lease_is_reassigned(queue: WorkQueue):
+    queue.add([QueuedUnit("Регион 45", "Район 45-0", UNIT)])
+    assert queue.lease("first").unit == UNIT
+    assert queue.lease("second") is None
+    with mock.patch("parser_gibdd.workqueue.time.time", return_value=10 ** 10):
+        assert queue.lease("second").unit == UNIT
+    assert not queue.renew(UNIT, "first")
+    assert queue.renew(UNIT, "second")
+    queue.finish(UNIT, "second", cards=3)
+    assert queue.states()[DONE] == 1
+    assert not queue.unfinished()
+
+
+def test_failed_units_are_retried(queue: WorkQueue):
+    queue.add([QueuedUnit("Регион 45", "Район 45-0", UNIT)])
+    queue.lease("first")
+    queue.fail(UNIT, "first", "ResourceUnreachable()")
+    assert queue.states()[PENDING] == 1
+    queue.lease("first")
+    queue.fail(UNIT, "first", "ResourceUnreachable()")
+    assert queue.states()[FAILED] == 1
+    assert queue.lease("first") is None
+    assert queue.retry_failed() == 1
+    assert queue.lease("first").unit == UNIT
+
+
+def test_workers_write_every_unit_once(queue: WorkQueue, tmp_path):
+    pytest.importorskip("pyarrow")
+    import pyarrow.dataset as ds
+
+    enqueue_country(queue, COUNTRY, date(2019, 1, 1), date(2019, 12, 1), planner=RequestPlanner(max_months=6))
+    output = str(tmp_path / "country")
+    finished = []
+
+    def work(name: str):
+        with GibddAPI(replay=Months()) as api:
+            finished.append(run_worker(queue, output, "parquet", worker=name, poll_seconds=0.01, api=api,
+                                       planner=RequestPlanner()))
+
+    workers = [threading.Thread(target=work, args=(f"worker-{ind}",)) for ind in range(3)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    assert sum(finished) == 12
+    assert queue.states() == {PENDING: 0, LEASED: 0, DONE: 12, FAILED: 0}
+    crashes = ds.dataset(f"{output}/crashes", partitioning="hive").to_table()
+    assert crashes.num_rows == 6 * 12
+    assert set(crashes.column("federal_region").to_pylist()) == {"Регион 45", "Регион 46"}
+
+
+def test_xlsx_parts_of_units(queue: WorkQueue, tmp_path):
+    queue.add([QueuedUnit("Регион 45", "Район 45-0", UNIT)])
+    with GibddAPI(replay=Months()) as api:
+        assert run_worker(queue, str(tmp_path / "country"), "xlsx", api=api, planner=RequestPlanner()) == 1
+    assert [path.name for path in (tmp_path / "country" / "Регион 45" / "Район 45-0").iterdir()] == \
+        ["2019-01_2019-06.xlsx"]
+
+
+def test_parts_are_written_atomically(queue: WorkQueue, tmp_path):
+    pytest.importorskip("pyarrow")
+    queue.add([QueuedUnit("Регион 45", "Район 45-0", UNIT)])
+
+    def interrupted(table, where):
+        Path(where).write_bytes(b"PAR1")
+        raise OSError("No space left on device")
+
+    with GibddAPI(replay=Months()) as api, mock.patch("pyarrow.parquet.write_table", side_effect=interrupted):
+        assert run_worker(queue, str(tmp_path / "country"), "parquet", api=api, planner=RequestPlanner()) == 0
+    assert not [path for path in (tmp_path / "country").rglob("*") if path.is_file()]